@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import threading
+
+import clients
+
+# Where cached captions are kept: "firestore" for a collection in the caption
+# database, "none" to disable the cache, or the path of a local JSON file (for
+# offline runs).
+CAPTION_CACHE = os.getenv("CAPTION_CACHE", "firestore")
+
+# Cached captions expire after this many days.  Firestore deletes expired
+# entries itself if a TTL policy is set on the "expires_at" field of the
+# collection, expired entries are never returned either way.
+CAPTION_CACHE_TTL_DAYS = int(os.getenv("CAPTION_CACHE_TTL_DAYS", "90"))
+
+CAPTIONCACHETABLE = "caption_cache"
+
+
+def get_content_hash(img):
+    """
+    Get the hash of the pixels of a normalized (RGB, reduced) image, so every
+    copy of an image hashes the same whatever its file name, container or
+    metadata.
+
+    Args:
+        img (PIL.Image.Image): The image as it would be sent to the API.
+
+    Returns:
+        str: The hex sha256 of the image size and pixels.
+    """
+
+    content_hash = hashlib.sha256(f"{img.mode} {img.size}".encode("utf-8"))
+    content_hash.update(img.tobytes())
+    return content_hash.hexdigest()
+
+
+def get_cache_version(*settings):
+    """
+    Get the cache version for the settings that affect a caption, e.g. the
+    model, prompt and detail level.  Entries written under other settings are
+    never reused.
+    """
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()[:16]
+
+
+class CaptionCache(object):
+    """
+    A class that caches captions keyed by the content hash of an image and the
+    version of the caption settings.
+    """
+
+    def __init__(self, database_name, destination=CAPTION_CACHE):
+        """Initialize the CaptionCache object."""
+        self.database_name = database_name
+        self.destination = destination
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def get(self, version, content_hash):
+        """Return the cached caption, or None if there is no current entry."""
+
+        if self.destination == "none":
+            return None
+        entry = self._read(f"{version}_{content_hash}")
+        if entry is None or entry["expires_at"] <= datetime.now(timezone.utc):
+            return None
+        return entry["caption"]
+
+    def put(self, version, content_hash, caption):
+        """Cache a caption."""
+
+        if self.destination == "none":
+            return
+        now = datetime.now(timezone.utc)
+        entry = {
+            "caption": caption,
+            "version": version,
+            "content_hash": content_hash,
+            "created_at": now,
+            "expires_at": now + timedelta(days=CAPTION_CACHE_TTL_DAYS),
+        }
+        self._write(f"{version}_{content_hash}", entry)
+
+    def _read(self, key):
+        """Read an entry from the destination, or None if there is none."""
+        if self.destination == "firestore":
+            db = clients.get_firestore_client(self.database_name)
+            doc = db.collection(CAPTIONCACHETABLE).document(key).get()
+            return doc.to_dict() if doc.exists else None
+
+        with self.lock:
+            entry = self._load_file().get(key, None)
+        if entry is None:
+            return None
+        return dict(entry, expires_at=datetime.fromisoformat(entry["expires_at"]))
+
+    def _write(self, key, entry):
+        """Write an entry to the destination."""
+        if self.destination == "firestore":
+            db = clients.get_firestore_client(self.database_name)
+            db.collection(CAPTIONCACHETABLE).document(key).set(entry)
+            return
+
+        with self.lock:
+            entries = self._load_file()
+            entries[key] = json.loads(json.dumps(entry, default=str))
+            with open(self.destination, "w") as f:
+                json.dump(entries, f)
+
+    def _load_file(self):
+        """Load the local cache file once.  Must be called with the lock held."""
+        if self.entries is None:
+            self.entries = {}
+            if os.path.exists(self.destination):
+                with open(self.destination, "r") as f:
+                    self.entries = json.load(f)
+        return self.entries
+
+
+_caches = {}
+_lock = threading.Lock()
+
+
+def get_caption_cache(database_name):
+    """Return the shared CaptionCache for the database, creating it on first use."""
+    with _lock:
+        if database_name not in _caches:
+            _caches[database_name] = CaptionCache(database_name)
+        return _caches[database_name]
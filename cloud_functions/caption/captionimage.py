@@ -0,0 +1,203 @@
+import base64
+from io import BytesIO
+import os
+from PIL import Image, ImageOps
+from pillow_heif import open_heif, register_heif_opener
+
+import clients
+
+# Detail level requested from the captioning API, "low" or "high".  At low
+# detail the API scales the image to fit in 512x512, at high detail it scales
+# the short side to 768 pixels and the long side to at most 2048.
+CAPTION_DETAIL = os.getenv("CAPTION_DETAIL", "low")
+
+# The short side of the smallest source image that loses nothing at each detail
+# level.  The 500 pixel rr_img covers the 512 pixel low detail box for all but
+# near-square images.
+CAPTION_SHORT_SIDE = {"low": 500, "high": 768}
+
+# The captioning model and prompt.  Cached captions are only reused while these
+# (and the detail level) are unchanged.
+CAPTION_MODEL = "gpt-4-vision-preview"
+CAPTION_PROMPT = "What’s in this image?"
+CAPTION_MAX_TOKENS = 300
+
+# Quality of the JPEG sent to the API.
+CAPTION_JPEG_QUALITY = 85
+
+
+def get_heif_thumbnail(data, short_side):
+    """
+    Get the smallest thumbnail embedded in a HEIF container whose short side is
+    at least short_side pixels.
+
+    Args:
+        data (bytes): The contents of the HEIF/HEIC file.
+        short_side (int): The minimum size of the short side of the thumbnail.
+
+    Returns:
+        PIL.Image.Image: The decoded thumbnail, or None if none is large enough.
+    """
+
+    heif_file = open_heif(BytesIO(data))
+    for heif_img in heif_file:
+        if not heif_img.info["primary"]:
+            continue
+
+        best = None
+        for idx in range(len(heif_img.info["thumbnails"])):
+            thumb = heif_img.get_thumbnail(idx)
+            if min(thumb.size) >= short_side:
+                if best is None or min(thumb.size) < min(best.size):
+                    best = thumb
+
+        if best is not None:
+            return best.to_pillow()
+
+    return None
+
+
+def get_caption_size(size, detail):
+    """
+    Get the size the captioning API scales an image to, never upscaling.
+
+    Args:
+        size (tuple): The (width, height) of the image.
+        detail (str): The detail level, "low" or "high".
+
+    Returns:
+        tuple: The (width, height) to send the image at.
+    """
+
+    w, h = size
+    if detail == "low":
+        scale = min(1.0, 512 / max(w, h))
+    else:
+        scale = min(1.0, 768 / min(w, h), 2048 / max(w, h))
+    return (max(round(w * scale), 1), max(round(h * scale), 1))
+
+
+def load_derivative(doc, bucket, short_side):
+    """
+    Load the smallest derivative image of a record whose short side is at least
+    short_side pixels.
+
+    Args:
+        doc (dict): The image record.
+        bucket: The storage bucket where the image is located.
+        short_side (int): The minimum size of the short side.
+
+    Returns:
+        PIL.Image.Image: The derivative, or None if none is large enough.
+    """
+
+    # Records from before the derivatives were added only have the rr_img.
+    derivatives = doc.get("derivatives", None)
+    if not derivatives and doc.get("rr_img", None):
+        derivatives = {"500": doc["rr_img"]}
+
+    for size, blob_name in sorted((derivatives or {}).items(), key=lambda d: int(d[0])):
+        if int(size) < short_side:
+            continue
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            continue
+        return Image.open(BytesIO(blob.download_as_bytes()))
+
+    return None
+
+
+def load_original(doc, bucket, short_side):
+    """
+    Load the original image of a record, decoding it at a reduced size where
+    the format allows.
+
+    Args:
+        doc (dict): The image record.
+        bucket: The storage bucket where the image is located.
+        short_side (int): The minimum size of the short side.
+
+    Returns:
+        PIL.Image.Image: The correctly oriented image.
+    """
+
+    blob = bucket.get_blob(doc["blob_name"])
+
+    register_heif_opener()  # Register the HEIF and HEIC support.
+    blob_data = blob.download_as_bytes()
+    img = Image.open(BytesIO(blob_data))
+    if img.format == "HEIF" or img.format == "HEIC":
+        # Avoid decoding the full HEVC frame when the embedded thumbnail is
+        # already as large as the API will use.
+        thumb = get_heif_thumbnail(blob_data, short_side)
+        if thumb is not None:
+            return thumb
+    elif img.format == "JPEG":
+        # Decode at a reduced DCT scale, still at least short_side.
+        w, h = img.size
+        scale = max(short_side / min(w, h), 1 / 8)
+        img.draft("RGB", (round(w * scale), round(h * scale)))
+    return ImageOps.exif_transpose(img)
+
+
+def load_caption_image(doc, detail):
+    """
+    Load the image of a record at the size the API would scale it to for the
+    detail level, from the smallest derivative that is large enough, or from
+    the original if there is none.
+
+    Args:
+        doc (dict): The image record.
+        detail (str): The detail level, "low" or "high".
+
+    Returns:
+        PIL.Image.Image: The RGB image to send.
+    """
+
+    storage_client = clients.get_storage_client()
+    bucket = storage_client.get_bucket(doc["bucket_name"])
+
+    short_side = CAPTION_SHORT_SIDE[detail]
+    img = load_derivative(doc, bucket, short_side)
+    if img is None:
+        img = load_original(doc, bucket, short_side)
+
+    img = img.convert("RGB")  # Handle PNG RGBA format.
+    return img.resize(get_caption_size(img.size, detail), Image.LANCZOS)
+
+
+def get_caption_payload(img, detail):
+    """
+    Get the body of the captioning API request for an image.
+
+    Args:
+        img (PIL.Image.Image): The RGB image, already at its caption size.
+        detail (str): The detail level, "low" or "high".
+
+    Returns:
+        dict: The chat completions request body.
+    """
+
+    bytes_buffer = BytesIO()
+    img.save(bytes_buffer, "jpeg", quality=CAPTION_JPEG_QUALITY)
+    img_bytes = base64.b64encode(bytes_buffer.getvalue()).decode("utf-8")
+
+    return {
+        "model": CAPTION_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": CAPTION_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{img_bytes}",
+                            "detail": detail,
+                        },
+                    },
+                ],
+            }
+        ],
+        "max_tokens": CAPTION_MAX_TOKENS,
+    }
@@ -0,0 +1,124 @@
+import threading
+
+import firebase_admin
+from firebase_admin import firestore
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import logging
+from google.cloud import storage
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of pooled keep-alive connections used by the Cloud Storage client and
+# the API session.  Should be at least the number of threads sharing them.
+HTTP_POOL_SIZE = 32
+
+# Clients are created once per function instance and reused by every warm
+# invocation, keyed by (service, database).
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_client(service, database, create):
+    """
+    Return the client for the service and database, creating it on first use.
+
+    Args:
+        service (str): The name of the service, e.g. "storage".
+        database (str): The database name, or None if not applicable.
+        create (callable): Function creating a new client.
+
+    Returns:
+        The shared client.
+    """
+
+    key = (service, database)
+    client = _clients.get(key, None)
+    if client is None:
+        with _lock:
+            client = _clients.get(key, None)
+            if client is None:
+                client = create()
+                _clients[key] = client
+    return client
+
+
+def register_client(service, client, database=None):
+    """
+    Register an already constructed client, e.g. a local stand-in for offline
+    runs, to be returned by the getters below.
+
+    Args:
+        service (str): One of "storage", "firestore", "logging" or "api".
+        client: The client object.
+        database (str, optional): The database name for Firestore clients.
+
+    Returns:
+        None
+    """
+
+    with _lock:
+        _clients[(service, database)] = client
+
+
+def get_http_session(scopes):
+    """
+    Create an authorized HTTP session with a keep-alive connection pool large
+    enough to be shared between threads.
+
+    Args:
+        scopes (list): The OAuth scopes to request.
+
+    Returns:
+        tuple: The AuthorizedSession and the default project id.
+    """
+
+    credentials, project = google.auth.default(scopes=scopes)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session, project
+
+
+def get_storage_client():
+    """Return the shared Cloud Storage client."""
+
+    def create():
+        session, project = get_http_session(list(storage.Client.SCOPE))
+        return storage.Client(project=project, _http=session)
+
+    return _get_client("storage", None, create)
+
+
+def get_firestore_client(database_name):
+    """Return the shared Firestore client for the named database."""
+
+    def create():
+        if not firebase_admin._apps:
+            _ = firebase_admin.initialize_app()
+        return firestore.Client(database=database_name)
+
+    return _get_client("firestore", database_name, create)
+
+
+def get_logging_client():
+    """Return the shared Cloud Logging client."""
+    return _get_client("logging", None, logging.Client)
+
+
+def get_api_session():
+    """
+    Return the shared HTTP session for third party APIs, with a keep-alive
+    connection pool large enough to be shared between threads.
+    """
+
+    def create():
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+        )
+        session.mount("https://", adapter)
+        return session
+
+    return _get_client("api", None, create)
@@ -0,0 +1,164 @@
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import clients
+
+# Where log entries are written: "cloud" for Cloud Logging, "stdout", or the
+# path of a local file to append JSON lines to (for offline runs).
+LOG_SINK = os.getenv("LOG_SINK", "cloud")
+
+# Entries are written when this many are queued, or after this many seconds.
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 1.0
+
+# Seconds the SIGTERM handler waits for queued entries to be written.
+LOG_SHUTDOWN_TIMEOUT = 5.0
+
+# Queued by flush() to have the writer thread write its batch right away.
+_FLUSH = object()
+
+
+class LogSink(object):
+    """
+    A class that queues structured log entries and writes them in batches from
+    a background thread, so logging is off the request path.
+    """
+
+    def __init__(self, logger_name, destination=LOG_SINK):
+        """Initialize the LogSink object and start the writer thread."""
+        self.logger_name = logger_name
+        self.destination = destination
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        # Write whatever is still queued when the process exits, SIGTERM is
+        # handled by install_sigterm_handler().
+        atexit.register(self.flush)
+
+    def log_struct(self, entry):
+        """Queue a structured log entry."""
+        self.queue.put(entry)
+
+    def flush(self):
+        """Write every queued entry now, blocking until they have been written."""
+        self.queue.put(_FLUSH)
+        self.queue.join()
+
+    def _run(self):
+        """Write queued entries in batches until the process exits."""
+        while True:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while items[-1] is not _FLUSH and len(items) < LOG_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            entries = [item for item in items if item is not _FLUSH]
+            try:
+                if entries:
+                    self._write(entries)
+            except Exception as e:
+                print(
+                    f"Failed to write {len(entries)} log entries: {e}", file=sys.stderr
+                )
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _write(self, entries):
+        """Write a batch of entries to the destination."""
+        if self.destination == "cloud":
+            logger = clients.get_logging_client().logger(self.logger_name)
+            batch = logger.batch()
+            for entry in entries:
+                batch.log_struct(entry)
+            batch.commit()
+        elif self.destination == "stdout":
+            for entry in entries:
+                print(json.dumps({"logger": self.logger_name, **entry}, default=str))
+        else:
+            with open(self.destination, "a") as f:
+                for entry in entries:
+                    record = {"logger": self.logger_name, **entry}
+                    f.write(json.dumps(record, default=str) + "\n")
+
+
+class StageTimer(object):
+    """A class that records the wall time of named processing stages."""
+
+    def __init__(self):
+        """Initialize the StageTimer object."""
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block, recording it in milliseconds under name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[name] = round(elapsed, 1)
+
+
+_sinks = {}
+_lock = threading.Lock()
+
+
+def get_log_sink(logger_name):
+    """Return the shared LogSink for the named logger, creating it on first use."""
+    with _lock:
+        if logger_name not in _sinks:
+            _sinks[logger_name] = LogSink(logger_name)
+        return _sinks[logger_name]
+
+
+def flush_all():
+    """Write the queued entries of every LogSink."""
+    for sink in list(_sinks.values()):
+        sink.flush()
+
+
+def install_sigterm_handler():
+    """
+    Flush every LogSink when the instance is sent SIGTERM on scale down, which
+    doesn't run atexit handlers, then hand over to the previous handler.
+
+    The flush runs on its own thread with a timeout, in case the signal
+    arrived while the main thread held the lock of a queue.
+    """
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        flusher = threading.Thread(target=flush_all, daemon=True)
+        flusher.start()
+        flusher.join(LOG_SHUTDOWN_TIMEOUT)
+
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    try:
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError:
+        # Only the main thread can install signal handlers.
+        pass
+
+
+install_sigterm_handler()
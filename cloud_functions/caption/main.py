@@ -1,84 +1,101 @@
 import base64
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
-from PIL import Image
-from pillow_heif import register_heif_opener
-import requests
 import traceback
 
-import firebase_admin
-from firebase_admin import firestore
+from google.rpc import code_pb2
 
-from google.cloud import logging
-from google.cloud import storage
+from captioncache import get_cache_version, get_caption_cache, get_content_hash
+from captionimage import (
+    CAPTION_DETAIL,
+    CAPTION_MAX_TOKENS,
+    CAPTION_MODEL,
+    CAPTION_PROMPT,
+    get_caption_payload,
+    load_caption_image,
+)
+import clients
+from logsink import StageTimer, get_log_sink
+
+# Maximum number of documents captioned concurrently from a batched message.
+CAPTION_CONCURRENCY = int(os.getenv("CAPTION_CONCURRENCY", "8"))
+
+# Seconds to wait for the captioning API to respond.
+CAPTION_TIMEOUT = 120
+
+# Attempts at writing a caption back before a transient error is given up on.
+CAPTION_WRITE_ATTEMPTS = 5
 
 
 def log_message(msg_dict):
-    """Log message to Cloud Logging."""
+    """Log message to Cloud Logging.  Entries are queued and written in batches."""
 
-    client = logging.Client()
-    logger = client.logger("caption")
-    logger.log_struct(msg_dict)
+    get_log_sink("caption").log_struct(msg_dict)
 
 
-def generate_caption(doc_ref):
+def request_caption(img, detail):
     """
-    A function to predict captions for images from the given URL.
+    Request a caption for an image from the captioning API.
 
-    :param image_url: The URL of the image to be processed
-    :return: caption generated for the image.
-    """
+    Args:
+        img (PIL.Image.Image): The RGB image, already at its caption size.
+        detail (str): The detail level, "low" or "high".
 
-    doc = doc_ref.get().to_dict()
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(doc["bucket_name"])
-    blob = bucket.get_blob(doc["blob_name"])
-
-    register_heif_opener()  # Register the HEIF and HEIC support.
-    blob_data = blob.download_as_bytes()
-    img = Image.open(BytesIO(blob_data))
-    img = img.convert("RGB")  # Handle PNG RGBA format.
-    # If the image format isn't jpeg, convert it before sending it
-    # to the captioning API.
-    if img.format != "JPEG":
-        bytes_buffer = BytesIO()
-        img.save(bytes_buffer, "jpeg")
-        img_bytes = base64.b64encode(bytes_buffer.getvalue()).decode("utf-8")
-    else:
-        img_bytes = base64.b64encode(blob_data).decode("utf-8")
+    Returns:
+        str: The caption.
+    """
 
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
     }
 
-    payload = {
-        "model": "gpt-4-vision-preview",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "What’s in this image?"},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_bytes}"},
-                    },
-                ],
-            }
-        ],
-        "max_tokens": 300,
-    }
-
-    response = requests.post(
+    # The pooled session keeps connections to the API alive across requests.
+    response = clients.get_api_session().post(
         "https://api.openai.com/v1/chat/completions",
         headers=headers,
-        json=payload,
+        json=get_caption_payload(img, detail),
+        timeout=CAPTION_TIMEOUT,
     )
     response.raise_for_status()
-    caption = response.json()["choices"][0]["message"]["content"].strip()
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+
+def generate_caption(doc_ref, detail=None, cache=None):
+    """
+    A function to predict captions for images from the given URL.
+
+    The caption cache is checked first, keyed by the hash of the pixels that
+    would be sent, so identical images are only captioned once per model,
+    prompt and detail level.
 
-    return caption
+    :param doc_ref: Reference to the image record.
+    :param detail: The API detail level, defaults to CAPTION_DETAIL.
+    :param cache: The CaptionCache to use, or None to always call the API.
+    :return: caption generated for the image, and whether it came from the cache.
+    """
+
+    if detail is None:
+        detail = CAPTION_DETAIL
+
+    doc = doc_ref.get().to_dict()
+    img = load_caption_image(doc, detail)
+
+    if cache is None:
+        return request_caption(img, detail), False
+
+    version = get_cache_version(
+        CAPTION_MODEL, CAPTION_PROMPT, CAPTION_MAX_TOKENS, detail
+    )
+    content_hash = get_content_hash(img)
+    caption = cache.get(version, content_hash)
+    if caption is not None:
+        return caption, True
+
+    caption = request_caption(img, detail)
+    cache.put(version, content_hash, caption)
+    return caption, False
 
 
 def get_docref_from_db(message):
@@ -90,19 +107,88 @@ def get_docref_from_db(message):
     # "customers/{customer_id}/{tl_name}/{document_id}"
     document_path = message.get("document_path")
 
-    if not firebase_admin._apps:
-        _ = firebase_admin.initialize_app()
-
-    db = firestore.Client(database=database_name)
+    db = clients.get_firestore_client(database_name)
     doc_ref = db.document(document_path)
 
     return doc_ref
 
 
+def get_document_paths(message):
+    """
+    Get the document paths named in a message.
+
+    A batched message carries a list of paths in "document_paths" instead of a
+    single "document_path"; all the other fields are shared by every document.
+
+    Args:
+        message (dict): The decoded Pub/Sub message.
+
+    Returns:
+        list: The document paths.
+    """
+
+    if "document_paths" in message:
+        return list(message["document_paths"])
+    return [message["document_path"]]
+
+
+def log_caption_error(document_path, e, timings=None):
+    """
+    Log a failure to caption the document, with the HTTP status code if the
+    captioning API rejected the request.
+    """
+
+    log_message(
+        {
+            "message": "Failed to caption image",
+            "document_path": document_path,
+            "error": str(e),
+            "status_code": getattr(getattr(e, "response", None), "status_code", None),
+            "traceback": traceback.format_exc(),
+            "status": "error",
+            "timings": timings,
+        }
+    )
+
+
+def caption_document(message, document_path):
+    """
+    Caption a single document, logging any failure.  The caption is not written
+    back, so that a batch can be written at once.
+
+    Args:
+        message (dict): The decoded Pub/Sub message.
+        document_path (str): The path of the document to caption.
+
+    Returns:
+        tuple: The document reference, the caption (None on failure), whether
+            the caption came from the cache and the stage timings.
+    """
+
+    timer = StageTimer()
+    try:
+        doc_ref = get_docref_from_db(dict(message, document_path=document_path))
+        cache = get_caption_cache(message.get("database_name"))
+        with timer.stage("caption"):
+            caption, cache_hit = generate_caption(
+                doc_ref, message.get("detail", None), cache
+            )
+        return doc_ref, caption, cache_hit, timer.timings
+    except Exception as e:
+        log_caption_error(document_path, e, timer.timings)
+        return None, None, False, timer.timings
+
+
 def caption_image(event, context):
     """
     A function to process an image caption event.
 
+    The message may name a single document ("document_path") or a batch of
+    documents ("document_paths").  Batches are captioned concurrently, with at
+    most "concurrency" (default CAPTION_CONCURRENCY) requests in flight, and
+    the captions are written back with a bulk writer, so a document that fails
+    to update (e.g. one deleted meanwhile) fails only itself.
+
     Parameters:
         event (dict): The event triggering the function.
         context (dict): The context in which the function is running.
@@ -110,30 +196,93 @@ def caption_image(event, context):
     Returns:
         None
     """
+
+    data = base64.b64decode(event["data"]).decode("utf-8")
+    message = json.loads(data)
     try:
-        data = base64.b64decode(event["data"]).decode("utf-8")
-        message = json.loads(data)
+        caption_message(message)
+    finally:
+        # Write the entries of this invocation before it returns, the instance
+        # may be throttled or shut down once it has.
+        get_log_sink("caption").flush()
+
+
+def caption_message(message):
+    """Caption the document, or batch of documents, named in a decoded message."""
+
+    document_paths = get_document_paths(message)
 
-        doc_ref = get_docref_from_db(message)
-        caption = generate_caption(doc_ref)
-        doc_ref.update({"caption": caption})
+    concurrency = min(
+        message.get("concurrency", CAPTION_CONCURRENCY), len(document_paths)
+    )
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        results = list(
+            executor.map(lambda path: caption_document(message, path), document_paths)
+        )
+
+    captioned = [
+        (document_path, doc_ref, caption, cache_hit, timings)
+        for document_path, (doc_ref, caption, cache_hit, timings) in zip(
+            document_paths, results
+        )
+        if caption is not None
+    ]
 
+    # The write errors of each document, by document path.
+    write_errors = {}
+
+    def on_write_error(error, bulk_writer):
+        """Retry transient errors, a missing document won't come back."""
+        if error.code != code_pb2.NOT_FOUND and error.attempts < CAPTION_WRITE_ATTEMPTS:
+            return True
+        write_errors[error.operation.reference.path] = error.message
+        return False
+
+    timer = StageTimer()
+    try:
+        with timer.stage("update"):
+            db = clients.get_firestore_client(message.get("database_name"))
+            bulk_writer = db.bulk_writer()
+            bulk_writer.on_write_error(on_write_error)
+            for _, doc_ref, caption, _, _ in captioned:
+                bulk_writer.update(doc_ref, {"caption": caption, "caption_tier": "api"})
+            bulk_writer.close()
+    except Exception as e:
+        for document_path, _, _, _, timings in captioned:
+            log_caption_error(document_path, e, dict(timings, **timer.timings))
+        return
+
+    num_written = 0
+    for document_path, doc_ref, _, cache_hit, timings in captioned:
+        if doc_ref.path in write_errors:
+            e = RuntimeError(
+                f"Failed to write the caption: {write_errors[doc_ref.path]}"
+            )
+            log_caption_error(document_path, e, dict(timings, **timer.timings))
+            continue
+
+        num_written += 1
         log_message(
             {
                 "message": "Captioned image",
-                "document_path": message["document_path"],
+                "document_path": document_path,
+                "cache": "hit" if cache_hit else "miss",
                 "status": "success",
+                "timings": dict(timings, **timer.timings),
             }
         )
 
-    except Exception as e:
-
+    if len(document_paths) > 1:
         log_message(
             {
-                "message": "Failed to caption image",
-                "document_path": message["document_path"],
-                "error": str(e),
-                "traceback": traceback.format_exc(),
-                "status": "error",
+                "message": "Captioned batch",
+                "num_images": len(document_paths),
+                "num_failed": len(document_paths) - num_written,
+                "num_cache_hits": sum(c[3] for c in captioned),
+                # Not "error", the failed images have their own error entries.
+                "status": (
+                    "success" if num_written == len(document_paths) else "batch_partial"
+                ),
+                "timings": timer.timings,
             }
         )
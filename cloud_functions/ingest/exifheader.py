@@ -0,0 +1,224 @@
+import struct
+
+# Size of the first ranged read.  Enough for the Exif segment of almost every
+# JPEG and the meta box of almost every HEIC.
+EXIF_HEADER_BYTES = 64 * 1024
+
+EXIF_PREFIX = b"Exif\x00\x00"
+
+# Returned by read_exif() in place of the Exif block when the image has Exif
+# data that the header reader can't read, e.g. a HEIF Exif item stored in the
+# idat box, so the caller falls back to a full download.
+UNSUPPORTED_EXIF = object()
+
+
+class ExifHeaderReader(object):
+    """
+    A class that reads the raw Exif block of a JPEG or HEIF/HEIC blob using
+    ranged reads, fetching more of the blob only when the header needs it.
+    """
+
+    def __init__(self, blob, initial_bytes=EXIF_HEADER_BYTES):
+        """Initialize the ExifHeaderReader object."""
+        self.blob = blob
+        self.initial_bytes = initial_bytes
+        self.prefix = b""
+        self.bytes_fetched = 0
+
+    def read(self, offset, length):
+        """
+        Read length bytes at offset.  Reads within the cached prefix of the blob
+        are free, reads just past it grow the prefix (at least doubling it), and
+        reads far beyond it are fetched on their own.
+        """
+
+        end = offset + length
+        if end > len(self.prefix):
+            if offset <= 2 * max(len(self.prefix), self.initial_bytes):
+                new_len = max(end, 2 * len(self.prefix), self.initial_bytes)
+                self.prefix += self._fetch(len(self.prefix), new_len)
+            else:
+                return self._fetch(offset, end)
+        return self.prefix[offset:end]
+
+    def _fetch(self, start, end):
+        """Download bytes [start, end) of the blob."""
+        if self.blob.size is not None:
+            end = min(end, self.blob.size)
+        if start >= end:
+            return b""
+        data = self.blob.download_as_bytes(start=start, end=end - 1)
+        self.bytes_fetched += len(data)
+        return data
+
+    def read_exif(self):
+        """
+        Read the raw Exif block from the blob header.
+
+        Returns:
+            tuple: The image format ("JPEG", "HEIF" or None if the container is
+                not supported) and the Exif block starting with "Exif\\0\\0",
+                None if the image has no Exif data, or UNSUPPORTED_EXIF if it
+                can't be read from the header.
+        """
+
+        head = self.read(0, 12)
+        if head[:2] == b"\xff\xd8":
+            return "JPEG", self._read_jpeg_exif()
+        if head[4:8] == b"ftyp":
+            return "HEIF", self._read_heif_exif()
+        return None, None
+
+    def _read_jpeg_exif(self):
+        """Walk the JPEG markers up to the start of scan, looking for APP1/Exif."""
+
+        offset = 2
+        while True:
+            marker = self.read(offset, 2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] == 0xFF:
+                # Fill byte.
+                offset += 1
+                continue
+            if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD8:
+                # Standalone markers carry no length.
+                offset += 2
+                continue
+            if marker[1] in (0xD9, 0xDA):
+                # End of image or start of scan, there is no more metadata.
+                return None
+
+            (seg_len,) = struct.unpack(">H", self.read(offset + 2, 2))
+            if marker[1] == 0xE1:
+                payload = self.read(offset + 4, seg_len - 2)
+                if payload.startswith(EXIF_PREFIX):
+                    return payload
+            offset += 2 + seg_len
+
+    def _iter_boxes(self, offset, end):
+        """Yield (type, payload offset, box end) for the ISO BMFF boxes in a range."""
+
+        while end is None or offset + 8 <= end:
+            header = self.read(offset, 8)
+            if len(header) < 8:
+                return
+            size, box_type = struct.unpack(">I4s", header)
+            header_len = 8
+            if size == 1:
+                (size,) = struct.unpack(">Q", self.read(offset + 8, 8))
+                header_len = 16
+            elif size == 0:
+                # The box extends to the end of the file.
+                yield box_type, offset + header_len, None
+                return
+            if size < header_len:
+                return
+            yield box_type, offset + header_len, offset + size
+            offset += size
+
+    def _read_uint(self, offset, size):
+        """Read a big endian unsigned integer of 0, 2, 4 or 8 bytes."""
+        if size == 0:
+            return 0
+        fmt = {2: ">H", 4: ">I", 8: ">Q"}[size]
+        return struct.unpack(fmt, self.read(offset, size))[0]
+
+    def _read_heif_exif(self):
+        """Find the Exif item in the meta box and read its extents."""
+
+        meta = None
+        for box_type, start, end in self._iter_boxes(0, None):
+            if box_type == b"meta":
+                meta = (start + 4, end)  # Skip the FullBox version and flags.
+                break
+        if meta is None:
+            return None
+
+        exif_item_id = None
+        locations = {}
+        for box_type, start, end in self._iter_boxes(*meta):
+            if box_type == b"iinf":
+                exif_item_id = self._find_exif_item(start, end)
+            elif box_type == b"iloc":
+                locations = self._read_item_locations(start)
+
+        if exif_item_id is None:
+            return None
+        if locations.get(exif_item_id) is None:
+            return UNSUPPORTED_EXIF
+
+        data = b"".join(
+            self.read(offset, length) for offset, length in locations[exif_item_id]
+        )
+
+        # The item starts with the offset of the TIFF header after this field.
+        (tiff_offset,) = struct.unpack(">I", data[:4])
+        tiff = data[4 + tiff_offset :]
+        if tiff.startswith(EXIF_PREFIX):
+            return tiff
+        return EXIF_PREFIX + tiff
+
+    def _find_exif_item(self, start, end):
+        """Return the id of the Exif item listed in an iinf box."""
+
+        version = self.read(start, 1)[0]
+        entry_start = start + (6 if version == 0 else 8)
+        for box_type, infe_start, _ in self._iter_boxes(entry_start, end):
+            if box_type != b"infe":
+                continue
+            infe_version = self.read(infe_start, 1)[0]
+            if infe_version < 2:
+                continue
+            id_size = 2 if infe_version == 2 else 4
+            item_id = self._read_uint(infe_start + 4, id_size)
+            item_type = self.read(infe_start + 4 + id_size + 2, 4)
+            if item_type == b"Exif":
+                return item_id
+        return None
+
+    def _read_item_locations(self, start):
+        """
+        Return the extents of every item in an iloc box, keyed by item id.  The
+        extents of items not stored directly in the file are None.
+        """
+
+        version = self.read(start, 1)[0]
+        sizes = self.read(start + 4, 2)
+        offset_size = sizes[0] >> 4
+        length_size = sizes[0] & 0x0F
+        base_offset_size = sizes[1] >> 4
+        index_size = sizes[1] & 0x0F if version in (1, 2) else 0
+        id_size = 4 if version == 2 else 2
+
+        pos = start + 6
+        item_count = self._read_uint(pos, id_size)
+        pos += id_size
+
+        locations = {}
+        for _ in range(item_count):
+            item_id = self._read_uint(pos, id_size)
+            pos += id_size
+            construction_method = 0
+            if version in (1, 2):
+                construction_method = self._read_uint(pos, 2) & 0x0F
+                pos += 2
+            pos += 2  # Data reference index.
+            base_offset = self._read_uint(pos, base_offset_size)
+            pos += base_offset_size
+            extent_count = self._read_uint(pos, 2)
+            pos += 2
+
+            extents = []
+            for _ in range(extent_count):
+                pos += index_size
+                extent_offset = self._read_uint(pos, offset_size)
+                pos += offset_size
+                extent_length = self._read_uint(pos, length_size)
+                pos += length_size
+                extents.append((base_offset + extent_offset, extent_length))
+
+            # Only items stored directly in the file are supported.
+            locations[item_id] = extents if construction_method == 0 else None
+
+        return locations
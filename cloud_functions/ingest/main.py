@@ -1,74 +1,544 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 from io import BytesIO
 import json
 import os
-from PIL import Image, ImageOps, TiffImagePlugin
-from PIL.ExifTags import TAGS
+from PIL import Image, ImageMode, ImageOps, TiffImagePlugin
+from PIL.ExifTags import GPSTAGS, TAGS
 import piexif
-from pillow_heif import register_heif_opener
+from pillow_heif import open_heif, register_heif_opener
 import re
+import resource
+import tempfile
 import traceback
-import uuid
 
-import firebase_admin
-from firebase_admin import firestore
+from google.cloud import firestore
 
-from google.cloud import firestore_v1
-from google.cloud import storage
-from google.cloud import logging
+import clients
+from exifheader import UNSUPPORTED_EXIF, ExifHeaderReader
+from logsink import StageTimer, get_log_sink
 
+# Target size of the short side of the reduced resolution WebP image (rr_img).
+WEBP_SHORT_SIDE = 500
 
-def generate_webp_image(bucket, blob):
+# Codec, quality (0-100) and effort of the derivative images.  The effort is the
+# WebP method (0 fastest to 6 smallest) or the AVIF speed (10 fastest to 0
+# smallest).  Empty values use the encoder defaults.
+DERIVATIVE_CODEC = os.getenv("DERIVATIVE_CODEC", "webp").lower()
+DERIVATIVE_QUALITY = os.getenv("DERIVATIVE_QUALITY", "")
+DERIVATIVE_EFFORT = os.getenv("DERIVATIVE_EFFORT", "")
+
+# Pillow format, file extension, content type and effort option of each codec.
+DERIVATIVE_CODECS = {
+    "webp": ("WEBP", "webp", "image/webp", "method"),
+    "avif": ("AVIF", "avif", "image/avif", "speed"),
+}
+
+# Maximum number of images processed concurrently from a batched message.
+INGEST_MAX_WORKERS = int(os.getenv("INGEST_MAX_WORKERS", "8"))
+
+# Memory budget for a single image in MB, or 0 for no budget.  Can be
+# overridden per message with "memory_budget_mb".
+INGEST_MEMORY_BUDGET_MB = int(os.getenv("INGEST_MEMORY_BUDGET_MB", "0"))
+
+# Whether the raw Exif tags, MakerNote blobs included, are stored in the
+# metadata sidecar next to the normalized "exif" field.  Can be overridden per
+# message with "store_raw_exif".
+INGEST_STORE_RAW_EXIF = os.getenv("INGEST_STORE_RAW_EXIF", "0") == "1"
+
+# The bulky, rarely read metadata of an image is kept out of the image record,
+# in a sidecar document at {image record}/metadata/exif.
+METADATATABLE = "metadata"
+EXIF_METADATA_DOC = "exif"
+
+# Short side sizes of all the derivative images generated at ingest, e.g.
+# DERIVATIVE_SIZES="256,500,1600".  The rr_img size is always included.
+DERIVATIVE_SIZES = sorted(
+    set(
+        [int(x) for x in os.getenv("DERIVATIVE_SIZES", "256,1600").split(",") if x]
+        + [WEBP_SHORT_SIDE]
+    )
+)
+
+
+class ImageContext(object):
+    """
+    A class holding the downloaded original and the opened image for a single
+    blob, so that every ingest stage shares one download and one header parse.
+
+    With a memory budget the original is streamed into a spooled temporary file
+    instead of being held in memory, decodes larger than the budget are refused,
+    and derivatives are downscaled as the image is loaded.
+    """
+
+    def __init__(self, blob, memory_budget=None):
+        """
+        Initialize the ImageContext object.
+
+        Args:
+            blob: The image blob.
+            memory_budget (int, optional): The memory budget for the image in
+                bytes, or None for no budget.
+        """
+        self.blob = blob
+        self.memory_budget = memory_budget
+        self.fp = None
+        self.img = None
+        self.dhash = None
+
+    def download(self):
+        """
+        Download the blob contents on first use and return them as a file
+        object positioned at the start.
+        """
+        if self.fp is None:
+            if self.memory_budget is None:
+                self.fp = BytesIO(self.blob.download_as_bytes())
+            else:
+                # Spill to disk once the original uses a quarter of the budget.
+                self.fp = tempfile.SpooledTemporaryFile(
+                    max_size=self.memory_budget // 4
+                )
+                self.blob.download_to_file(self.fp)
+        self.fp.seek(0)
+        return self.fp
+
+    def get_image(self):
+        """
+        Open the image on first use and return it.  Only the header is parsed
+        here, the pixel data is decoded lazily by whichever stage needs it.
+        """
+        if self.img is None:
+            register_heif_opener()  # Register the HEIF and HEIC support.
+            self.img = Image.open(self.download())
+        return self.img
+
+    def open_image(self):
+        """
+        Open a new image over the downloaded original, for a decode that sets
+        its own draft mode.  The caller closes it.
+        """
+        register_heif_opener()  # Register the HEIF and HEIC support.
+        return Image.open(self.download())
+
+    def close(self):
+        """Release the image and the downloaded original."""
+        if self.img is not None:
+            self.img.close()
+        if self.fp is not None:
+            self.fp.close()
+        self.img = None
+        self.fp = None
+
+
+def get_heif_thumbnail(fp, min_size):
+    """
+    Get the smallest thumbnail embedded in a HEIF container that is at least
+    as large as min_size in both dimensions.
+
+    Args:
+        fp: File object with the contents of the HEIF/HEIC file.
+        min_size (tuple): The minimum (width, height) of the thumbnail.
+
+    Returns:
+        PIL.Image.Image: The decoded thumbnail, or None if none is large enough.
+    """
+
+    heif_file = open_heif(fp)
+    for heif_img in heif_file:
+        if not heif_img.info["primary"]:
+            continue
+
+        best = None
+        for idx in range(len(heif_img.info["thumbnails"])):
+            thumb = heif_img.get_thumbnail(idx)
+            w, h = thumb.size
+            if w >= min_size[0] and h >= min_size[1]:
+                if best is None or w < best.size[0]:
+                    best = thumb
+
+        if best is not None:
+            return best.to_pillow()
+
+    return None
+
+
+def get_pixel_bytes(mode):
+    """Get the bytes Pillow stores a pixel in, multi-band modes are padded to 4."""
+    if mode in ("1", "L", "P"):
+        return 1
+    if mode.startswith("I;16"):
+        return 2
+    return 4
+
+
+def get_reducing_factor(size, new_size, reducing_gap):
+    """Get the box reduction factor Pillow's resize uses for the reducing gap."""
+    return max(int(min(size[0] / new_size[0], size[1] / new_size[1]) / reducing_gap), 1)
+
+
+def get_decode_bytes(size, mode, new_size, reducing_gap):
+    """
+    Estimate the memory needed to decode an image and reduce it to new_size,
+    counting every copy alive at once: the decoded image, its RGB copy if the
+    mode needs converting, the box reduced copy, the intermediate of the
+    resize's first pass and the resized image.
+
+    Args:
+        size (tuple): The (width, height) the image decodes at.
+        mode (str): The mode the image decodes to.
+        new_size (tuple): The (width, height) it is reduced to.
+        reducing_gap (float): The reducing gap of the resize.
+
+    Returns:
+        int: The number of bytes.
+    """
+
+    w, h = size
+    num_bytes = w * h * get_pixel_bytes(mode)
+    if mode != "RGB":
+        num_bytes += w * h * 4
+
+    factor = get_reducing_factor(size, new_size, reducing_gap)
+    if factor > 1:
+        w, h = (w + factor - 1) // factor, (h + factor - 1) // factor
+        num_bytes += w * h * 4
+    return num_bytes + (new_size[0] * h + new_size[0] * new_size[1]) * 4
+
+
+def decode_raw_strips(image_ctx, img, new_size, reducing_gap):
+    """
+    Decode an image whose pixels are stored uncompressed (BMP, PPM, TGA and
+    uncompressed TIFF) a strip of rows at a time, box reducing each strip as it
+    is read, so the full size image is never held in memory.
+
+    Args:
+        image_ctx (ImageContext): Shared context for the blob.
+        img (PIL.Image.Image): The opened, not yet loaded, image.
+        new_size (tuple): The (width, height) the image is reduced to.
+        reducing_gap (float): The reducing gap of the resize.
+
+    Returns:
+        PIL.Image.Image: The box reduced RGB image, or None if the pixels are
+            not stored as a single uncompressed block.
+    """
+
+    if len(img.tile) != 1 or img.tile[0][0] != "raw":
+        return None
+    _, extents, offset, args = img.tile[0]
+    if tuple(extents[:2]) != (0, 0):
+        return None
+    w, h = extents[2:]
+    if isinstance(args, str):
+        args = (args,)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+    if not stride:
+        # Rows are packed without padding, work out their size from the mode.
+        if rawmode == "1":
+            return None
+        try:
+            mode_desc = ImageMode.getmode(rawmode)
+        except KeyError:
+            return None
+        stride = w * len(mode_desc.bands) * int(mode_desc.typestr[-1])
+
+    # Reduce the strips by the reducing gap, or further if the reduced image
+    # and its resize won't fit in half the budget.
+    factor = get_reducing_factor(img.size, new_size, reducing_gap)
+    max_factor = max(int(min(img.size[0] / new_size[0], img.size[1] / new_size[1])), 1)
+    while factor < max_factor:
+        size = [(x + factor - 1) // factor for x in img.size]
+        if get_decode_bytes(size, "RGB", new_size, reducing_gap) <= (
+            image_ctx.memory_budget // 2
+        ):
+            break
+        factor += 1
+
+    # Strips of a whole number of reduction steps, using about an eighth of
+    # the budget for the strip and its RGB copy.
+    rows = image_ctx.memory_budget // 8 // (w * (get_pixel_bytes(img.mode) + 4))
+    rows = max(rows // factor, 1) * factor
+
+    fp = image_ctx.download()
+    reduced = Image.new("RGB", ((w + factor - 1) // factor, (h + factor - 1) // factor))
+    for y0 in range(0, h, rows):
+        y1 = min(y0 + rows, h)
+        # Bottom up images (orientation -1) store the last row first.
+        fp.seek(offset + (y0 if orientation > 0 else h - y1) * stride)
+        strip = Image.frombytes(
+            img.mode,
+            (w, y1 - y0),
+            fp.read((y1 - y0) * stride),
+            "raw",
+            rawmode,
+            stride,
+            orientation,
+        )
+        if img.mode == "P":
+            strip.putpalette(img.palette)
+        strip = strip if strip.mode == "RGB" else strip.convert("RGB")
+        reduced.paste(strip.reduce(factor), (0, y0 // factor))
+
+    # Keep the orientation for the transpose.  Pillow reports the size of
+    # TIFFs with their orientation already applied, so those are transposed
+    # here, as loading them would.
+    reduced.info["exif"] = img.getexif().tobytes()
+    if (w, h) != img.size:
+        reduced = ImageOps.exif_transpose(reduced)
+    return reduced
+
+
+def decode_reduced_image(image_ctx, short_side):
+    """
+    Decode an image at a reduced resolution, returning an RGB image whose short
+    side is close to (and no smaller than) the requested size.
+
+    JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale by the DCT decoder, and
+    HEIF/HEIC files use an embedded thumbnail when one is large enough, so the
+    full resolution image is never materialized.  Over the memory budget,
+    uncompressed formats are decoded and reduced a strip at a time.  The orientation transpose is
+    applied after resizing, so it only ever touches the small image.
+
+    Args:
+        image_ctx (ImageContext): Shared context for the blob.
+        short_side (int): The target size of the short side in pixels.
+
+    Returns:
+        PIL.Image.Image: The reduced, correctly oriented RGB image.
+
+    Raises:
+        ValueError: If decoding the image would exceed the memory budget.
+    """
+
+    # A fresh image, since the draft mode only applies before the first load.
+    img = image_ctx.open_image()
+    w, h = img.size
+    resize_factor = min(w, h) // short_side
+    if resize_factor < 1:
+        resize_factor = 1
+    new_size = (w // resize_factor, h // resize_factor)
+
+    if img.format == "HEIF" or img.format == "HEIC":
+        # Thumbnails are stored with the same transformations applied as the
+        # primary image, so they need no further orientation fix.
+        thumb = get_heif_thumbnail(image_ctx.download(), new_size)
+        if thumb is not None:
+            return thumb.convert("RGB").resize(new_size, Image.LANCZOS)
+    elif img.format == "JPEG":
+        # Only has an effect before the image is loaded.  The decoder picks the
+        # largest scale whose output is still at least new_size.
+        img.draft("RGB", new_size)
+
+    reducing_gap = None
+    if image_ctx.memory_budget is not None:
+        # Refuse to decode anything that won't fit rather than running the
+        # instance out of memory, and downscale with a cheap box reduction
+        # first so the resize needs less working memory.
+        reducing_gap = 3.0
+        decoded_bytes = get_decode_bytes(img.size, img.mode, new_size, reducing_gap)
+        if decoded_bytes > image_ctx.memory_budget:
+            # Formats without a reduced decode are read in strips where their
+            # pixels are stored uncompressed.
+            reduced = decode_raw_strips(image_ctx, img, new_size, reducing_gap)
+            if reduced is None:
+                raise ValueError(
+                    f"Decoding {img.size[0]}x{img.size[1]} {img.mode} image needs "
+                    f"{decoded_bytes} bytes, over the memory budget of "
+                    f"{image_ctx.memory_budget} bytes"
+                )
+            img.close()
+            img = reduced
+
+    # Handle PNG RGBA format.  RGB images are resized directly, without first
+    # making a full size copy.
+    reduced = img if img.mode == "RGB" else img.convert("RGB")
+    if reduced.size != new_size:
+        reduced = reduced.resize(new_size, Image.LANCZOS, reducing_gap=reducing_gap)
+
+    # Fix orientation of webp images so original orientation is preserved.
+    # The Exif data is carried over by convert and resize.
+    return ImageOps.exif_transpose(reduced)
+
+
+def get_dhash(img):
+    """
+    Compute the 64-bit difference hash (dHash) of an image.  Each bit records
+    whether a pixel of a 9x8 grayscale thumbnail is brighter than its right
+    neighbour, so resized, recompressed or re-exported copies of an image have
+    hashes within a small Hamming distance of each other.
+
+    Args:
+        img (PIL.Image.Image): The image to hash, ideally already small.
+
+    Returns:
+        str: The hash as 16 hex digits.
+    """
+
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | int(left > right)
+    return f"{value:016x}"
+
+
+def get_derivative_name(blob_name, size, codec=None):
+    """
+    Get the name of the derivative image of the given size for a blob.
+
+    The WEBP_SHORT_SIDE derivative keeps the original "<name>.webp" naming so
+    existing rr_img links stay valid, other sizes are "<name>_<size>.webp".
+    The extension follows the codec, e.g. "<name>.avif" for AVIF.
+
+    Args:
+        blob_name (str): The name of the original image blob.
+        size (int): The short side size of the derivative.
+        codec (str, optional): The codec, defaults to DERIVATIVE_CODEC.
+
+    Returns:
+        str: The name of the derivative image blob.
     """
-    Generate a WebP image based on the input bucket and blob.
+
+    ext = DERIVATIVE_CODECS[codec or DERIVATIVE_CODEC][1]
+    base, _ = os.path.splitext(os.path.basename(blob_name))
+    dir_name = os.path.dirname(blob_name)
+    if size == WEBP_SHORT_SIDE:
+        return os.path.join(dir_name, f"{base}.{ext}")
+    return os.path.join(dir_name, f"{base}_{size}.{ext}")
+
+
+def encode_derivative(img, codec=None, quality=None, effort=None):
+    """
+    Encode a derivative image.
+
+    Args:
+        img (PIL.Image.Image): The image to encode.
+        codec (str, optional): "webp" or "avif", defaults to DERIVATIVE_CODEC.
+        quality (int, optional): The quality, defaults to DERIVATIVE_QUALITY.
+        effort (int, optional): The WebP method or AVIF speed, defaults to
+            DERIVATIVE_EFFORT.
+
+    Returns:
+        bytes: The encoded image.
+    """
+
+    img_format, _, _, effort_option = DERIVATIVE_CODECS[codec or DERIVATIVE_CODEC]
+    if quality is None and DERIVATIVE_QUALITY:
+        quality = int(DERIVATIVE_QUALITY)
+    if effort is None and DERIVATIVE_EFFORT:
+        effort = int(DERIVATIVE_EFFORT)
+
+    options = {}
+    if quality is not None:
+        options["quality"] = quality
+    if effort is not None:
+        options[effort_option] = effort
+
+    bytes_buffer = BytesIO()
+    img.save(bytes_buffer, img_format, **options)
+    return bytes_buffer.getvalue()
+
+
+def generate_derivatives(bucket, blob, image_ctx=None, sizes=None):
+    """
+    Generate a set of reduced resolution images from a single decode, encoded
+    with DERIVATIVE_CODEC.
+
+    JPEG and HEIF/HEIC originals are decoded separately for each size, so every
+    derivative comes from the reduced DCT decode or an embedded thumbnail.  Other
+    formats are decoded once at (about) the largest requested size, and each
+    smaller derivative is scaled down from the previous one.  Sizes at or above
+    the long side of the original are skipped rather than written as same size
+    copies, except WEBP_SHORT_SIDE, which records link to as the rr_img, and the
+    smallest size.  The perceptual hash of the smallest derivative is stored on
+    the context.
 
     Args:
         bucket: The storage bucket where the image is located.
-        blob: The image blob to generate a WebP version from.
+        blob: The image blob to generate the derivatives from.
+        image_ctx (ImageContext, optional): Shared context for the blob.  A new
+            one is created (and the blob downloaded) if not provided.
+        sizes (list, optional): The short side sizes to generate.  Defaults to
+            DERIVATIVE_SIZES.
 
     Returns:
-        str: The name of the generated WebP image if successful, None otherwise.
+        dict: The derivative blob names keyed by size (as a string), or None if
+            the blob is not an image.
     """
 
     if "image" in blob.content_type:
 
-        # Set up the new blob name.
-        base, _ = os.path.splitext(os.path.basename(blob.name))
-        dir_name = os.path.dirname(blob.name)
-        new_blob_name = os.path.join(dir_name, f"{base}.webp")
+        if sizes is None:
+            sizes = DERIVATIVE_SIZES
 
-        # Delete the webp image if it exists.
-        webp_blob = bucket.get_blob(new_blob_name)
-        if webp_blob is not None:
-            webp_blob.delete()
-
-        # Generate a resized version of the image in webp format
-        # and upload it to the bucket.
-        register_heif_opener()  # Register the HEIF and HEIC support.
-        blob_data = blob.download_as_bytes()
-        img = Image.open(BytesIO(blob_data))
-
-        # Fix orientation of webp images so original orientation is preserved.
-        img = ImageOps.exif_transpose(img)
-        img = img.convert("RGB")  # Handle PNG RGBA format.
-        w, h = img.size
-        resize_factor = min(w, h) // 500
-        if resize_factor < 1:
-            resize_factor = 1
-
-        bytes_buffer = BytesIO()
-        img.resize((w // resize_factor, h // resize_factor), Image.LANCZOS).save(
-            bytes_buffer, "WEBP"
+        if image_ctx is None:
+            image_ctx = ImageContext(blob)
+        orig = image_ctx.get_image()
+        long_side = max(orig.size)
+        sizes = sorted(
+            [
+                s
+                for s in set(sizes)
+                if s < long_side or s in (WEBP_SHORT_SIDE, min(sizes))
+            ],
+            reverse=True,
         )
-        del img
-        bucket.blob(new_blob_name).upload_from_string(bytes_buffer.getvalue())
+        reduced_decode = orig.format in ("JPEG", "HEIF", "HEIC")
 
-        return new_blob_name
+        # Upload will overwrite any existing derivative, there is no need to
+        # delete it first.
+        derivatives = {}
+        img = None
+        for size in sizes:
+            if img is None or reduced_decode:
+                img = decode_reduced_image(image_ctx, size)
+            w, h = img.size
+            if min(w, h) > size:
+                scale = size / min(w, h)
+                new_size = (max(round(w * scale), 1), max(round(h * scale), 1))
+                img = img.resize(new_size, Image.LANCZOS)
+
+            new_blob_name = get_derivative_name(blob.name, size)
+            bucket.blob(new_blob_name).upload_from_string(
+                encode_derivative(img),
+                content_type=DERIVATIVE_CODECS[DERIVATIVE_CODEC][2],
+            )
+            derivatives[str(size)] = new_blob_name
+
+        image_ctx.dhash = get_dhash(img)
+        del img
+        return derivatives
 
     return None
 
 
+def generate_webp_image(bucket, blob, image_ctx=None):
+    """
+    Generate a WebP image based on the input bucket and blob.
+
+    Args:
+        bucket: The storage bucket where the image is located.
+        blob: The image blob to generate a WebP version from.
+        image_ctx (ImageContext, optional): Shared context for the blob.  A new
+            one is created (and the blob downloaded) if not provided.
+
+    Returns:
+        str: The name of the generated WebP image if successful, None otherwise.
+    """
+
+    derivatives = generate_derivatives(bucket, blob, image_ctx, [WEBP_SHORT_SIDE])
+    if derivatives is None:
+        return None
+    return derivatives[str(WEBP_SHORT_SIDE)]
+
+
 def cast(v):
     """
     Casts the input value v to the appropriate type if necessary.
@@ -114,15 +584,27 @@ def flatten_nested_tuples(t):
     return t
 
 
-def get_exif_data(blob):
-    """Get Exif data from the blob object."""
+def get_exif_data(blob, image_ctx=None):
+    """
+    Get Exif data from the blob object.
+
+    Args:
+        blob: The image blob to read the Exif data from.
+        image_ctx (ImageContext, optional): Shared context for the blob.  A new
+            one is created (and the blob downloaded) if not provided.
+
+    Returns:
+        dict: The Exif data keyed by tag name.
+    """
 
     if "image" in blob.content_type:
-        register_heif_opener()  # Register the HEIF and HEIC support.
-        blob_data = blob.download_as_bytes()
-        img = Image.open(BytesIO(blob_data))
+        if image_ctx is None:
+            image_ctx = ImageContext(blob)
+        img = image_ctx.get_image()
         exif_data = {}
 
+        gps_data = {}
+
         if img.format == "BMP":
             # BMP images have no exif data and no exif tags are defined.
             # PIL doesn't handle this properly so we need to handle it manually.
@@ -131,19 +613,294 @@ def get_exif_data(blob):
             # Load the exif data from the image if it exists.
             raw_exif_data = img.info.get("exif", None)
             if raw_exif_data:
-                result = piexif.load(raw_exif_data, key_is_name=True)
-                exif_data = result.get("Exif", {})
+                exif_data, gps_data = get_piexif_tags(raw_exif_data)
         else:
-            exif_data = img.getexif()
-
-        if exif_data:
-            exif_info = {}
-            for tag, value in exif_data.items():
-                tag_name = TAGS.get(tag, tag)
-                exif_info[tag_name] = flatten_nested_tuples(cast(value))
-            return exif_info
+            exif_data, gps_data = get_ifd_tags(img.getexif())
+
+        return get_named_exif_tags(exif_data, gps_data)
+
+
+def get_ifd_tags(exif):
+    """
+    Merge the Exif sub-IFD of a PIL Exif object, which holds the capture
+    settings and DateTimeOriginal, into the main IFD.
+
+    Args:
+        exif (PIL.Image.Exif): The Exif data.
+
+    Returns:
+        tuple: The merged tags and the GPS tags, both keyed by tag id.
+    """
+
+    exif_data = dict(exif)
+    exif_data.update(exif.get_ifd(0x8769))
+    return exif_data, exif.get_ifd(0x8825)
+
+
+def get_piexif_tags(raw_exif_data):
+    """
+    Load a raw Exif block with piexif, merging the main and Exif IFDs.
+
+    Args:
+        raw_exif_data (bytes): The Exif block.
+
+    Returns:
+        tuple: The merged tags and the GPS tags, both keyed by tag name.
+    """
+
+    result = piexif.load(raw_exif_data, key_is_name=True)
+    exif_data = dict(result.get("0th", {}))
+    exif_data.update(result.get("Exif", {}))
+    return exif_data, result.get("GPS", {})
+
+
+def get_named_exif_tags(exif_data, gps_data=None):
+    """
+    Convert Exif data to a dict keyed by tag name, with values cast to types
+    that can be stored in the database.  The GPS tags are nested under
+    "GPSInfo".
+
+    Args:
+        exif_data: The Exif data, keyed by tag id or tag name.
+        gps_data (optional): The GPS tags, keyed by tag id or tag name.
+
+    Returns:
+        dict: The Exif data keyed by tag name.
+    """
+
+    exif_info = {}
+    if exif_data:
+        for tag, value in exif_data.items():
+            tag_name = TAGS.get(tag, tag)
+            exif_info[tag_name] = flatten_nested_tuples(cast(value))
+    if gps_data:
+        exif_info["GPSInfo"] = {
+            GPSTAGS.get(tag, tag): flatten_nested_tuples(cast(value))
+            for tag, value in gps_data.items()
+        }
+    return exif_info
+
+
+def to_float(value):
+    """
+    Convert an Exif number to a float.  Rationals are either already floats or,
+    when read by piexif, (numerator, denominator) pairs.
+
+    Args:
+        value: The Exif value.
+
+    Returns:
+        float: The value, or None if it isn't a valid number.
+    """
+
+    try:
+        if isinstance(value, (tuple, list)):
+            if len(value) != 2 or not value[1]:
+                return None
+            return value[0] / value[1]
+        if isinstance(value, bool) or value is None:
+            return None
+        value = float(value)
+        return value if value == value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def to_str(value):
+    """Convert an Exif string to a stripped str, or None if it is empty."""
+    if not isinstance(value, str):
+        return None
+    value = value.strip(" \x00")
+    return value or None
+
+
+def to_degrees(value, ref):
+    """
+    Convert an Exif GPS coordinate to signed decimal degrees.
+
+    Args:
+        value: The degrees, minutes and seconds, either as three floats or as
+            three flattened (numerator, denominator) pairs.
+        ref (str): The hemisphere, one of "N", "S", "E" or "W".
+
+    Returns:
+        float: The coordinate, or None if it can't be read.
+    """
+
+    if not isinstance(value, (tuple, list)):
+        return None
+    if len(value) == 6:
+        value = [to_float(value[idx : idx + 2]) for idx in range(0, 6, 2)]
+    else:
+        value = [to_float(v) for v in value]
+    if len(value) != 3 or None in value:
+        return None
+
+    degrees = value[0] + value[1] / 60 + value[2] / 3600
+    if to_str(ref) in ("S", "W"):
+        degrees = -degrees
+    return round(degrees, 7)
+
+
+def normalize_exif(exif_data, size=None):
+    """
+    Normalize Exif data, as returned by get_exif_data, to the compact typed
+    schema stored on the image records.  Only whitelisted fields are kept, and
+    missing fields and empty groups are left out:
+
+        camera:     make, model
+        lens:       make, model, focal_length_mm, focal_length_35mm
+        exposure:   exposure_time_s, f_number, iso, exposure_bias_ev, flash
+        gps:        latitude, longitude, altitude_m
+        datetime:   original (ISO 8601), offset
+        dimensions: width, height (as displayed), orientation
+
+    Args:
+        exif_data (dict): The Exif data keyed by tag name.
+        size (tuple, optional): The (width, height) of the stored image, used
+            instead of the Exif dimensions when known.
+
+    Returns:
+        dict: The normalized Exif data.
+    """
+
+    exif_data = exif_data or {}
+    gps_data = exif_data.get("GPSInfo", None)
+    if not isinstance(gps_data, dict):
+        gps_data = {}
+
+    iso = exif_data.get("ISOSpeedRatings", exif_data.get("PhotographicSensitivity"))
+    if isinstance(iso, (tuple, list)):
+        iso = iso[0] if iso else None
+
+    flash = exif_data.get("Flash", None)
+    if isinstance(flash, int):
+        # Bit 0 is set if the flash fired.
+        flash = bool(flash & 1)
+    else:
+        flash = None
+
+    original = None
+    datetime_str = to_str(exif_data.get("DateTimeOriginal", None))
+    if datetime_str:
+        try:
+            original = datetime.strptime(datetime_str, "%Y:%m:%d %H:%M:%S")
+            original = original.isoformat()
+        except ValueError:
+            pass
+
+    # The altitude ref is 1 below sea level.  It is a single byte, which cast()
+    # turns into a str and piexif leaves as an int.
+    altitude = to_float(gps_data.get("GPSAltitude", None))
+    altitude_ref = gps_data.get("GPSAltitudeRef", 0)
+    if isinstance(altitude_ref, (bytes, str)):
+        altitude_ref = ord(altitude_ref[:1]) if altitude_ref else 0
+    if altitude is not None and altitude_ref == 1:
+        altitude = -altitude
+
+    orientation = exif_data.get("Orientation", None)
+    if not isinstance(orientation, int):
+        orientation = None
+    if size is None:
+        size = (
+            exif_data.get("ExifImageWidth", exif_data.get("PixelXDimension")),
+            exif_data.get("ExifImageHeight", exif_data.get("PixelYDimension")),
+        )
+    width, height = [v if isinstance(v, int) else None for v in size]
+    if orientation in (5, 6, 7, 8):
+        # Rotated by 90 degrees when displayed.
+        width, height = height, width
+
+    focal_length_35mm = exif_data.get("FocalLengthIn35mmFilm", None)
+
+    normalized = {
+        "camera": {
+            "make": to_str(exif_data.get("Make", None)),
+            "model": to_str(exif_data.get("Model", None)),
+        },
+        "lens": {
+            "make": to_str(exif_data.get("LensMake", None)),
+            "model": to_str(exif_data.get("LensModel", None)),
+            "focal_length_mm": to_float(exif_data.get("FocalLength", None)),
+            "focal_length_35mm": to_float(focal_length_35mm),
+        },
+        "exposure": {
+            "exposure_time_s": to_float(exif_data.get("ExposureTime", None)),
+            "f_number": to_float(exif_data.get("FNumber", None)),
+            "iso": iso if isinstance(iso, int) else None,
+            "exposure_bias_ev": to_float(exif_data.get("ExposureBiasValue", None)),
+            "flash": flash,
+        },
+        "gps": {
+            "latitude": to_degrees(
+                gps_data.get("GPSLatitude", None),
+                gps_data.get("GPSLatitudeRef", None),
+            ),
+            "longitude": to_degrees(
+                gps_data.get("GPSLongitude", None),
+                gps_data.get("GPSLongitudeRef", None),
+            ),
+            "altitude_m": altitude,
+        },
+        "datetime": {
+            "original": original,
+            "offset": to_str(exif_data.get("OffsetTimeOriginal", None)),
+        },
+        "dimensions": {
+            "width": width,
+            "height": height,
+            "orientation": orientation,
+        },
+    }
+
+    for group in list(normalized):
+        fields = {k: v for k, v in normalized[group].items() if v is not None}
+        if fields:
+            normalized[group] = fields
         else:
+            del normalized[group]
+    return normalized
+
+
+def get_exif_data_from_header(blob, header_reader=None):
+    """
+    Get Exif data from the blob object, downloading only the header with ranged
+    reads instead of the whole image.  Images whose container or Exif storage
+    isn't supported by the header reader fall back to a full download.
+
+    Args:
+        blob: The image blob to read the Exif data from.
+        header_reader (ExifHeaderReader, optional): The reader to use, so the
+            caller can inspect the number of bytes fetched.
+
+    Returns:
+        dict: The Exif data keyed by tag name, as returned by get_exif_data.
+    """
+
+    if "image" in blob.content_type:
+        if header_reader is None:
+            header_reader = ExifHeaderReader(blob)
+
+        try:
+            img_format, raw_exif_data = header_reader.read_exif()
+        except Exception:
+            img_format = None
+
+        if img_format is None or raw_exif_data is UNSUPPORTED_EXIF:
+            return get_exif_data(blob)
+        elif not raw_exif_data:
             return {}
+        elif img_format == "HEIF":
+            exif_data = get_named_exif_tags(*get_piexif_tags(raw_exif_data))
+            # pillow_heif applies the orientation when decoding and reports it
+            # as 1, match what get_exif_data returns for the same image.
+            if "Orientation" in exif_data:
+                exif_data["Orientation"] = 1
+            return exif_data
+        else:
+            exif = Image.Exif()
+            exif.load(raw_exif_data)
+            return get_named_exif_tags(*get_ifd_tags(exif))
 
 
 def get_photo_acquired_time(blob_name, exif_data):
@@ -159,9 +916,10 @@ def get_photo_acquired_time(blob_name, exif_data):
     """
 
     # If the exif data exists, read the field DateTimeOriginal as the timestamp.
-    # If not, then look at the filename of the photo.  If it matches a format like
-    # "20230525_192803.jpg" then that can be converted into a date.  If not then
-    # set the creation date to a default value.
+    # If not, or it is not a valid date, then look at the filename of the photo.
+    # If it matches a format like "20230525_192803.jpg" then that can be
+    # converted into a date.  If not then set the creation date to a default
+    # value.
 
     default_timestamp = datetime(1970, 1, 1, 0, 0, 0)
     if exif_data:
@@ -169,110 +927,366 @@ def get_photo_acquired_time(blob_name, exif_data):
         exif_datetime_str = exif_data.get("DateTimeOriginal", None)
         if exif_datetime_str:
             date_str = "%Y:%m:%d %H:%M:%S"
-            time_stamp = datetime.strptime(exif_datetime_str, date_str)
-            return time_stamp
-    else:
-        # Example filename: "20230525_192803.jpg"
-        res = os.path.splitext(os.path.basename(blob_name))
-        if len(res) == 2:
-            base_str = res[0]
-            pattern = r"^\d{4}(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])_(0[0-9]|1[0-9]|2[0-3])([0-5]\d){2}$"
-            if re.match(pattern, base_str):
-                date_str = "%Y%m%d_%H%M%S"
-                time_stamp = datetime.strptime(base_str, date_str)
+            try:
+                time_stamp = datetime.strptime(str(exif_datetime_str), date_str)
                 return time_stamp
+            except ValueError:
+                # Many cameras write "0000:00:00 00:00:00" when the clock is
+                # unset, fall back to the filename.
+                pass
+
+    # Example filename: "20230525_192803.jpg"
+    res = os.path.splitext(os.path.basename(blob_name))
+    if len(res) == 2:
+        base_str = res[0]
+        pattern = r"^\d{4}(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])_(0[0-9]|1[0-9]|2[0-3])([0-5]\d){2}$"
+        if re.match(pattern, base_str):
+            date_str = "%Y%m%d_%H%M%S"
+            time_stamp = datetime.strptime(base_str, date_str)
+            return time_stamp
 
     return default_timestamp
 
 
-def upsert_into_db(message, exif_data, time_stamp, webp_name):
+def get_image_doc_id(bucket_name, blob_name):
     """
-    Upserts a data record into the database.
+    Get the document id of the image record for a blob.  The id is a hash of
+    the bucket and blob names, so every ingest of a blob maps to the same
+    document.
+
+    Args:
+        bucket_name (str): The name of the bucket holding the blob.
+        blob_name (str): The name of the image blob.
+
+    Returns:
+        str: The document id.
+    """
+
+    return hashlib.sha1(f"{bucket_name}/{blob_name}".encode("utf-8")).hexdigest()
+
+
+def get_image_doc_ref(message):
+    """
+    Get a reference to the database record for the blob named in the message.
+
+    Args:
+        message (dict): A single blob message.
+
+    Returns:
+        DocumentReference: The reference to the (possibly nonexistent) record.
+    """
+
+    database_name = message.get("database_name")
+    customer_table_name = message.get("customer_table_name")
+    tl_name = message.get("top_level_collection_name")
+    user_id = message.get("user_id")
+
+    db = clients.get_firestore_client(database_name)
+    doc_id = get_image_doc_id(message.get("bucket_name"), message.get("blob_name"))
+    return (
+        db.collection(customer_table_name)
+        .document(user_id)
+        .collection(tl_name)
+        .document(doc_id)
+    )
+
+
+def get_image_record(message):
+    """
+    Get the database record for the blob named in the message.
+
+    Args:
+        message (dict): A single blob message.
+
+    Returns:
+        DocumentSnapshot: The existing record, or None if there isn't one.
+    """
+
+    snapshot = get_image_doc_ref(message).get()
+    if snapshot.exists:
+        return snapshot
+    return None
+
+
+def get_blob_fingerprint(blob):
+    """
+    Get the fields that identify the current contents of a blob.  The
+    generation changes whenever the object is overwritten.
+
+    Args:
+        blob: The image blob.
+
+    Returns:
+        dict: The generation and md5 hash of the blob.
+    """
+
+    return {"source_generation": blob.generation, "source_md5": blob.md5_hash}
+
+
+def is_unchanged(message, blob):
+    """
+    Check whether the blob has already been ingested with its current contents.
+
+    Args:
+        message (dict): A single blob message.
+        blob: The image blob.
+
+    Returns:
+        bool: True if the database record matches the blob fingerprint.
+    """
+
+    record = get_image_record(message)
+    if record is None:
+        return False
+
+    doc = record.to_dict()
+    fingerprint = get_blob_fingerprint(blob)
+    for key, value in fingerprint.items():
+        if value is None or doc.get(key, None) != value:
+            return False
+    return True
+
+
+def upsert_into_db(
+    message,
+    exif,
+    time_stamp,
+    webp_name,
+    derivatives=None,
+    fingerprint=None,
+    dhash=None,
+    raw_exif_data=None,
+):
+    """
+    Upserts a data record into the database.  The record only holds the fields
+    read by scans of the images collection, the Exif data goes into its
+    metadata sidecar document.
 
     Args:
         message (dict): A dictionary containing the necessary information
             for upserting into the database.
-        exif_data (dict): A dictionary containing the EXIF data of the image.
+        exif (dict): The normalized EXIF data of the image.
         time_stamp (datetime): The timestamp of the image acquisition.
         webp_name (str): The name of the WebP image.
+        derivatives (dict, optional): The names of all the derivative images,
+            keyed by size.
+        fingerprint (dict, optional): The generation and md5 hash of the source
+            blob, used to skip unchanged blobs on later runs.
+        dhash (str, optional): The perceptual hash of the image, used to find
+            near duplicates.
+        raw_exif_data (dict, optional): The raw EXIF tags.  Only stored if the
+            message sets "store_raw_exif" (default INGEST_STORE_RAW_EXIF),
+            otherwise the sidecar holds just the normalized tags.
 
     Returns:
         None
     """
 
-    database_name = message.get("database_name")
-    customer_table_name = message.get("customer_table_name")
-    tl_name = message.get("top_level_collection_name")
-    bucket_name = message.get("bucket_name")
-    blob_name = message.get("blob_name")
-    user_id = message.get("user_id")
+    if fingerprint is None:
+        fingerprint = {}
+
+    # The document id is derived from the bucket and blob names, so a single
+    # merge both inserts new records and updates existing ones (keeping fields
+    # such as the caption), and redelivered messages can't create duplicates.
+    doc_ref = get_image_doc_ref(message)
+    data_record = {
+        "blob_name": message.get("blob_name"),
+        "bucket_name": message.get("bucket_name"),
+        "acquisition_time": time_stamp.isoformat(),
+        "uuid": doc_ref.id,
+        "rr_img": webp_name,
+        "derivatives": derivatives,
+        "dhash": dhash,
+        **fingerprint,
+    }
+
+    # The sidecar is overwritten, so raw tags stored by earlier ingests are
+    # removed unless they are stored again.
+    metadata_record = {"exif": exif}
+    if message.get("store_raw_exif", INGEST_STORE_RAW_EXIF):
+        metadata_record["exif_data"] = raw_exif_data
+
+    # Convert any integer keys to strings.
+    data_record = json.loads(json.dumps(data_record))
+    metadata_record = json.loads(json.dumps(metadata_record))
 
-    if not firebase_admin._apps:
-        _ = firebase_admin.initialize_app()
-
-    # Check and see if the document already exists. If so, update it with
-    # the newly generated webp name.
-    db = firestore.Client(database=database_name)
-    field_filter = firestore_v1.base_query.FieldFilter("blob_name", "==", blob_name)
-    query = (
-        db.collection(f"{customer_table_name}/{user_id}/{tl_name}")
-        .where(filter=field_filter)
-        .limit(1)
+    # Remove the Exif fields that earlier ingests stored on the record.
+    data_record["exif"] = firestore.DELETE_FIELD
+    data_record["exif_data"] = firestore.DELETE_FIELD
+
+    # Write the record and its sidecar together.
+    batch = clients.get_firestore_client(message.get("database_name")).batch()
+    batch.set(doc_ref, data_record, merge=True)
+    batch.set(
+        doc_ref.collection(METADATATABLE).document(EXIF_METADATA_DOC),
+        metadata_record,
     )
+    batch.commit()
 
-    res = query.get()
-    if len(res) == 1:
-        res[0].reference.set({"rr_img": webp_name}, merge=True)
-        return
-    else:
-        # Add a new record.
-        data_record = {
-            "blob_name": blob_name,
-            "bucket_name": bucket_name,
-            "acquisition_time": time_stamp.isoformat(),
-            "exif_data": exif_data,
-            "uuid": str(uuid.uuid4()),
-            "rr_img": webp_name,
+
+def log_message(msg_dict):
+    """Log message to Cloud Logging.  Entries are queued and written in batches."""
+
+    get_log_sink("ingest").log_struct(msg_dict)
+
+
+def log_ingest_error(message, e, timings=None):
+    """Log a failure to ingest the image described by the message."""
+
+    log_message(
+        {
+            "message": "Failed to ingest image",
+            "user_id": message["user_id"],
+            "error": str(e),
+            "traceback": traceback.format_exc(),
+            "bucket_name": message["bucket_name"],
+            "blob_name": message["blob_name"],
+            "status": "error",
+            "timings": timings,
+            "peak_rss_mb": get_peak_rss_mb(),
         }
+    )
 
-        # Convert any integer keys to strings.
-        data_record = json.loads(json.dumps(data_record))
 
-        doc_ref = (
-            db.collection(customer_table_name)
-            .document(user_id)
-            .collection(tl_name)
-            .document(str(data_record["uuid"]))
-        )
-        doc_ref.set(data_record)
+def get_item_messages(message):
+    """
+    Split a message into one message per blob.
 
+    A batched message carries a list of blob names in "blob_names" instead of a
+    single "blob_name"; all the other fields are shared by every blob.
 
-def log_message(msg_dict):
-    """Log message to Cloud Logging."""
+    Args:
+        message (dict): The decoded Pub/Sub message.
+
+    Returns:
+        list: A list of single blob messages.
+    """
 
-    client = logging.Client()
-    logger = client.logger("ingest")
-    logger.log_struct(msg_dict)
+    if "blob_names" not in message:
+        return [message]
 
+    item_messages = []
+    for blob_name in message["blob_names"]:
+        item_message = {k: v for k, v in message.items() if k != "blob_names"}
+        item_message["blob_name"] = blob_name
+        item_messages.append(item_message)
+    return item_messages
 
-def ingest_object(event, context):
+
+def get_memory_budget(message):
     """
-    A function to ingest an object, decode the data, retrieve information from a storage bucket,
-    extract exif data, insert data into a database, and log messages.
-    It takes 'event' and 'context' as parameters.
+    Get the per image memory budget for a message.
+
+    Args:
+        message (dict): A single blob message, which may set "memory_budget_mb".
+
+    Returns:
+        int: The budget in bytes, or None if the budget is disabled.
     """
 
-    data = base64.b64decode(event["data"]).decode("utf-8")
-    message = json.loads(data)
+    budget_mb = message.get("memory_budget_mb", INGEST_MEMORY_BUDGET_MB)
+    if not budget_mb:
+        return None
+    return int(budget_mb) * 1024 * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process to its current size, so
+    get_peak_rss_mb() measures from here on.  Needs Linux 4.0 or later, where
+    it isn't supported the peak stays that of the whole process lifetime.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
 
+
+def get_peak_rss_mb():
+    """
+    Get the peak resident set size in MB since the last reset_peak_rss(), or
+    of the process lifetime if /proc isn't available.
+    """
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(message.get("bucket_name"))
-        blob = bucket.get_blob(message.get("blob_name"))
-        webp_name = generate_webp_image(bucket, blob)
-        exif_data = get_exif_data(blob)
-        time_stamp = get_photo_acquired_time(message["blob_name"], exif_data)
-        upsert_into_db(message, exif_data, time_stamp, webp_name)
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def ingest_blob(message, bucket):
+    """
+    Ingest a single blob, logging whether it succeeded or failed.
+
+    Args:
+        message (dict): A single blob message.
+        bucket: The storage bucket where the image is located.
+
+    Returns:
+        bool: True if the image was ingested, False otherwise.
+    """
+
+    image_ctx = None
+    timer = StageTimer()
+    try:
+        with timer.stage("get_blob"):
+            blob = bucket.get_blob(message.get("blob_name"))
+
+        # Skip the expensive stages if the blob hasn't changed since it was
+        # last ingested, unless the message asks to force a reprocess.
+        if not message.get("force", False):
+            with timer.stage("skip_check"):
+                unchanged = is_unchanged(message, blob)
+            if unchanged:
+                log_message(
+                    {
+                        "message": "Skipped unchanged image",
+                        "user_id": message["user_id"],
+                        "bucket_name": message["bucket_name"],
+                        "blob_name": message["blob_name"],
+                        "status": "skipped",
+                        "timings": timer.timings,
+                    }
+                )
+                return True
+
+        # Download and parse the original once, all stages share the result.
+        image_ctx = ImageContext(blob, get_memory_budget(message))
+        with timer.stage("download"):
+            image_ctx.download()
+        with timer.stage("exif"):
+            exif_data = get_exif_data(blob, image_ctx)
+            time_stamp = get_photo_acquired_time(message["blob_name"], exif_data)
+            size = None
+            if exif_data is not None:
+                size = image_ctx.get_image().size
+            exif = normalize_exif(exif_data, size)
+        with timer.stage("derivatives"):
+            derivatives = generate_derivatives(bucket, blob, image_ctx)
+        webp_name = None
+        if derivatives is not None:
+            webp_name = derivatives[str(WEBP_SHORT_SIDE)]
+        dhash = image_ctx.dhash
+
+        # Nothing else needs the original, release it before the database write.
+        image_ctx.close()
+        image_ctx = None
+
+        with timer.stage("upsert"):
+            upsert_into_db(
+                message,
+                exif,
+                time_stamp,
+                webp_name,
+                derivatives,
+                get_blob_fingerprint(blob),
+                dhash,
+                exif_data,
+            )
 
         log_message(
             {
@@ -281,18 +1295,81 @@ def ingest_object(event, context):
                 "bucket_name": message["bucket_name"],
                 "blob_name": message["blob_name"],
                 "status": "success",
+                "timings": timer.timings,
+                "peak_rss_mb": get_peak_rss_mb(),
             }
         )
+        return True
 
     except Exception as e:
-        log_message(
-            {
-                "message": "Failed to ingest image",
-                "user_id": message["user_id"],
-                "error": str(e),
-                "traceback": traceback.format_exc(),
-                "bucket_name": message["bucket_name"],
-                "blob_name": message["blob_name"],
-                "status": "error",
-            }
-        )
+        log_ingest_error(message, e, timer.timings)
+        return False
+
+    finally:
+        if image_ctx is not None:
+            image_ctx.close()
+
+
+def ingest_object(event, context):
+    """
+    A function to ingest an object, decode the data, retrieve information from a storage bucket,
+    extract exif data, insert data into a database, and log messages.
+    It takes 'event' and 'context' as parameters.
+
+    The message may name a single blob ("blob_name") or a batch of blobs in the
+    same bucket ("blob_names").  Blobs that are unchanged since they were last
+    ingested are skipped unless the message sets "force", and "memory_budget_mb"
+    (default INGEST_MEMORY_BUDGET_MB) caps the memory used for each image.
+    Batches are processed concurrently, with at most "max_workers" (default
+    INGEST_MAX_WORKERS) images in flight at once.
+    """
+
+    data = base64.b64decode(event["data"]).decode("utf-8")
+    message = json.loads(data)
+    try:
+        ingest_message(message)
+    finally:
+        # Write the entries of this invocation before it returns, the instance
+        # may be throttled or shut down once it has.
+        get_log_sink("ingest").flush()
+
+
+def ingest_message(message):
+    """Ingest the blob, or batch of blobs, named in a decoded message."""
+
+    item_messages = get_item_messages(message)
+
+    try:
+        storage_client = clients.get_storage_client()
+        bucket = storage_client.get_bucket(message.get("bucket_name"))
+    except Exception as e:
+        for item_message in item_messages:
+            log_ingest_error(item_message, e)
+        return
+
+    # The peak RSS logged with each image is measured from here, so it is that
+    # of the image for a single blob, and of the batch so far for a batch,
+    # whose images share the process.
+    reset_peak_rss()
+
+    if len(item_messages) == 1:
+        ingest_blob(item_messages[0], bucket)
+        return
+
+    max_workers = min(
+        message.get("max_workers", INGEST_MAX_WORKERS), len(item_messages)
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda m: ingest_blob(m, bucket), item_messages))
+
+    log_message(
+        {
+            "message": "Ingested batch",
+            "user_id": message["user_id"],
+            "bucket_name": message["bucket_name"],
+            "num_images": len(results),
+            "num_failed": results.count(False),
+            # Not "error", the failed images have their own error entries.
+            "status": "success" if all(results) else "batch_partial",
+        }
+    )
@@ -0,0 +1,66 @@
+from io import BytesIO
+
+from PIL import Image
+import pytest
+
+from main import ImageContext, decode_reduced_image, get_decode_bytes
+
+BUDGET = 4 * 1024 * 1024
+
+
+class BytesBlob(object):
+    """Just enough of a storage blob for ImageContext."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def download_as_bytes(self):
+        return self.data
+
+    def download_to_file(self, fp):
+        fp.write(self.data)
+
+
+def encode(img, fmt, **kwargs):
+    buf = BytesIO()
+    img.save(buf, fmt, **kwargs)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def src():
+    # Two flat halves, so box and Lanczos reductions agree away from the edge.
+    img = Image.new("RGB", (2400, 1500), (200, 30, 30))
+    img.paste((20, 40, 220), (0, 0, 1200, 1500))
+    return img
+
+
+def test_working_copies_are_counted():
+    rgb = get_decode_bytes((2400, 1500), "RGB", (800, 500), 3.0)
+    assert rgb > 2400 * 1500 * 4
+    assert get_decode_bytes((2400, 1500), "RGBA", (800, 500), 3.0) > rgb
+
+
+@pytest.mark.parametrize("fmt", ["BMP", "PPM", "TIFF"])
+def test_uncompressed_decoded_in_strips(src, fmt):
+    data = encode(src, fmt)
+    reduced = decode_reduced_image(ImageContext(BytesBlob(data), BUDGET), 500)
+    assert reduced.mode == "RGB"
+    assert reduced.size == (800, 500)
+    assert reduced.getpixel((100, 250)) == (20, 40, 220)
+    assert reduced.getpixel((700, 250)) == (200, 30, 30)
+
+
+def test_strips_keep_orientation(src):
+    exif = src.getexif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise.
+    data = encode(src, "TIFF", exif=exif)
+    reduced = decode_reduced_image(ImageContext(BytesBlob(data), BUDGET), 500)
+    assert reduced.size == (500, 800)
+    assert reduced.getpixel((250, 100)) == (20, 40, 220)
+
+
+def test_compressed_over_budget_is_refused(src):
+    data = encode(src, "PNG")
+    with pytest.raises(ValueError):
+        decode_reduced_image(ImageContext(BytesBlob(data), BUDGET), 500)
@@ -0,0 +1,60 @@
+import struct
+
+from exifheader import EXIF_PREFIX, UNSUPPORTED_EXIF, ExifHeaderReader
+
+TIFF = b"MM\x00\x2a\x00\x00\x00\x08\x00\x00"
+
+
+class BytesBlob(object):
+    """Just enough of a storage blob for ExifHeaderReader."""
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+
+    def download_as_bytes(self, start, end):
+        return self.data[start : end + 1]
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, payload):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def make_heif(construction_method):
+    """
+    Build a HEIF file whose Exif item (id 1) is in an mdat box, stored with
+    the given iloc construction method.
+    """
+
+    infe = full_box(b"infe", 2, struct.pack(">HH4s", 1, 0, b"Exif") + b"\x00")
+    iinf = full_box(b"iinf", 0, struct.pack(">H", 1) + infe)
+    item = struct.pack(">I", 0) + TIFF
+
+    def iloc(offset):
+        # Version 1: 4 byte offsets and lengths, no base offset or index.
+        entry = struct.pack(">HHHHII", 1, construction_method, 0, 1, offset, len(item))
+        return full_box(b"iloc", 1, bytes([0x44, 0x00]) + struct.pack(">H", 1) + entry)
+
+    ftyp = box(b"ftyp", b"heic" + b"\x00" * 4 + b"mif1heic")
+    meta_len = len(full_box(b"meta", 0, iinf + iloc(0)))
+    offset = len(ftyp) + meta_len + 8  # Just past the mdat header.
+    return ftyp + full_box(b"meta", 0, iinf + iloc(offset)) + box(b"mdat", item)
+
+
+def test_heif_exif_item_in_file():
+    reader = ExifHeaderReader(BytesBlob(make_heif(0)))
+    assert reader.read_exif() == ("HEIF", EXIF_PREFIX + TIFF)
+
+
+def test_heif_exif_item_in_idat_is_unsupported():
+    reader = ExifHeaderReader(BytesBlob(make_heif(1)))
+    assert reader.read_exif() == ("HEIF", UNSUPPORTED_EXIF)
+
+
+def test_jpeg_without_exif():
+    reader = ExifHeaderReader(BytesBlob(b"\xff\xd8\xff\xda\x00\x02"))
+    assert reader.read_exif() == ("JPEG", None)
@@ -0,0 +1,46 @@
+from io import BytesIO
+
+from PIL import Image
+import pillow_heif
+import pytest
+
+from main import ImageContext, decode_reduced_image, get_heif_thumbnail
+
+
+class BytesBlob(object):
+    """Just enough of a storage blob for ImageContext."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def download_as_bytes(self):
+        return self.data
+
+
+@pytest.fixture
+def heic_data():
+    buf = BytesIO()
+    heif_file = pillow_heif.from_pillow(Image.new("RGB", (1200, 800), (10, 200, 30)))
+    heif_file.save(buf, quality=50, thumbnails=[256, 600])
+    return buf.getvalue()
+
+
+def test_smallest_large_enough_thumbnail(heic_data):
+    assert get_heif_thumbnail(BytesIO(heic_data), (200, 150)).size == (256, 170)
+    assert get_heif_thumbnail(BytesIO(heic_data), (300, 200)).size == (600, 400)
+
+
+def test_no_thumbnail_large_enough(heic_data):
+    assert get_heif_thumbnail(BytesIO(heic_data), (700, 500)) is None
+
+
+def test_decode_reduced_uses_thumbnail(heic_data, monkeypatch):
+    # The full decode must not be needed when a thumbnail is large enough.
+    def fail_load(self):
+        raise AssertionError("decoded the full image")
+
+    image_ctx = ImageContext(BytesBlob(heic_data))
+    monkeypatch.setattr(type(image_ctx.get_image()), "load", fail_load)
+    reduced = decode_reduced_image(image_ctx, 256)
+    assert reduced.mode == "RGB"
+    assert reduced.size == (400, 266)
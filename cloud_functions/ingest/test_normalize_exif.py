@@ -0,0 +1,85 @@
+from datetime import datetime
+
+from PIL import TiffImagePlugin
+import pytest
+
+from main import cast, get_photo_acquired_time, normalize_exif, to_degrees, to_float
+
+
+@pytest.mark.parametrize("ref", [1, b"\x01", "\x01"])
+def test_altitude_below_sea_level(ref):
+    gps = {"GPSAltitude": 100.0, "GPSAltitudeRef": ref}
+    assert normalize_exif({"GPSInfo": gps})["gps"]["altitude_m"] == -100.0
+
+
+@pytest.mark.parametrize("ref", [0, b"\x00", "\x00", None])
+def test_altitude_above_sea_level(ref):
+    gps = {"GPSAltitude": (100, 1), "GPSAltitudeRef": ref}
+    assert normalize_exif({"GPSInfo": gps})["gps"]["altitude_m"] == 100.0
+
+
+def test_altitude_ref_from_pillow_jpeg():
+    # Pillow reads the ref as bytes, which cast() turns into a str.
+    gps = cast(
+        {
+            "GPSAltitude": TiffImagePlugin.IFDRational(1005, 10),
+            "GPSAltitudeRef": b"\x01",
+        }
+    )
+    assert normalize_exif({"GPSInfo": gps})["gps"]["altitude_m"] == -100.5
+
+
+def test_bad_datetime_is_dropped():
+    exif = {"Make": "Canon", "DateTimeOriginal": "0000:00:00 00:00:00"}
+    normalized = normalize_exif(exif)
+    assert "datetime" not in normalized
+    assert normalized["camera"] == {"make": "Canon"}
+
+
+def test_datetime_and_offset():
+    exif = {"DateTimeOriginal": "2023:05:25 19:28:03", "OffsetTimeOriginal": "+02:00"}
+    assert normalize_exif(exif)["datetime"] == {
+        "original": "2023-05-25T19:28:03",
+        "offset": "+02:00",
+    }
+
+
+def test_bad_datetime_falls_back_to_filename():
+    exif = {"DateTimeOriginal": "0000:00:00 00:00:00"}
+    assert get_photo_acquired_time("20230525_192803.jpg", exif) == datetime(
+        2023, 5, 25, 19, 28, 3
+    )
+    assert get_photo_acquired_time("IMG_0001.jpg", exif) == datetime(1970, 1, 1)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (TiffImagePlugin.IFDRational(1, 250), 0.004),
+        ((1, 250), 0.004),
+        ([28, 10], 2.8),
+        (2.8, 2.8),
+        ((1, 0), None),
+        (TiffImagePlugin.IFDRational(1, 0), None),
+        ("abc", None),
+        (None, None),
+    ],
+)
+def test_to_float(value, expected):
+    assert to_float(value) == expected
+
+
+def test_exposure_from_rational_pairs():
+    # piexif (HEIF) returns rationals as (numerator, denominator) pairs.
+    exif = {"ExposureTime": (1, 250), "FNumber": (28, 10), "ISOSpeedRatings": 200}
+    assert normalize_exif(exif)["exposure"] == {
+        "exposure_time_s": 0.004,
+        "f_number": 2.8,
+        "iso": 200,
+    }
+
+
+def test_degrees_from_floats_and_flattened_pairs():
+    assert to_degrees((33.0, 52.0, 0.0), "S") == -33.8666667
+    assert to_degrees((151, 1, 12, 1, 36, 1), "E") == 151.21
+    assert to_degrees((1, 2), "N") is None
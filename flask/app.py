@@ -194,9 +194,10 @@ def get_captions():
     factory = visionmodel.VisionModelFactory()
     model = factory.create(model_str=session['caption_engine'], device='gpu')
     
-    for photo in session['selected_photos']:
-            caption = model.predict([photo['baseUrl']])
-            photo['caption'] = format_caption(caption[0])
+    # Caption all the selected photos in one call, so the model can batch them.
+    captions = model.predict([photo['baseUrl'] for photo in session['selected_photos']])
+    for photo, caption in zip(session['selected_photos'], captions):
+        photo['caption'] = format_caption(caption)
 
     return render_template('photos_with_captions.html', photos=session['selected_photos'])
 
@@ -0,0 +1,163 @@
+from PIL import Image
+import torch
+from transformers import AutoTokenizer, VisionEncoderDecoderModel, ViTImageProcessor
+from transformers.pytorch_utils import Conv1D
+
+DEFAULT_CAPTION_MODEL = "nlpconnect/vit-gpt2-image-captioning"
+
+# How the model is run on the CPU: "int8" quantizes the linear layers of the
+# PyTorch model, including the Conv1D projections of GPT-2, to int8 as it
+# loads, "onnx" exports it to ONNX Runtime, "fp32" runs it unchanged.
+CAPTION_BACKENDS = ["int8", "onnx", "fp32"]
+
+
+def conv1d_to_linear(module):
+    """
+    Replace the Conv1D layers of a module, which GPT-2 uses for its attention
+    and MLP projections, with the equivalent nn.Linear layers so dynamic
+    quantization picks them up.  Conv1D stores its weight as (in, out).
+    """
+
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+
+class LocalCaptionModel(object):
+    """
+    A class that captions images on the CPU with a VisionEncoderDecoder model,
+    revived from the deprecated HuggingfaceVisionModel for bulk backfills.
+    """
+
+    def __init__(
+        self,
+        model_str=DEFAULT_CAPTION_MODEL,
+        backend="int8",
+        num_threads=None,
+        num_beams=2,
+        max_length=32,
+    ):
+        """
+        Load the model for the backend.
+
+        Args:
+            model_str (str): The Hugging Face model to load.
+            backend (str): One of CAPTION_BACKENDS.
+            num_threads (int, optional): Number of CPU threads used for
+                inference, defaults to the torch / ONNX Runtime default.
+            num_beams (int): The beam width, 1 for greedy decoding.
+            max_length (int): The maximum caption length in tokens.
+        """
+
+        if backend not in CAPTION_BACKENDS:
+            raise ValueError(f"Unknown caption backend: {backend}")
+
+        self.model_str = model_str
+        self.backend = backend
+        self.num_threads = num_threads
+        self.num_beams = num_beams
+        self.max_length = max_length
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.feature_extractor = ViTImageProcessor.from_pretrained(model_str)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_str)
+
+        if backend == "onnx":
+            # Only needed for this backend.
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForVision2Seq
+
+            session_options = onnxruntime.SessionOptions()
+            if num_threads:
+                session_options.intra_op_num_threads = num_threads
+            self.model = ORTModelForVision2Seq.from_pretrained(
+                model_str, export=True, session_options=session_options
+            )
+        else:
+            model = VisionEncoderDecoderModel.from_pretrained(model_str)
+            model.eval()
+            if backend == "int8":
+                # Dynamic quantization: int8 weights, activations quantized on
+                # the fly.  quantize_dynamic only handles nn.Linear, which
+                # covers the ViT encoder and the lm_head, so the Conv1D
+                # projections of the GPT-2 decoder are converted first.
+                model = conv1d_to_linear(model)
+                model = torch.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            self.model = model
+
+    def predict(self, images, num_beams=None, max_length=None, return_scores=False):
+        """
+        Predict captions for a list of images.
+
+        Args:
+            images (list): A list of PIL.Image objects.
+            num_beams (int, optional): Overrides the beam width of the model.
+            max_length (int, optional): Overrides the maximum caption length.
+            return_scores (bool): Also return the confidence of each caption,
+                the geometric mean of its token probabilities (0 to 1).
+
+        Returns:
+            list: The predicted captions, in the order of the images, or
+                (caption, confidence) tuples if return_scores is set.
+        """
+
+        for image in images:
+            if not isinstance(image, Image.Image):
+                raise ValueError("All images must be of type PIL.Image")
+        images = [img if img.mode == "RGB" else img.convert("RGB") for img in images]
+
+        pixel_values = self.feature_extractor(
+            images=images, return_tensors="pt"
+        ).pixel_values
+
+        num_beams = num_beams or self.num_beams
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                pixel_values,
+                num_beams=num_beams,
+                max_length=max_length or self.max_length,
+                output_scores=return_scores,
+                return_dict_in_generate=True,
+            )
+        captions = self.tokenizer.batch_decode(
+            outputs.sequences, skip_special_tokens=True
+        )
+        captions = [caption.strip() for caption in captions]
+
+        if not return_scores:
+            return captions
+        return list(zip(captions, self._get_confidences(outputs, num_beams)))
+
+    def _get_confidences(self, outputs, num_beams):
+        """Return the geometric mean token probability of each generated caption."""
+
+        with torch.inference_mode():
+            # Log probabilities of the chosen tokens.  Greedy decoding keeps the
+            # raw logits, beam search has already normalized them.
+            token_scores = self.model.compute_transition_scores(
+                outputs.sequences,
+                outputs.scores,
+                getattr(outputs, "beam_indices", None),
+                normalize_logits=(num_beams == 1),
+            )
+            # Skip the decoder start token, and the padding after each caption.
+            tokens = outputs.sequences[:, -token_scores.shape[1] :]
+            mask = torch.ones_like(tokens, dtype=torch.bool)
+            for token_id in (self.tokenizer.pad_token_id, self.tokenizer.eos_token_id):
+                if token_id is not None:
+                    mask &= tokens != token_id
+            mean_scores = (token_scores * mask).sum(dim=1) / mask.sum(dim=1).clamp(
+                min=1
+            )
+        return [round(score, 4) for score in torch.exp(mean_scores).tolist()]
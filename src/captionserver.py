@@ -0,0 +1,279 @@
+import argparse
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from io import BytesIO
+import queue
+import statistics
+import threading
+import time
+
+from flask import Flask, jsonify, request
+from PIL import Image, ImageOps
+import requests
+
+from captionmodel import CAPTION_BACKENDS, DEFAULT_CAPTION_MODEL, LocalCaptionModel
+
+# Number of recent requests and batches the latency metrics are computed over.
+METRICS_WINDOW = 1000
+
+
+class MicroBatcher(object):
+    """
+    A class that queues caption requests and runs them through the model in
+    micro-batches.  A batch is started as soon as max_batch_size requests are
+    waiting, or max_wait_ms after the oldest one arrived, whichever is first.
+    Requests whose Future was cancelled while they waited are dropped.
+    """
+
+    def __init__(self, predict, max_batch_size=8, max_wait_ms=20):
+        """
+        Initialize the MicroBatcher object and start the worker thread.
+
+        Args:
+            predict (callable): Captions a list of images, e.g.
+                LocalCaptionModel.predict.
+            max_batch_size (int): The largest batch run through the model.
+            max_wait_ms (float): The longest a request waits for a batch to fill.
+        """
+
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.num_cancelled = 0
+        self.queue_ms = []
+        self.batch_ms = []
+        self.batch_sizes = []
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """Queue an image, returning a Future that resolves to its caption."""
+        future = Future()
+        self.queue.put((image, future, time.monotonic()))
+        return future
+
+    def caption(self, image, timeout=None):
+        """
+        Caption an image, waiting for its batch to run.  If it times out while
+        still queued, the request is cancelled so the model never runs it.
+
+        Raises:
+            concurrent.futures.TimeoutError: If there is no caption in time.
+        """
+        future = self.submit(image)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def get_metrics(self):
+        """Return the throughput, batch size and queue latency metrics."""
+
+        def percentiles(values):
+            if not values:
+                return None
+            values = sorted(values)
+            return {
+                "p50": round(values[len(values) // 2], 2),
+                "p95": round(values[int(len(values) * 0.95)], 2),
+                "max": round(values[-1], 2),
+            }
+
+        with self.lock:
+            uptime = time.monotonic() - self.start_time
+            return {
+                "uptime_s": round(uptime, 1),
+                "num_requests": self.num_requests,
+                "num_batches": self.num_batches,
+                "num_errors": self.num_errors,
+                "num_cancelled": self.num_cancelled,
+                "queue_depth": self.queue.qsize(),
+                "captions_per_sec": round(self.num_requests / max(uptime, 1e-9), 2),
+                "mean_batch_size": (
+                    round(statistics.mean(self.batch_sizes), 2)
+                    if self.batch_sizes
+                    else None
+                ),
+                "queue_ms": percentiles(self.queue_ms),
+                "batch_ms": percentiles(self.batch_ms),
+            }
+
+    def _next_batch(self):
+        """Block until a request arrives, then collect a batch around it."""
+
+        batch = [self.queue.get()]
+        deadline = batch[0][2] + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        # Take whatever else is already waiting, up to the batch size.
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """Run batches through the model for as long as the process lives."""
+
+        while True:
+            batch = self._next_batch()
+
+            # Drop the requests whose caller has given up, the rest can no
+            # longer be cancelled.
+            num_queued = len(batch)
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if len(batch) < num_queued:
+                with self.lock:
+                    self.num_cancelled += num_queued - len(batch)
+            if not batch:
+                continue
+
+            start = time.monotonic()
+            try:
+                captions = self.predict([image for image, _, _ in batch])
+                error = None
+            except Exception as e:
+                error = e
+            batch_ms = (time.monotonic() - start) * 1000
+
+            for idx, (_, future, queued) in enumerate(batch):
+                if error is None:
+                    future.set_result(captions[idx])
+                else:
+                    future.set_exception(error)
+
+            with self.lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.num_errors += len(batch) if error is not None else 0
+                self.queue_ms += [(start - queued) * 1000 for _, _, queued in batch]
+                self.batch_ms.append(batch_ms)
+                self.batch_sizes.append(len(batch))
+                del self.queue_ms[:-METRICS_WINDOW]
+                del self.batch_ms[:-METRICS_WINDOW]
+                del self.batch_sizes[:-METRICS_WINDOW]
+
+
+def load_request_image():
+    """
+    Load the image of a caption request, either an uploaded "image" file or a
+    JSON body with the "url" of the image.
+    """
+
+    if "image" in request.files:
+        img = Image.open(request.files["image"].stream)
+    else:
+        response = requests.get(request.get_json()["url"], timeout=30)
+        response.raise_for_status()
+        img = Image.open(BytesIO(response.content))
+    return ImageOps.exif_transpose(img).convert("RGB")
+
+
+def create_app(batcher, timeout=60):
+    """
+    Create the caption server.  Flask's threaded server handles each request
+    on its own thread, so concurrent requests end up in the same batch.
+
+    Args:
+        batcher (MicroBatcher): The batcher that runs the model.
+        timeout (float): Seconds a request may wait for its caption.
+
+    Returns:
+        Flask: The app.
+    """
+
+    app = Flask(__name__)
+
+    @app.route("/caption", methods=["POST"])
+    def caption():
+        try:
+            img = load_request_image()
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            return jsonify({"caption": batcher.caption(img, timeout)})
+        except FutureTimeoutError:
+            return jsonify({"error": f"No caption within {timeout} s"}), 504
+        except Exception as e:
+            return jsonify({"error": f"Captioning failed: {e}"}), 500
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return jsonify(batcher.get_metrics())
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model",
+        required=False,
+        type=str,
+        default=DEFAULT_CAPTION_MODEL,
+        help="Hugging Face model to load",
+    )
+    parser.add_argument(
+        "--backend",
+        required=False,
+        type=str,
+        default="int8",
+        choices=CAPTION_BACKENDS,
+        help="how the model is run on the CPU",
+    )
+    parser.add_argument(
+        "--threads",
+        required=False,
+        type=int,
+        default=None,
+        help="number of CPU threads used for inference",
+    )
+    parser.add_argument(
+        "--beams",
+        required=False,
+        type=int,
+        default=2,
+        help="beam width, 1 for greedy decoding",
+    )
+    parser.add_argument(
+        "--maxbatch",
+        required=False,
+        type=int,
+        default=8,
+        help="largest number of images captioned in one batch",
+    )
+    parser.add_argument(
+        "--maxwaitms",
+        required=False,
+        type=float,
+        default=20,
+        help="longest a request waits for its batch to fill, in ms",
+    )
+    parser.add_argument(
+        "--port",
+        required=False,
+        type=int,
+        default=8080,
+        help="port to serve on",
+    )
+
+    args = parser.parse_args()
+    model = LocalCaptionModel(args.model, args.backend, args.threads, args.beams)
+    batcher = MicroBatcher(model.predict, args.maxbatch, args.maxwaitms)
+    create_app(batcher).run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,258 @@
+import datetime
+import time
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import logging
+
+MONITORING_URL = "https://monitoring.googleapis.com/v3/projects/{}/timeSeries"
+
+# Defaults for the "dispatcher" section of the config file.
+DISPATCHER_DEFAULTS = {
+    "initial_rate": 1.0,
+    "min_rate": 0.1,
+    "max_rate": 50.0,
+    "increase": 1.0,
+    "decrease": 0.5,
+    "interval_s": 30.0,
+    "max_backlog": 200,
+    "max_errors_per_min": 20,
+}
+
+
+class BacklogSignal(object):
+    """
+    A class that reports congestion when the number of undelivered messages on
+    a Pub/Sub subscription, i.e. the work waiting for a free function instance,
+    is above max_backlog.
+    """
+
+    def __init__(self, project_id, subscription_name, max_backlog):
+        """Initialize the BacklogSignal object."""
+        self.name = "backlog"
+        self.project_id = project_id
+        self.subscription_name = subscription_name
+        self.max_backlog = max_backlog
+        credentials, _ = google.auth.default(
+            scopes=["https://www.googleapis.com/auth/monitoring.read"]
+        )
+        self.session = AuthorizedSession(credentials)
+
+    def read(self):
+        """Return the latest number of undelivered messages, or None if unknown."""
+
+        # The metric is sampled once a minute, so look back a few minutes.
+        end = datetime.datetime.now(datetime.timezone.utc)
+        start = end - datetime.timedelta(minutes=5)
+        response = self.session.get(
+            MONITORING_URL.format(self.project_id),
+            params={
+                "filter": (
+                    'metric.type="pubsub.googleapis.com/subscription/num_undelivered_messages" '
+                    f'AND resource.labels.subscription_id="{self.subscription_name}"'
+                ),
+                "interval.startTime": start.isoformat(),
+                "interval.endTime": end.isoformat(),
+            },
+            timeout=30,
+        )
+        response.raise_for_status()
+        for series in response.json().get("timeSeries", []):
+            # Points are returned newest first.
+            return int(series["points"][0]["value"]["int64Value"])
+        return None
+
+    def is_congested(self):
+        """Return whether the backlog is too long, or None if unknown."""
+        backlog = self.read()
+        return None if backlog is None else backlog > self.max_backlog
+
+
+class ErrorLogSignal(object):
+    """
+    A class that reports congestion when a cloud function logs more than
+    max_per_min failures a minute.  extra_filter narrows the failures counted,
+    e.g. to rate limit errors.
+    """
+
+    def __init__(
+        self, name, project_id, logger_name, max_per_min, window_s, extra_filter=None
+    ):
+        """Initialize the ErrorLogSignal object."""
+        self.name = name
+        self.project_id = project_id
+        self.logger_name = logger_name
+        self.max_per_min = max_per_min
+        self.window_s = window_s
+        self.extra_filter = extra_filter
+        self.client = logging.Client(project=project_id)
+
+    def read(self):
+        """Return the number of failures logged in the last window."""
+
+        start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=self.window_s
+        )
+        # Only the per image entries carry a traceback, not the batch summaries.
+        log_filter = (
+            f'logName="projects/{self.project_id}/logs/{self.logger_name}" '
+            'AND jsonPayload.status="error" AND jsonPayload.traceback:* '
+            f'AND timestamp>="{start.isoformat()}"'
+        )
+        if self.extra_filter:
+            log_filter += f" AND {self.extra_filter}"
+        return sum(1 for _ in self.client.list_entries(filter_=log_filter))
+
+    def is_congested(self):
+        """Return whether there are too many failures."""
+        return self.read() > self.max_per_min * self.window_s / 60
+
+
+class AdaptiveDispatcher(object):
+    """
+    A class that paces the messages of a backfill with a token bucket whose
+    rate (messages/sec) is set by an AIMD controller.  Every interval_s seconds
+    the signals are read: if any reports congestion the rate is multiplied by
+    decrease, otherwise it grows by increase, between min_rate and max_rate.
+    A signal that can't be read holds the rate where it is.
+    """
+
+    def __init__(
+        self,
+        signals,
+        initial_rate=DISPATCHER_DEFAULTS["initial_rate"],
+        min_rate=DISPATCHER_DEFAULTS["min_rate"],
+        max_rate=DISPATCHER_DEFAULTS["max_rate"],
+        increase=DISPATCHER_DEFAULTS["increase"],
+        decrease=DISPATCHER_DEFAULTS["decrease"],
+        interval_s=DISPATCHER_DEFAULTS["interval_s"],
+    ):
+        """Initialize the AdaptiveDispatcher object."""
+        self.signals = signals
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.interval_s = interval_s
+
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.last_update = self.last_refill
+        self.num_dispatched = 0
+        self.num_since_update = 0
+
+    @classmethod
+    def from_config(cls, config, function_name):
+        """
+        Create a dispatcher for the backfill of a cloud function from the
+        "dispatcher" section of the config file.
+
+        Args:
+            config (dict): The loaded config file.
+            function_name (str): The function key, e.g. "caption_function".
+
+        Returns:
+            AdaptiveDispatcher: The dispatcher.
+        """
+
+        settings = dict(DISPATCHER_DEFAULTS, **config.get("dispatcher", {}))
+        function = config["functions"][function_name]
+        project_id = config["project_id"]
+
+        # The cloud function logs to "caption" or "ingest", and its trigger
+        # subscription is created by Cloud Functions with this name.
+        logger_name = function_name.replace("_function", "")
+        subscription_name = settings.get(
+            f"{logger_name}_subscription",
+            f'gcf-{function_name}-{function["location"]}-{function["trigger_topic"]}',
+        )
+
+        signals = [
+            BacklogSignal(project_id, subscription_name, settings["max_backlog"]),
+            ErrorLogSignal(
+                "errors",
+                project_id,
+                logger_name,
+                settings["max_errors_per_min"],
+                settings["interval_s"],
+            ),
+        ]
+        if function_name == "caption_function":
+            # Any rate limiting by the captioning API means back off.
+            signals.append(
+                ErrorLogSignal(
+                    "rate_limited",
+                    project_id,
+                    logger_name,
+                    0,
+                    settings["interval_s"],
+                    "jsonPayload.status_code=429",
+                )
+            )
+        return cls(
+            signals,
+            settings["initial_rate"],
+            settings["min_rate"],
+            settings["max_rate"],
+            settings["increase"],
+            settings["decrease"],
+            settings["interval_s"],
+        )
+
+    def acquire(self):
+        """Block until the next message may be sent."""
+
+        self._update()
+        self._refill()
+        if self.tokens < 1.0:
+            time.sleep((1.0 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1.0
+        self.num_dispatched += 1
+        self.num_since_update += 1
+
+    def _refill(self):
+        """Add the tokens earned since the last refill, allowing a one second burst."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.tokens + (now - self.last_refill) * self.rate, max(self.rate, 1.0)
+        )
+        self.last_refill = now
+
+    def _update(self):
+        """Adjust the rate from the signals once per interval."""
+
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        if elapsed < self.interval_s:
+            return
+
+        congested = []
+        unknown = []
+        for signal in self.signals:
+            try:
+                state = signal.is_congested()
+            except Exception as e:
+                print(f"Failed to read the {signal.name} signal: {e}")
+                state = None
+            if state is None:
+                unknown.append(signal.name)
+            elif state:
+                congested.append(signal.name)
+
+        old_rate = self.rate
+        if congested:
+            self.rate = max(self.rate * self.decrease, self.min_rate)
+        elif not unknown and self.num_since_update >= 0.5 * old_rate * elapsed:
+            # Only speed up when the current rate is actually being used.
+            self.rate = min(self.rate + self.increase, self.max_rate)
+
+        print(
+            f"\n\nDispatched {self.num_dispatched} messages, rate "
+            f"{old_rate:.2f} -> {self.rate:.2f} messages/sec"
+            + (f", congested: {', '.join(congested)}" if congested else "")
+            + (f", unknown: {', '.join(unknown)}" if unknown else "")
+        )
+        self.last_update = now
+        self.num_since_update = 0
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import json
 import uuid
 import yaml
@@ -16,6 +17,33 @@ from google.cloud import storage
 CUSTOMERTABLE = "customers"
 IMAGESTABLE = "images"
 
+# Firestore allows at most 500 writes in a single batch.
+MAX_BATCH_WRITES = 500
+
+# The bulky, rarely read metadata of an image lives in a sidecar document at
+# {image record}/metadata/exif, written by the ingest cloud function.
+METADATATABLE = "metadata"
+EXIF_METADATA_DOC = "exif"
+
+# The fields of an image record needed by most readers.  Scans should select
+# only these rather than streaming the whole record.
+IMAGE_SUMMARY_FIELDS = [
+    "acquisition_time",
+    "blob_name",
+    "bucket_name",
+    "caption",
+    "rr_img",
+    "uuid",
+]
+
+
+def get_image_doc_id(bucket_name, blob_name):
+    """
+    Return the document id of the image record for a blob.  This must match
+    get_image_doc_id in the ingest cloud function.
+    """
+    return hashlib.sha1(f"{bucket_name}/{blob_name}".encode("utf-8")).hexdigest()
+
 
 class PubSubHelper(object):
     """A class to represent a PubSub object."""
@@ -79,8 +107,11 @@ class GCStoragehelper(object):
 class DatabaseHelper(object):
     """A class to represent a database."""
 
-    def __init__(self, config_file, test_mode=False):
-        """Initialize the Database object."""
+    def __init__(self, config_file, test_mode=False, database_name=None):
+        """
+        Initialize the Database object.  database_name, if given, overrides the
+        database picked by test_mode.
+        """
         self.config_file = config_file
         self.config = self.load_config()
 
@@ -89,7 +120,9 @@ class DatabaseHelper(object):
         if not firebase_admin._apps:
             _ = firebase_admin.initialize_app(creds)
 
-        if test_mode:
+        if database_name:
+            self.db = firestore.Client(database=database_name)
+        elif test_mode:
             self.db = firestore.Client(database=self.config["firestore"]["testdb_name"])
         else:
             self.db = firestore.Client(database=self.config["firestore"]["database_name"])
@@ -121,6 +154,25 @@ class DatabaseHelper(object):
         doc_ref = self.db.collection(CUSTOMERTABLE).document(str(customer.uuid))
         doc_ref.set(customer.to_dict())
 
+    def get_image_metadata(self, customer_uuid, image_id, name=EXIF_METADATA_DOC):
+        """
+        Load the metadata sidecar of an image record on demand.  Returns a dict
+        with the normalized ("exif") and, if it was stored, raw ("exif_data")
+        Exif data, or None if the image has no sidecar.
+        """
+        doc = (
+            self.db.collection(CUSTOMERTABLE)
+            .document(customer_uuid)
+            .collection(IMAGESTABLE)
+            .document(image_id)
+            .collection(METADATATABLE)
+            .document(name)
+            .get()
+        )
+        if not doc.exists:
+            return None
+        return doc.to_dict()
+
     def get_db(self):
         """Return the database object."""
         return self.db
@@ -0,0 +1,217 @@
+import json
+import os
+
+import hnswlib
+import numpy as np
+from sentence_transformers import SentenceTransformer
+import torch
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+INDEX_FILE = "index.bin"
+EMBEDDINGS_FILE = "embeddings.npy"
+RECORDS_FILE = "records.json"
+
+
+class CaptionEmbedder(object):
+    """A class that computes normalized sentence embeddings of captions on the CPU."""
+
+    def __init__(
+        self, model_str=DEFAULT_EMBEDDING_MODEL, num_threads=None, batch_size=64
+    ):
+        """
+        Load the embedding model.
+
+        Args:
+            model_str (str): The sentence-transformers model to load.
+            num_threads (int, optional): Number of CPU threads used for
+                inference, defaults to the torch default.
+            batch_size (int): Number of captions embedded per forward pass.
+        """
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model_str = model_str
+        self.model = SentenceTransformer(model_str, device="cpu")
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        """
+        Embed a list of texts.
+
+        Returns:
+            numpy.ndarray: The unit length embeddings, one float16 row per text.
+        """
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+        return embeddings.astype(np.float16)
+
+
+class SemanticIndex(object):
+    """
+    A class that holds the HNSW index of the caption embeddings of a customer,
+    persisted in its own directory.  Alongside the index are the embeddings as
+    float16 (so the index can be rebuilt without re-embedding) and the caption
+    and summary fields of each record, so search results need no database read.
+    """
+
+    def __init__(self, index_dir, dim, m=16, ef_construction=200, ef_search=64):
+        """
+        Initialize the SemanticIndex object, loading the index if it exists.
+
+        Args:
+            index_dir (str): The directory of the customer's index.
+            dim (int): The dimension of the embeddings.
+            m (int): Number of links per HNSW node.
+            ef_construction (int): Candidate list size while building.
+            ef_search (int): Candidate list size while searching, at least k.
+        """
+
+        self.index_dir = index_dir
+        self.dim = dim
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+
+        # One label per image, the row of its embedding, and its record.
+        self.labels = {}
+        self.records = []
+        self.embeddings = np.zeros((0, dim), dtype=np.float16)
+        self.index = hnswlib.Index(space="cosine", dim=dim)
+
+        if os.path.exists(os.path.join(index_dir, INDEX_FILE)):
+            self.load()
+        else:
+            self.index.init_index(
+                max_elements=1024, ef_construction=ef_construction, M=m
+            )
+        self.index.set_ef(ef_search)
+
+    def load(self):
+        """Load the index, embeddings and records from the index directory."""
+        with open(os.path.join(self.index_dir, RECORDS_FILE), "r") as f:
+            data = json.load(f)
+        self.labels = data["labels"]
+        self.records = data["records"]
+        self.embeddings = np.load(os.path.join(self.index_dir, EMBEDDINGS_FILE))
+        self.index.load_index(
+            os.path.join(self.index_dir, INDEX_FILE),
+            max_elements=max(len(self.records), 1024),
+        )
+
+    def save(self):
+        """Save the index, embeddings and records to the index directory."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.index.save_index(os.path.join(self.index_dir, INDEX_FILE))
+        np.save(os.path.join(self.index_dir, EMBEDDINGS_FILE), self.embeddings)
+        with open(os.path.join(self.index_dir, RECORDS_FILE), "w") as f:
+            json.dump({"labels": self.labels, "records": self.records}, f, default=str)
+
+    def update(self, records, embedder):
+        """
+        Bring the index up to date with the captioned records of the customer.
+        Only new and re-captioned images are embedded; images that are gone or
+        have lost their caption are removed from the results.
+
+        Args:
+            records (dict): The summary record of each captioned image, by id.
+            embedder (CaptionEmbedder): Embeds the new captions.
+
+        Returns:
+            tuple: The number of images added or updated, and removed.
+        """
+
+        changed = [
+            image_id
+            for image_id, rec in records.items()
+            if image_id not in self.labels
+            or self.records[self.labels[image_id]] is None
+            or self.records[self.labels[image_id]]["caption"] != rec["caption"]
+        ]
+        removed = [
+            image_id
+            for image_id, label in self.labels.items()
+            if image_id not in records and self.records[label] is not None
+        ]
+
+        for image_id in removed:
+            label = self.labels[image_id]
+            self.index.mark_deleted(label)
+            self.records[label] = None
+
+        if changed:
+            embeddings = embedder.embed([records[i]["caption"] for i in changed])
+            labels = []
+            for image_id in changed:
+                if image_id not in self.labels:
+                    self.labels[image_id] = len(self.records)
+                    self.records.append(None)
+                elif self.records[self.labels[image_id]] is None:
+                    # Removed by an earlier update, and captioned again.
+                    self.index.unmark_deleted(self.labels[image_id])
+                label = self.labels[image_id]
+                self.records[label] = dict(records[image_id], image_id=image_id)
+                labels.append(label)
+
+            self.embeddings = np.concatenate(
+                [
+                    self.embeddings,
+                    np.zeros(
+                        (len(self.records) - len(self.embeddings), self.dim),
+                        dtype=np.float16,
+                    ),
+                ]
+            )
+            self.embeddings[labels] = embeddings
+
+            if len(self.records) > self.index.get_max_elements():
+                self.index.resize_index(2 * len(self.records))
+            # Re-adding an existing label replaces its vector.
+            self.index.add_items(embeddings.astype(np.float32), labels)
+
+        return len(changed), len(removed)
+
+    def search(self, query, embedder, k=10):
+        """
+        Find the images whose captions best match the query.
+
+        Args:
+            query (str): The search text.
+            embedder (CaptionEmbedder): Embeds the query.
+            k (int): The number of results.
+
+        Returns:
+            list: The (record, similarity) of the top k images, best first.
+        """
+
+        num_images = sum(1 for rec in self.records if rec is not None)
+        k = min(k, num_images)
+        if k == 0:
+            return []
+
+        embedding = embedder.embed([query]).astype(np.float32)
+        ef = max(self.ef_search, k)
+        while True:
+            self.index.set_ef(ef)
+            try:
+                labels, distances = self.index.knn_query(embedding, k=k)
+                break
+            except RuntimeError:
+                # The search skips deleted images, so it can run out of
+                # candidates before it has k live ones.  Widen it, and settle
+                # for fewer results once it already covers the whole index.
+                if ef < self.index.get_current_count():
+                    ef *= 2
+                elif k > 1:
+                    k //= 2
+                else:
+                    return []
+        return [
+            (self.records[label], round(1.0 - float(distance), 4))
+            for label, distance in zip(labels[0], distances[0])
+        ]
@@ -0,0 +1,357 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../src")
+sys.path.insert(0, "../cloud_functions/caption")
+import time
+import yaml
+
+from openai import OpenAI
+from tqdm import tqdm
+
+from captionimage import CAPTION_DETAIL, get_caption_payload, load_caption_image
+from generate_captions import IMAGE_FIELDS, get_uncaptioned_docs, use_config_credentials
+import photosapp
+
+BATCH_URL = "/v1/chat/completions"
+
+# The batch API accepts at most 50,000 requests and 200 MB in a request file.
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+# Number of images loaded and encoded concurrently while exporting.
+EXPORT_CHUNK_SIZE = 256
+
+MANIFEST_FILE = "manifest.json"
+
+# Batch states after which there is nothing more to wait for.
+FINAL_STATES = ["completed", "failed", "expired", "cancelled"]
+
+
+def load_manifest(outdir):
+    """Load the manifest of the request files in outdir."""
+    with open(outdir / MANIFEST_FILE, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(outdir, manifest):
+    """Save the manifest of the request files in outdir."""
+    with open(outdir / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def get_request_line(doc, detail):
+    """
+    Get the batch request line of a document, or None if its image can't be
+    loaded.  The document path is the custom_id the result is matched by.
+    """
+
+    document_path, rec = doc
+    try:
+        img = load_caption_image(rec, detail)
+    except Exception as e:
+        print(e)
+        print(rec.get("bucket_name"), rec.get("blob_name"))
+        return None
+    request = {
+        "custom_id": document_path,
+        "method": "POST",
+        "url": BATCH_URL,
+        "body": get_caption_payload(img, detail),
+    }
+    return json.dumps(request) + "\n"
+
+
+def export_requests(docs, outdir, database_name, detail=CAPTION_DETAIL):
+    """
+    Write the caption requests of the documents to JSONL request files of
+    reduced images, in the format of the OpenAI Batch API.
+
+    Parameters:
+    - docs: list, the (document path, record) of each document to caption
+    - outdir: Path, the directory to write the request files and manifest to
+    - database_name: str, the database the captions are written back to
+    - detail: str, optional, the API detail level (default is CAPTION_DETAIL)
+
+    Returns:
+    dict: the manifest
+    """
+
+    outdir.mkdir(parents=True, exist_ok=True)
+    manifest = {"database_name": database_name, "detail": detail, "files": []}
+
+    f = None
+    num_failed = 0
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for idx in tqdm(range(0, len(docs), EXPORT_CHUNK_SIZE)):
+            chunk = docs[idx : idx + EXPORT_CHUNK_SIZE]
+            for line in executor.map(lambda doc: get_request_line(doc, detail), chunk):
+                if line is None:
+                    num_failed += 1
+                    continue
+
+                entry = manifest["files"][-1] if manifest["files"] else None
+                if (
+                    entry is None
+                    or entry["num_requests"] >= MAX_REQUESTS_PER_FILE
+                    or entry["num_bytes"] + len(line) > MAX_BYTES_PER_FILE
+                ):
+                    if f is not None:
+                        f.close()
+                    entry = {
+                        "requests": f'requests_{len(manifest["files"]):04d}.jsonl',
+                        "num_requests": 0,
+                        "num_bytes": 0,
+                    }
+                    manifest["files"].append(entry)
+                    f = open(outdir / entry["requests"], "w")
+
+                f.write(line)
+                entry["num_requests"] += 1
+                entry["num_bytes"] += len(line)
+    if f is not None:
+        f.close()
+
+    save_manifest(outdir, manifest)
+    print(
+        f'\n\nExported {sum(e["num_requests"] for e in manifest["files"])} requests '
+        f'to {len(manifest["files"])} files, {num_failed} images failed to load.'
+    )
+    return manifest
+
+
+class OpenAIBatchEndpoint(object):
+    """A class that runs request files through the OpenAI Batch API."""
+
+    def __init__(self):
+        """Initialize the OpenAIBatchEndpoint object."""
+        self.client = OpenAI()
+
+    def submit(self, request_file):
+        """Upload a request file and start its batch, returning the batch id."""
+        with open(request_file, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_URL,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def get_status(self, batch_id):
+        """Return the state of a batch, e.g. "in_progress" or "completed"."""
+        return self.client.batches.retrieve(batch_id).status
+
+    def download_results(self, batch_id, result_file):
+        """Download the result file of a completed batch."""
+        batch = self.client.batches.retrieve(batch_id)
+        self.client.files.content(batch.output_file_id).write_to_file(result_file)
+
+
+class MockBatchEndpoint(object):
+    """
+    A class that completes every batch immediately with a made up caption, so
+    the batch mode can be run end to end offline.
+    """
+
+    def submit(self, request_file):
+        """Start a batch, the batch id is the path of the request file."""
+        return str(request_file)
+
+    def get_status(self, batch_id):
+        """Return the state of a batch, mock batches complete at once."""
+        return "completed"
+
+    def download_results(self, batch_id, result_file):
+        """Write a result line for every request of the batch."""
+        with open(batch_id, "r") as fin, open(result_file, "w") as fout:
+            for line in fin:
+                request = json.loads(line)
+                result = {
+                    "id": f'mock_{request["custom_id"]}',
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [
+                                {
+                                    "message": {
+                                        "content": f'Mock caption of {request["custom_id"]}'
+                                    }
+                                }
+                            ]
+                        },
+                    },
+                    "error": None,
+                }
+                fout.write(json.dumps(result) + "\n")
+
+
+BATCH_ENDPOINTS = {"openai": OpenAIBatchEndpoint, "mock": MockBatchEndpoint}
+
+
+def submit_requests(outdir, endpoint, wait=False, poll_s=60):
+    """
+    Submit the request files that have not been submitted yet, optionally
+    waiting until every batch has finished.
+
+    Parameters:
+    - outdir: Path, the directory holding the request files and manifest
+    - endpoint: the batch endpoint, e.g. an OpenAIBatchEndpoint
+    - wait: bool, optional, poll until the batches finish (default is False)
+    - poll_s: float, optional, seconds between polls (default is 60)
+    """
+
+    manifest = load_manifest(outdir)
+    for entry in manifest["files"]:
+        if "batch_id" not in entry:
+            entry["batch_id"] = endpoint.submit(outdir / entry["requests"])
+            entry["status"] = "submitted"
+            print(f'\n\nSubmitted {entry["requests"]} as batch {entry["batch_id"]}.')
+            # Save after every file, so an interrupted run can be resumed.
+            save_manifest(outdir, manifest)
+
+    while True:
+        for entry in manifest["files"]:
+            if entry["status"] not in FINAL_STATES:
+                entry["status"] = endpoint.get_status(entry["batch_id"])
+            print(f'{entry["batch_id"]}: {entry["status"]}')
+        save_manifest(outdir, manifest)
+
+        if not wait or all(e["status"] in FINAL_STATES for e in manifest["files"]):
+            break
+        time.sleep(poll_s)
+
+
+def ingest_results(db, outdir, endpoint):
+    """
+    Stream the result files of the completed batches back into Firestore with
+    a bulk writer, tagged with caption_tier "batch".  Documents whose request
+    failed are left uncaptioned, to be picked up by the next run.
+
+    Parameters:
+    - db: firestore.Client, the database the captions are written to, the one
+      named in the manifest
+    - outdir: Path, the directory holding the request files and manifest
+    - endpoint: the batch endpoint, e.g. an OpenAIBatchEndpoint
+    """
+
+    manifest = load_manifest(outdir)
+    num_captioned = 0
+    num_failed = 0
+    for entry in manifest["files"]:
+        if entry.get("status") != "completed" or entry.get("ingested", False):
+            continue
+
+        result_file = outdir / entry["requests"].replace("requests_", "results_")
+        endpoint.download_results(entry["batch_id"], result_file)
+
+        bulk_writer = db.bulk_writer()
+        with open(result_file, "r") as f:
+            for line in tqdm(f, total=entry["num_requests"]):
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    num_failed += 1
+                    continue
+
+                caption = response["body"]["choices"][0]["message"]["content"]
+                bulk_writer.update(
+                    db.document(result["custom_id"]),
+                    {"caption": caption.strip(), "caption_tier": "batch"},
+                )
+                num_captioned += 1
+        bulk_writer.close()
+
+        entry["ingested"] = True
+        save_manifest(outdir, manifest)
+
+    print(f"\n\nCaptioned {num_captioned} images, {num_failed} requests failed.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "step",
+        type=str,
+        choices=["export", "submit", "ingest"],
+        help="export the request files, submit them, or ingest the results",
+    )
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--outdir",
+        required=True,
+        type=Path,
+        help="directory for the request files, results and manifest",
+    )
+    parser.add_argument(
+        "--email",
+        required=False,
+        type=str,
+        default=None,
+        help="customer email to export the uncaptioned images of",
+    )
+    parser.add_argument(
+        "--maxmessages",
+        required=False,
+        type=int,
+        default=None,
+        help="maximum number of images to export",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="export from the test database, the ingest step writes to the "
+        "database recorded in the manifest",
+    )
+    parser.add_argument(
+        "--endpoint",
+        required=False,
+        type=str,
+        default="openai",
+        choices=list(BATCH_ENDPOINTS),
+        help="batch endpoint to submit the requests to",
+    )
+    parser.add_argument(
+        "--wait",
+        required=False,
+        action="store_true",
+        help="wait for the submitted batches to finish",
+    )
+
+    args = parser.parse_args()
+
+    if args.step == "export":
+        with open(args.configfile, "r") as file:
+            config = yaml.safe_load(file)
+        db_name = config["firestore"]["database_name"]
+        if args.testmode:
+            db_name = config["firestore"]["testdb_name"]
+
+        db_helper = photosapp.DatabaseHelper(args.configfile, args.testmode)
+        customer_rec = db_helper.get_customer(args.email)
+        docs = get_uncaptioned_docs(
+            db_helper, customer_rec, args.maxmessages, IMAGE_FIELDS
+        )
+        use_config_credentials(args.configfile)
+        export_requests(docs, args.outdir, db_name)
+    elif args.step == "submit":
+        endpoint = BATCH_ENDPOINTS[args.endpoint]()
+        submit_requests(args.outdir, endpoint, args.wait)
+    else:
+        endpoint = BATCH_ENDPOINTS[args.endpoint]()
+        # Write to the database the requests were exported from.
+        db_helper = photosapp.DatabaseHelper(
+            args.configfile,
+            database_name=load_manifest(args.outdir)["database_name"],
+        )
+        ingest_results(db_helper.get_db(), args.outdir, endpoint)
@@ -0,0 +1,248 @@
+import argparse
+import json
+import multiprocessing
+from pathlib import Path
+import platform
+import resource
+import statistics
+import sys
+
+sys.path.insert(0, "../src")
+import time
+
+from PIL import Image, ImageOps
+
+from captionmodel import CAPTION_BACKENDS, DEFAULT_CAPTION_MODEL, LocalCaptionModel
+
+
+def load_images(image_dir, num_images):
+    """Load up to num_images images from a directory, correctly oriented."""
+
+    images = []
+    for path in sorted(image_dir.iterdir()):
+        if len(images) >= num_images:
+            break
+        try:
+            img = ImageOps.exif_transpose(Image.open(path))
+        except Exception:
+            continue
+        img.thumbnail((512, 512))  # The size the captioner is sent.
+        images.append(img.convert("RGB"))
+    return images
+
+
+def get_rss_mb():
+    """Return the current resident set size of the process in MB."""
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_config(image_dir, num_images, model_str, setting, repeats, results):
+    """
+    Load the model for one setting and caption the images repeats times.  Runs
+    in its own process, so the memory of each setting is measured alone.
+    """
+
+    images = load_images(image_dir, num_images)
+    batch_size = setting["batch_size"]
+
+    start = time.perf_counter()
+    model = LocalCaptionModel(
+        model_str,
+        setting["backend"],
+        setting["threads"],
+        setting["beams"],
+        setting["max_length"],
+    )
+    load_s = time.perf_counter() - start
+    loaded_rss_mb = get_rss_mb()
+
+    # Warm up, the first batch pays for lazy initialization.
+    model.predict(images[:batch_size])
+
+    latencies = []
+    captions = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for idx in range(0, len(images), batch_size):
+            batch_start = time.perf_counter()
+            captions = model.predict(images[idx : idx + batch_size])
+            latencies.append((time.perf_counter() - batch_start) * 1000)
+    elapsed = time.perf_counter() - start
+
+    results.put(
+        dict(
+            setting,
+            load_s=round(load_s, 1),
+            captions_per_sec=round(repeats * len(images) / elapsed, 2),
+            batch_p50_ms=round(statistics.median(latencies), 1),
+            loaded_rss_mb=round(loaded_rss_mb, 1),
+            peak_rss_mb=round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+            sample_caption=captions[0] if captions else None,
+        )
+    )
+
+
+def benchmark_caption_model(
+    image_dir, num_images, model_str, settings, repeats, output=None
+):
+    """
+    Benchmark the captions/sec and memory of the local caption model for each
+    combination of backend, thread count, beam width, length and batch size.
+
+    Args:
+        image_dir (Path): Directory containing the images to caption.
+        num_images (int): Number of images to caption.
+        model_str (str): The Hugging Face model to load.
+        settings (list): The settings dicts to benchmark.
+        repeats (int): Number of times to caption the images.
+        output (Path, optional): Path to write the results to as JSON.
+
+    Returns:
+        list: The results of each setting.
+    """
+
+    print(
+        f"\n\n{platform.processor() or platform.machine()}, "
+        f"{multiprocessing.cpu_count()} CPUs, {platform.python_version()}\n"
+    )
+    print(
+        f'{"backend":8s} {"threads":>7s} {"beams":>5s} {"maxlen":>6s} {"batch":>5s} '
+        f'{"load s":>7s} {"capt/s":>7s} {"p50 ms":>8s} {"rss MB":>7s} {"peak MB":>8s}'
+    )
+
+    # Use a fresh process per setting, torch never gives memory back.
+    ctx = multiprocessing.get_context("spawn")
+    all_results = []
+    for setting in settings:
+        results = ctx.Queue()
+        process = ctx.Process(
+            target=run_config,
+            args=(image_dir, num_images, model_str, setting, repeats, results),
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"Failed to benchmark {setting}")
+            continue
+
+        result = results.get()
+        all_results.append(result)
+        print(
+            f'{result["backend"]:8s} {str(result["threads"]):>7s} '
+            f'{result["beams"]:5d} {result["max_length"]:6d} '
+            f'{result["batch_size"]:5d} {result["load_s"]:7.1f} '
+            f'{result["captions_per_sec"]:7.2f} {result["batch_p50_ms"]:8.1f} '
+            f'{result["loaded_rss_mb"]:7.1f} {result["peak_rss_mb"]:8.1f}'
+        )
+
+    if all_results:
+        print("\n\nSample captions:")
+        for result in all_results:
+            print(f'{result["backend"]:8s} {result["sample_caption"]}')
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+    return all_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--imagedir",
+        required=True,
+        type=Path,
+        help="directory containing the images to caption",
+    )
+    parser.add_argument(
+        "--numimages",
+        required=False,
+        type=int,
+        default=32,
+        help="number of images to caption",
+    )
+    parser.add_argument(
+        "--model",
+        required=False,
+        type=str,
+        default=DEFAULT_CAPTION_MODEL,
+        help="Hugging Face model to load",
+    )
+    parser.add_argument(
+        "--backends",
+        required=False,
+        type=str,
+        default=",".join(CAPTION_BACKENDS),
+        help="comma separated backends to benchmark",
+    )
+    parser.add_argument(
+        "--threads",
+        required=False,
+        type=str,
+        default=str(multiprocessing.cpu_count()),
+        help="comma separated thread counts to benchmark",
+    )
+    parser.add_argument(
+        "--beams",
+        required=False,
+        type=str,
+        default="1,2,4",
+        help="comma separated beam widths to benchmark",
+    )
+    parser.add_argument(
+        "--maxlength",
+        required=False,
+        type=int,
+        default=32,
+        help="maximum caption length in tokens",
+    )
+    parser.add_argument(
+        "--batchsize",
+        required=False,
+        type=int,
+        default=8,
+        help="number of images captioned per call",
+    )
+    parser.add_argument(
+        "--repeats",
+        required=False,
+        type=int,
+        default=1,
+        help="number of times to caption the images",
+    )
+    parser.add_argument(
+        "--output",
+        required=False,
+        type=Path,
+        default=None,
+        help="path to write the results to as JSON",
+    )
+
+    args = parser.parse_args()
+    settings = [
+        {
+            "backend": backend,
+            "threads": int(threads),
+            "beams": int(beams),
+            "max_length": args.maxlength,
+            "batch_size": args.batchsize,
+        }
+        for backend in args.backends.split(",")
+        for threads in args.threads.split(",")
+        for beams in args.beams.split(",")
+    ]
+    benchmark_caption_model(
+        args.imagedir,
+        args.numimages,
+        args.model,
+        settings,
+        args.repeats,
+        args.output,
+    )
@@ -0,0 +1,126 @@
+import argparse
+from pathlib import Path
+import statistics
+import sys
+
+sys.path.insert(0, "../cloud_functions/ingest")
+import time
+import yaml
+
+import firebase_admin
+from firebase_admin import firestore
+
+from google.cloud import logging
+from google.cloud import storage
+
+import clients
+
+
+def invoke_with_new_clients(bucket_name, blob_name, database_name):
+    """
+    Simulate a warm invocation that constructs its own clients, as the cloud
+    functions used to: read a blob's metadata, read a document and write a log
+    entry.
+    """
+
+    bucket = storage.Client().get_bucket(bucket_name)
+    bucket.get_blob(blob_name)
+    if not firebase_admin._apps:
+        _ = firebase_admin.initialize_app()
+    firestore.Client(database=database_name).document("benchmark/clients").get()
+    logging.Client().logger("benchmark").log_struct({"message": "benchmark"})
+
+
+def invoke_with_shared_clients(bucket_name, blob_name, database_name):
+    """Simulate the same warm invocation using the shared client registry."""
+
+    bucket = clients.get_storage_client().get_bucket(bucket_name)
+    bucket.get_blob(blob_name)
+    clients.get_firestore_client(database_name).document("benchmark/clients").get()
+    clients.get_logging_client().logger("benchmark").log_struct(
+        {"message": "benchmark"}
+    )
+
+
+def time_invocations(invoke, num_invocations, *args):
+    """Return the wall time in milliseconds of each invocation."""
+
+    timings = []
+    for _ in range(num_invocations):
+        start = time.perf_counter()
+        invoke(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def benchmark_clients(config_file, blob_name, num_invocations, test_mode=False):
+    """
+    Compare warm invocation latency with per-invocation clients and with the
+    shared client registry, against the real services.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - blob_name: str, a blob in the main bucket to read the metadata of
+    - num_invocations: int, the number of invocations to time for each mode
+    - test_mode: bool, optional, whether to use the test database and bucket
+    """
+
+    with open(config_file, "r") as file:
+        config = yaml.safe_load(file)
+
+    bucket_name = config["buckets"]["main_bucket"]["name"]
+    database_name = config["firestore"]["database_name"]
+    if test_mode:
+        bucket_name = config["buckets"]["test_bucket"]["name"]
+        database_name = config["firestore"]["testdb_name"]
+    args = (bucket_name, blob_name, database_name)
+
+    # The first shared invocation pays the one-off client setup of a cold
+    # instance, so time it separately.
+    start = time.perf_counter()
+    invoke_with_shared_clients(*args)
+    cold_start = (time.perf_counter() - start) * 1000
+
+    before = time_invocations(invoke_with_new_clients, num_invocations, *args)
+    after = time_invocations(invoke_with_shared_clients, num_invocations, *args)
+
+    print(f"\n\nFirst invocation with shared clients: {cold_start:8.1f} ms")
+    for label, timings in (("new clients", before), ("shared clients", after)):
+        quantiles = statistics.quantiles(timings, n=20)
+        print(
+            f"{label:15s} mean: {statistics.mean(timings):8.1f} ms  "
+            f"p50: {statistics.median(timings):8.1f} ms  "
+            f"p95: {quantiles[18]:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--blobname",
+        required=True,
+        type=str,
+        help="name of a blob in the bucket to read the metadata of",
+    )
+    parser.add_argument(
+        "--invocations",
+        required=False,
+        type=int,
+        default=20,
+        help="number of warm invocations to time in each mode",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database and bucket",
+    )
+
+    args = parser.parse_args()
+    benchmark_clients(args.configfile, args.blobname, args.invocations, args.testmode)
@@ -0,0 +1,111 @@
+import argparse
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../cloud_functions/ingest")
+import time
+
+from tqdm import tqdm
+
+from fakegcp import FakeBucket
+from main import ImageContext, generate_webp_image, get_exif_data
+
+
+def run_stages(bucket, blob, shared):
+    """
+    Run the webp and exif stages of the ingest function for one blob.
+
+    Args:
+        bucket (FakeBucket): The bucket holding the blob.
+        blob (FakeBlob): The image blob to process.
+        shared (bool): Whether the stages share a single ImageContext.
+
+    Returns:
+        tuple: The number of bytes downloaded and the wall time in seconds.
+    """
+
+    bucket.reset_counters()
+    start = time.perf_counter()
+    if shared:
+        image_ctx = ImageContext(blob)
+        generate_webp_image(bucket, blob, image_ctx)
+        get_exif_data(blob, image_ctx)
+        image_ctx.close()
+    else:
+        generate_webp_image(bucket, blob)
+        get_exif_data(blob)
+    elapsed = time.perf_counter() - start
+
+    return bucket.bytes_downloaded, elapsed
+
+
+def benchmark_image_context(image_dir, repeats):
+    """
+    Compare the per-image download size and wall time of the ingest stages with
+    and without a shared ImageContext.
+
+    Args:
+        image_dir (Path): Directory containing the images to benchmark.
+        repeats (int): Number of times to process each image in each mode.
+
+    Returns:
+        None
+    """
+
+    bucket = FakeBucket("benchmark")
+    blobs = []
+    for path in sorted(image_dir.iterdir()):
+        if path.is_file():
+            blob = bucket.add_file(str(path))
+            if "image" in blob.content_type:
+                blobs.append(blob)
+
+    if not blobs:
+        print(f"No images found in {image_dir}")
+        return
+
+    totals = {False: [0, 0.0], True: [0, 0.0]}
+    print(f"\n\n{'image':40s} {'bytes saved':>12s} {'time saved (ms)':>16s}")
+    for blob in tqdm(blobs):
+        per_image = {}
+        for shared in (False, True):
+            num_bytes, elapsed = 0, 0.0
+            for _ in range(repeats):
+                b, t = run_stages(bucket, blob, shared)
+                num_bytes += b
+                elapsed += t
+            per_image[shared] = (num_bytes / repeats, elapsed / repeats)
+            totals[shared][0] += num_bytes / repeats
+            totals[shared][1] += elapsed / repeats
+
+        bytes_saved = per_image[False][0] - per_image[True][0]
+        time_saved = per_image[False][1] - per_image[True][1]
+        print(f"{blob.name[:40]:40s} {bytes_saved:12.0f} {time_saved * 1000:16.1f}")
+
+    num_images = len(blobs)
+    print(f"\n\nImages: {num_images}")
+    for shared, label in ((False, "separate downloads"), (True, "shared context")):
+        print(
+            f"{label:20s} bytes/image: {totals[shared][0] / num_images:12.0f}  "
+            f"ms/image: {totals[shared][1] / num_images * 1000:8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--imagedir",
+        required=True,
+        type=Path,
+        help="directory of sample images to benchmark",
+    )
+    parser.add_argument(
+        "--repeats",
+        required=False,
+        type=int,
+        default=3,
+        help="number of times to process each image",
+    )
+
+    args = parser.parse_args()
+    benchmark_image_context(args.imagedir, args.repeats)
@@ -0,0 +1,353 @@
+import argparse
+import json
+import os
+from pathlib import Path
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+# Ingest log entries, which carry the per stage timings, are written to a local
+# file instead of Cloud Logging.  This must be set before main is imported.
+LOG_FILE = os.path.join(tempfile.gettempdir(), "benchmark_ingest_log.jsonl")
+os.environ["LOG_SINK"] = LOG_FILE
+
+sys.path.insert(0, "../cloud_functions/ingest")
+from PIL import Image
+import piexif
+from pillow_heif import register_heif_opener
+
+from fakegcp import FakeFirestoreClient, FakeStorageClient
+import main
+
+CORPUS_FORMATS = {"jpg": "JPEG", "png": "PNG", "heic": "HEIF", "bmp": "BMP"}
+CORPUS_RESOLUTIONS = "640x480,2048x1536,4032x3024"
+
+# Stages reported by ingest_blob, in the order they run.
+STAGES = ["get_blob", "download", "exif", "derivatives", "upsert"]
+
+# Changes smaller than this (in ms, MB or images/sec) are never regressions, so
+# stages that take well under a millisecond offline don't make the check flaky.
+NOISE_FLOOR = 1.0
+
+
+def make_test_image(size, rgba=False):
+    """
+    Make a synthetic photo-like image: smooth gradients with sensor-like noise,
+    so it compresses roughly like a real photo.
+    """
+
+    w, h = size
+    red = Image.linear_gradient("L").resize((w, h))
+    green = Image.radial_gradient("L").resize((w, h))
+    blue = Image.effect_noise((w, h), 40)
+    img = Image.merge("RGB", (red, green, blue))
+    if rgba:
+        img.putalpha(Image.linear_gradient("L").rotate(90).resize((w, h)))
+    return img
+
+
+def generate_corpus(corpus_dir, resolutions):
+    """
+    Generate the benchmark corpus, one image per format and resolution.  The
+    JPEG and HEIC images carry Exif data.  Existing images are reused.
+
+    Args:
+        corpus_dir (Path): Directory to write the images to.
+        resolutions (list): The (width, height) of each resolution.
+
+    Returns:
+        list: The paths of the images.
+    """
+
+    register_heif_opener()
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    exif = piexif.dump(
+        {
+            "0th": {
+                piexif.ImageIFD.Make: b"Benchmark",
+                piexif.ImageIFD.Model: b"Camera",
+                piexif.ImageIFD.Orientation: 6,
+            },
+            "Exif": {
+                piexif.ExifIFD.DateTimeOriginal: b"2023:05:25 19:28:03",
+                piexif.ExifIFD.FNumber: (28, 10),
+                piexif.ExifIFD.ExposureTime: (1, 250),
+                piexif.ExifIFD.ISOSpeedRatings: 200,
+                piexif.ExifIFD.MakerNote: b"\x00" * 4096,
+            },
+        }
+    )
+
+    paths = []
+    for w, h in resolutions:
+        for ext, img_format in CORPUS_FORMATS.items():
+            path = corpus_dir / f"{w}x{h}.{ext}"
+            if not path.exists():
+                img = make_test_image((w, h), rgba=(ext == "png"))
+                if img_format in ("JPEG", "HEIF"):
+                    img.save(path, img_format, exif=exif, quality=90)
+                else:
+                    img.save(path, img_format)
+            paths.append(path)
+    return paths
+
+
+def get_percentiles(values):
+    """Return the p50, p95 and p99 of a list of values."""
+    if len(values) < 2:
+        values = values * 2
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": round(quantiles[49], 2),
+        "p95": round(quantiles[94], 2),
+        "p99": round(quantiles[98], 2),
+    }
+
+
+def read_log_entries(log_file):
+    """Read the ingest log entries written during the run."""
+    main.get_log_sink("ingest").flush()
+    with open(log_file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_benchmark(paths, repeats, latency):
+    """
+    Ingest every image in the corpus repeats times through ingest_blob, which
+    runs generate_derivatives (and so the rr_img WebP), get_exif_data,
+    get_photo_acquired_time and upsert_into_db, against the in-memory clients.
+
+    Args:
+        paths (list): The paths of the images.
+        repeats (int): Number of times to ingest the corpus.
+        latency (float): Seconds per simulated storage and database request.
+
+    Returns:
+        dict: The metrics of the run.
+    """
+
+    storage_client = FakeStorageClient(latency)
+    firestore_client = FakeFirestoreClient(latency)
+    main.clients.register_client("storage", storage_client)
+    main.clients.register_client("firestore", firestore_client, "benchmark")
+
+    bucket = storage_client.bucket("benchmark")
+    for path in paths:
+        bucket.add_file(str(path))
+
+    message = {
+        "database_name": "benchmark",
+        "customer_table_name": "customers",
+        "top_level_collection_name": "images",
+        "bucket_name": bucket.name,
+        "user_id": "benchmark",
+        "force": True,
+    }
+
+    open(LOG_FILE, "w").close()
+    totals = []
+    totals_by_format = {}
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for path in paths:
+            image_start = time.perf_counter()
+            main.ingest_blob(dict(message, blob_name=path.name), bucket)
+            elapsed = (time.perf_counter() - image_start) * 1000
+            totals.append(elapsed)
+            totals_by_format.setdefault(path.suffix[1:], []).append(elapsed)
+    wall_time = time.perf_counter() - start
+
+    entries = read_log_entries(LOG_FILE)
+    errors = [e for e in entries if e.get("status") == "error"]
+    for entry in errors[:5]:
+        print(f'Error ingesting {entry["blob_name"]}: {entry["error"]}')
+
+    stage_timings = {stage: [] for stage in STAGES}
+    for entry in entries:
+        if entry.get("status") != "success":
+            continue
+        for stage in STAGES:
+            if stage in entry["timings"]:
+                stage_timings[stage].append(entry["timings"][stage])
+
+    return {
+        "images": len(totals),
+        "errors": len(errors),
+        "images_per_sec": round(len(totals) / wall_time, 2),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "stages": {
+            stage: get_percentiles(values)
+            for stage, values in stage_timings.items()
+            if values
+        },
+        "total": get_percentiles(totals),
+        "total_by_format": {
+            ext: get_percentiles(values) for ext, values in totals_by_format.items()
+        },
+    }
+
+
+def find_regressions(metrics, baseline, threshold):
+    """
+    Compare the tracked metrics against a baseline.  Latency percentiles and
+    peak memory regress when they grow, throughput when it drops, by more than
+    the threshold fraction.
+
+    Returns:
+        list: A description of every regression.
+    """
+
+    # (label, current value, baseline value, whether lower is better)
+    tracked = [
+        (
+            "images_per_sec",
+            metrics["images_per_sec"],
+            baseline.get("images_per_sec"),
+            False,
+        ),
+        ("peak_rss_mb", metrics["peak_rss_mb"], baseline.get("peak_rss_mb"), True),
+    ]
+    for pct in ("p50", "p95"):
+        tracked.append(
+            (f"total.{pct}", metrics["total"][pct], baseline["total"][pct], True)
+        )
+    for group in ("stages", "total_by_format"):
+        for name, values in baseline.get(group, {}).items():
+            for pct in ("p50", "p95"):
+                current = metrics[group].get(name, {}).get(pct)
+                tracked.append((f"{group}.{name}.{pct}", current, values[pct], True))
+
+    regressions = []
+    for label, current, base, lower_is_better in tracked:
+        if current is None or not base or abs(current - base) < NOISE_FLOOR:
+            continue
+        change = (current - base) / base
+        if not lower_is_better:
+            change = -change
+        if change > threshold:
+            regressions.append(
+                f"{label}: {base} -> {current} ({100 * change:+.1f}% worse)"
+            )
+    return regressions
+
+
+def print_metrics(metrics):
+    """Print the metrics of a run."""
+
+    print(f'\n\nImages: {metrics["images"]}  errors: {metrics["errors"]}')
+    print(f'Throughput: {metrics["images_per_sec"]:8.2f} images/sec')
+    print(f'Peak RSS:   {metrics["peak_rss_mb"]:8.1f} MB')
+    print(f'\n{"ms":16s} {"p50":>9s} {"p95":>9s} {"p99":>9s}')
+    rows = list(metrics["stages"].items()) + [("total", metrics["total"])]
+    rows += [(f"total ({ext})", v) for ext, v in metrics["total_by_format"].items()]
+    for name, pcts in rows:
+        print(f'{name:16s} {pcts["p50"]:9.1f} {pcts["p95"]:9.1f} {pcts["p99"]:9.1f}')
+
+
+def benchmark_ingest(
+    corpus_dir, resolutions, repeats, latency, output, baseline_file, threshold
+):
+    """
+    Run the offline ingest benchmark, optionally failing if it regresses.
+
+    Returns:
+        int: The exit code, 1 if a tracked metric regressed, 0 otherwise.
+    """
+
+    paths = generate_corpus(corpus_dir, resolutions)
+    metrics = run_benchmark(paths, repeats, latency)
+    print_metrics(metrics)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+    if metrics["errors"]:
+        print(f'\n\n{metrics["errors"]} images failed to ingest.')
+        return 1
+
+    if baseline_file is not None:
+        with open(baseline_file, "r") as f:
+            baseline = json.load(f)
+        regressions = find_regressions(metrics, baseline, threshold)
+        if regressions:
+            print(f"\n\nRegressions beyond {100 * threshold:.0f}% of the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\n\nNo regressions beyond {100 * threshold:.0f}% of the baseline.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--corpusdir",
+        required=False,
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "ingest_benchmark_corpus",
+        help="directory to generate the image corpus in (reused if present)",
+    )
+    parser.add_argument(
+        "--resolutions",
+        required=False,
+        type=str,
+        default=CORPUS_RESOLUTIONS,
+        help="comma separated WxH resolutions of the corpus images",
+    )
+    parser.add_argument(
+        "--repeats",
+        required=False,
+        type=int,
+        default=3,
+        help="number of times to ingest the corpus",
+    )
+    parser.add_argument(
+        "--latency",
+        required=False,
+        type=float,
+        default=0.0,
+        help="simulated seconds per storage and database request",
+    )
+    parser.add_argument(
+        "--output",
+        required=False,
+        type=Path,
+        default=None,
+        help="path to write the metrics to as JSON, e.g. to use as a baseline",
+    )
+    parser.add_argument(
+        "--baseline",
+        required=False,
+        type=Path,
+        default=None,
+        help="metrics JSON of an earlier run to check for regressions against",
+    )
+    parser.add_argument(
+        "--threshold",
+        required=False,
+        type=float,
+        default=0.2,
+        help="fraction a tracked metric may worsen by before the run fails",
+    )
+
+    args = parser.parse_args()
+    resolutions = [
+        tuple(int(v) for v in res.split("x")) for res in args.resolutions.split(",")
+    ]
+    sys.exit(
+        benchmark_ingest(
+            args.corpusdir,
+            resolutions,
+            args.repeats,
+            args.latency,
+            args.output,
+            args.baseline,
+            args.threshold,
+        )
+    )
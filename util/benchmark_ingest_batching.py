@@ -0,0 +1,151 @@
+import argparse
+import base64
+import json
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../cloud_functions/ingest")
+import time
+
+from fakegcp import FakeStorageClient
+import main
+
+
+def make_event(message):
+    """Encode a message as a Pub/Sub event."""
+    return {"data": base64.b64encode(json.dumps(message).encode("utf-8"))}
+
+
+def patch_ingest_function(storage_client, latency):
+    """
+    Point the ingest function at the in-memory storage client and replace the
+    Firestore and Cloud Logging round trips with a simulated latency.
+
+    Args:
+        storage_client (FakeStorageClient): The client holding the images.
+        latency (float): Seconds per simulated request.
+
+    Returns:
+        None
+    """
+
+    def is_unchanged(message, blob):
+        time.sleep(latency)
+        return False
+
+    def upsert_into_db(*args, **kwargs):
+        time.sleep(latency)
+
+    def log_message(msg_dict):
+        time.sleep(latency)
+
+    main.clients.register_client("storage", storage_client)
+    main.is_unchanged = is_unchanged
+    main.upsert_into_db = upsert_into_db
+    main.log_message = log_message
+
+
+def benchmark_ingest_batching(image_dir, batch_size, max_workers, latency, repeats):
+    """
+    Compare the images per second processed by a single function instance with
+    the single blob message format and the batched message format.
+
+    Args:
+        image_dir (Path): Directory containing the images to benchmark.
+        batch_size (int): Number of blobs in each batched message.
+        max_workers (int): Concurrency used for batched messages.
+        latency (float): Seconds per simulated storage/database/logging request.
+        repeats (int): Number of times to ingest the image set in each mode.
+
+    Returns:
+        None
+    """
+
+    storage_client = FakeStorageClient(latency)
+    bucket = storage_client.bucket("benchmark")
+    blob_names = []
+    for path in sorted(image_dir.iterdir()):
+        if path.is_file():
+            blob = bucket.add_file(str(path))
+            if "image" in blob.content_type:
+                blob_names.append(blob.name)
+    blob_names = blob_names * repeats
+
+    if not blob_names:
+        print(f"No images found in {image_dir}")
+        return
+
+    patch_ingest_function(storage_client, latency)
+    message = {
+        "database_name": "benchmark",
+        "customer_table_name": "customers",
+        "top_level_collection_name": "images",
+        "bucket_name": bucket.name,
+        "user_id": "benchmark",
+    }
+
+    start = time.perf_counter()
+    for blob_name in blob_names:
+        main.ingest_object(make_event(dict(message, blob_name=blob_name)), None)
+    single_rate = len(blob_names) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for idx in range(0, len(blob_names), batch_size):
+        batch = blob_names[idx : idx + batch_size]
+        batch_message = dict(message, blob_names=batch, max_workers=max_workers)
+        main.ingest_object(make_event(batch_message), None)
+    batch_rate = len(blob_names) / (time.perf_counter() - start)
+
+    print(f"\n\nImages: {len(blob_names)}")
+    print(f"single blob messages:       {single_rate:8.2f} images/sec")
+    print(
+        f"batches of {batch_size:4d}, {max_workers:2d} workers: {batch_rate:8.2f} images/sec"
+    )
+    print(f"speedup:                    {batch_rate / single_rate:8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--imagedir",
+        required=True,
+        type=Path,
+        help="directory of sample images to benchmark",
+    )
+    parser.add_argument(
+        "--batchsize",
+        required=False,
+        type=int,
+        default=20,
+        help="number of blobs in each batched message",
+    )
+    parser.add_argument(
+        "--maxworkers",
+        required=False,
+        type=int,
+        default=8,
+        help="number of images processed concurrently from a batch",
+    )
+    parser.add_argument(
+        "--latency",
+        required=False,
+        type=float,
+        default=0.05,
+        help="simulated seconds per storage, database and logging request",
+    )
+    parser.add_argument(
+        "--repeats",
+        required=False,
+        type=int,
+        default=5,
+        help="number of times to ingest the image set in each mode",
+    )
+
+    args = parser.parse_args()
+    benchmark_ingest_batching(
+        args.imagedir,
+        args.batchsize,
+        args.maxworkers,
+        args.latency,
+        args.repeats,
+    )
@@ -0,0 +1,175 @@
+import argparse
+from pathlib import Path
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, "../src")
+sys.path.insert(0, "../cloud_functions/ingest")
+from tqdm import tqdm
+
+import photosapp
+from main import (
+    WEBP_SHORT_SIDE,
+    ImageContext,
+    decode_reduced_image,
+    encode_derivative,
+)
+
+DEFAULT_SETTINGS = "webp:80:4,webp:75:6,webp:80:0,avif:60:6,avif:50:4"
+
+
+def parse_settings(settings):
+    """
+    Parse a comma separated list of codec:quality:effort settings, e.g.
+    "webp:80:4,avif:60:6".  Quality and effort may be left empty for the
+    encoder defaults, e.g. "webp::".
+    """
+
+    parsed = []
+    for setting in settings.split(","):
+        codec, quality, effort = (setting.split(":") + ["", ""])[:3]
+        parsed.append(
+            (
+                setting,
+                codec.lower(),
+                int(quality) if quality else None,
+                int(effort) if effort else None,
+            )
+        )
+    return parsed
+
+
+def compare_codecs(
+    config_file, email, settings, sample_size, short_side, test_mode=False
+):
+    """
+    Re-encode a random sample of a customer's images under several derivative
+    codec settings, and report the bytes saved against the encode time.  The
+    first setting is the reference the others are compared to.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - email: str, the email address of the customer
+    - settings: list, (label, codec, quality, effort) of each setting
+    - sample_size: int, the number of images to sample
+    - short_side: int, the short side of the derivatives to encode
+    - test_mode: bool, optional, whether to run in test mode (default is False)
+    """
+
+    db_helper = photosapp.DatabaseHelper(config_file, test_mode)
+    customer_rec = db_helper.get_customer(email)
+    storage_helper = photosapp.GCStoragehelper(config_file)
+    col_ref = db_helper.get_db().collection(
+        f'{photosapp.CUSTOMERTABLE}/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
+    )
+
+    print("\n\nQuerying the database...\n\n")
+    records = [
+        doc.to_dict()
+        for doc in tqdm(col_ref.select(["bucket_name", "blob_name"]).stream())
+    ]
+    records = random.sample(records, min(sample_size, len(records)))
+
+    print("\n\nEncoding the sample...\n\n")
+    buckets = {}
+    sizes = {label: [] for label, _, _, _ in settings}
+    times = {label: [] for label, _, _, _ in settings}
+    for rec in tqdm(records):
+        image_ctx = None
+        try:
+            if rec["bucket_name"] not in buckets:
+                buckets[rec["bucket_name"]] = storage_helper.get_bucket(
+                    rec["bucket_name"]
+                )
+            blob = buckets[rec["bucket_name"]].get_blob(rec["blob_name"])
+            image_ctx = ImageContext(blob)
+            img = decode_reduced_image(image_ctx, short_side)
+        except Exception as e:
+            print(e)
+            print(rec["bucket_name"], rec["blob_name"])
+            continue
+        finally:
+            if image_ctx is not None:
+                image_ctx.close()
+
+        for label, codec, quality, effort in settings:
+            start = time.perf_counter()
+            data = encode_derivative(img, codec, quality, effort)
+            times[label].append((time.perf_counter() - start) * 1000)
+            sizes[label].append(len(data))
+
+    num_images = len(sizes[settings[0][0]])
+    if not num_images:
+        print("No images could be encoded.")
+        return
+
+    reference = sum(sizes[settings[0][0]])
+    print(f"\n\nEncoded {num_images} images at a short side of {short_side} px.\n")
+    print(
+        f'{"setting":16s} {"mean KB":>9s} {"vs ref":>8s} '
+        f'{"mean ms":>9s} {"p95 ms":>9s}'
+    )
+    for label, _, _, _ in settings:
+        total = sum(sizes[label])
+        p95 = statistics.quantiles(times[label] * 2, n=20)[18]
+        print(
+            f"{label:16s} {total / num_images / 1024:9.1f} "
+            f"{100 * (total - reference) / reference:+7.1f}% "
+            f"{statistics.mean(times[label]):9.1f} {p95:9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--email",
+        required=True,
+        type=str,
+        default=None,
+        help="customer email to sample the images of",
+    )
+    parser.add_argument(
+        "--settings",
+        required=False,
+        type=str,
+        default=DEFAULT_SETTINGS,
+        help="comma separated codec:quality:effort settings, the first is the reference",
+    )
+    parser.add_argument(
+        "--samplesize",
+        required=False,
+        type=int,
+        default=50,
+        help="number of images to sample",
+    )
+    parser.add_argument(
+        "--shortside",
+        required=False,
+        type=int,
+        default=WEBP_SHORT_SIDE,
+        help="short side of the derivatives to encode",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database",
+    )
+
+    args = parser.parse_args()
+    compare_codecs(
+        args.configfile,
+        args.email,
+        parse_settings(args.settings),
+        args.samplesize,
+        args.shortside,
+        args.testmode,
+    )
@@ -44,7 +44,7 @@ if __name__ == "__main__":
     col_ref = db_helper.get_db().collection(
         f'customers/{customer["uuid"]}/{photosapp.IMAGESTABLE}'
     )
-    image_list = col_ref.stream()
+    image_list = col_ref.select(["blob_name"]).stream()
 
     total_num_records = 0
     for img in tqdm(image_list):
@@ -68,9 +68,10 @@ class HuggingfaceVisionModel:
         for image in images:
             if not isinstance(image, Image.Image):
                 raise ValueError("All images must be of type PIL.Image")
-
-            if image.mode != "RGB":
-                image = image.convert(mode="RGB")
+        images = [
+            image if image.mode == "RGB" else image.convert(mode="RGB")
+            for image in images
+        ]
 
         pixel_values = self.feature_extractor(
             images=images, return_tensors="pt"
@@ -0,0 +1,395 @@
+import base64
+import copy
+import hashlib
+import json
+import mimetypes
+import os
+import time
+from types import SimpleNamespace
+
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore_v1
+from google.rpc import code_pb2
+
+
+class FakeBlob(object):
+    """A class to represent a Google Cloud Storage blob held in memory."""
+
+    def __init__(self, bucket, name, data=None, content_type=None):
+        """Initialize the FakeBlob object."""
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.content_type = content_type
+        if self.content_type is None:
+            self.content_type = mimetypes.guess_type(name)[0] or "image/webp"
+        self.generation = None
+        self.md5_hash = None
+        if data is not None:
+            self.set_data(data)
+
+    def set_data(self, data):
+        """Store the data, updating the generation and md5 hash."""
+        self.data = data
+        self.generation = (self.generation or 0) + 1
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+
+    @property
+    def size(self):
+        """Return the size of the blob in bytes."""
+        return len(self.data) if self.data is not None else None
+
+    def download_as_bytes(self, start=None, end=None):
+        """
+        Return the contents of the blob, counting the bytes downloaded.  As with
+        Cloud Storage, end is inclusive.
+        """
+        self.bucket.simulate_latency()
+        data = self.data
+        if start is not None or end is not None:
+            data = data[start or 0 : None if end is None else end + 1]
+        self.bucket.bytes_downloaded += len(data)
+        self.bucket.num_downloads += 1
+        return data
+
+    def download_to_file(self, file_obj):
+        """Write the contents of the blob to a file object."""
+        file_obj.write(self.download_as_bytes())
+
+    def upload_from_string(self, data, content_type=None):
+        """Store the data in the blob, counting the bytes uploaded."""
+        self.bucket.simulate_latency()
+        self.set_data(data)
+        if content_type is not None:
+            self.content_type = content_type
+        self.bucket.bytes_uploaded += len(data)
+        self.bucket.blobs[self.name] = self
+
+    def delete(self):
+        """Delete the blob from the bucket."""
+        self.bucket.blobs.pop(self.name, None)
+
+
+class FakeBucket(object):
+    """A class to represent a Google Cloud Storage bucket held in memory."""
+
+    def __init__(self, name, latency=0.0):
+        """
+        Initialize the FakeBucket object.
+
+        Args:
+            name (str): The name of the bucket.
+            latency (float, optional): Seconds to sleep on every request, to
+                simulate the round trip to Cloud Storage.  Defaults to 0.
+        """
+        self.name = name
+        self.latency = latency
+        self.blobs = {}
+        self.reset_counters()
+
+    def simulate_latency(self):
+        """Sleep for the simulated request latency."""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        """Reset the transfer counters."""
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.num_downloads = 0
+
+    def add_file(self, path, blob_name=None):
+        """Add a file from the local filesystem to the bucket."""
+        if blob_name is None:
+            blob_name = os.path.basename(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        blob = FakeBlob(self, blob_name, data)
+        self.blobs[blob_name] = blob
+        return blob
+
+    def blob(self, blob_name):
+        """Return a new blob object that is not yet stored in the bucket."""
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        """Return the blob with the given name, or None if it does not exist."""
+        self.simulate_latency()
+        return self.blobs.get(blob_name, None)
+
+    def list_blobs(self):
+        """List the blobs in the bucket."""
+        return list(self.blobs.values())
+
+
+class FakeStorageClient(object):
+    """A class to represent a Google Cloud Storage client held in memory."""
+
+    def __init__(self, latency=0.0):
+        """Initialize the FakeStorageClient object."""
+        self.latency = latency
+        self.buckets = {}
+
+    def bucket(self, bucket_name):
+        """Return the bucket with the given name, creating it if required."""
+        if bucket_name not in self.buckets:
+            self.buckets[bucket_name] = FakeBucket(bucket_name, self.latency)
+        return self.buckets[bucket_name]
+
+    def get_bucket(self, bucket_name):
+        """Return the bucket with the given name."""
+        return self.bucket(bucket_name)
+
+
+class FakeDocumentSnapshot(object):
+    """A class to represent a Firestore document snapshot held in memory."""
+
+    def __init__(self, reference, data):
+        """Initialize the FakeDocumentSnapshot object."""
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        """Return a copy of the document data, or None if it doesn't exist."""
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        """Return the value of a top level field."""
+        return self._data.get(field, None)
+
+
+class FakeDocumentReference(object):
+    """A class to represent a Firestore document reference held in memory."""
+
+    def __init__(self, client, path):
+        """Initialize the FakeDocumentReference object."""
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        """Return a subcollection of the document."""
+        return FakeCollectionReference(self.client, f"{self.path}/{name}")
+
+    def get(self):
+        """Return a snapshot of the document."""
+        self.client.simulate_latency()
+        self.client.num_reads += 1
+        return FakeDocumentSnapshot(self, self.client.documents.get(self.path, None))
+
+    def set(self, data, merge=False):
+        """Write the document, merging into the existing data if requested."""
+        self.client.simulate_latency()
+        self.client.write(self.path, data, merge)
+
+    def update(self, data):
+        """Update fields of an existing document."""
+        self.client.simulate_latency()
+        if self.path not in self.client.documents:
+            raise KeyError(f"No document to update: {self.path}")
+        self.client.write(self.path, data, True)
+
+    def delete(self):
+        """Delete the document."""
+        self.client.simulate_latency()
+        self.client.documents.pop(self.path, None)
+
+
+class FakeCollectionReference(object):
+    """A class to represent a Firestore collection held in memory."""
+
+    def __init__(self, client, path):
+        """Initialize the FakeCollectionReference object."""
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id):
+        """Return a reference to a document in the collection."""
+        return FakeDocumentReference(self.client, f"{self.path}/{document_id}")
+
+    def stream(self):
+        """Yield a snapshot of every document directly in the collection."""
+        self.client.simulate_latency()
+        prefix = self.path + "/"
+        for path in sorted(self.client.documents):
+            if path.startswith(prefix) and "/" not in path[len(prefix) :]:
+                self.client.num_reads += 1
+                yield FakeDocumentSnapshot(
+                    FakeDocumentReference(self.client, path),
+                    self.client.documents[path],
+                )
+
+
+class FakeWriteBatch(object):
+    """
+    A class to represent a Firestore write batch held in memory.  As with
+    Firestore, an update of a missing document fails the whole batch.
+    """
+
+    def __init__(self, client):
+        """Initialize the FakeWriteBatch object."""
+        self.client = client
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        """Queue a set of the document."""
+        self.writes.append((doc_ref, data, "merge" if merge else "set"))
+
+    def update(self, doc_ref, data):
+        """Queue an update of the document."""
+        self.writes.append((doc_ref, data, "update"))
+
+    def delete(self, doc_ref):
+        """Queue a delete of the document."""
+        self.writes.append((doc_ref, None, "delete"))
+
+    def commit(self):
+        """Apply every queued write in a single round trip."""
+        self.client.simulate_latency()
+        writes, self.writes = self.writes, []
+        for doc_ref, _, mode in writes:
+            if mode == "update" and doc_ref.path not in self.client.documents:
+                raise NotFound(f"No document to update: {doc_ref.path}")
+        for doc_ref, data, mode in writes:
+            self._apply(doc_ref, data, mode)
+
+    def _apply(self, doc_ref, data, mode):
+        """Apply a single write."""
+        if mode == "delete":
+            self.client.documents.pop(doc_ref.path, None)
+        else:
+            self.client.write(doc_ref.path, data, mode != "set")
+
+
+class FakeWriteFailure(object):
+    """A class to represent a failed bulk writer write, as BulkWriteFailure."""
+
+    def __init__(self, reference, code, message):
+        """Initialize the FakeWriteFailure object."""
+        self.operation = SimpleNamespace(reference=reference)
+        self.code = code
+        self.message = message
+        self.attempts = 1
+
+
+class FakeBulkWriter(FakeWriteBatch):
+    """
+    A class to represent a Firestore bulk writer held in memory.  Writes are
+    sent in batches of 20 as they are queued, like the real one, and a write
+    that fails only fails itself, calling the on_write_error callback.
+    """
+
+    BATCH_SIZE = 20
+
+    def __init__(self, client):
+        """Initialize the FakeBulkWriter object."""
+        super().__init__(client)
+        self.error_callback = None
+
+    def on_write_error(self, callback):
+        """Set the callback called on a failed write, which returns whether to retry."""
+        self.error_callback = callback
+
+    def set(self, doc_ref, data, merge=False):
+        """Queue a set of the document."""
+        super().set(doc_ref, data, merge)
+        self._send_full_batch()
+
+    def update(self, doc_ref, data):
+        """Queue an update of the document."""
+        super().update(doc_ref, data)
+        self._send_full_batch()
+
+    def commit(self):
+        """Apply every queued write, retrying failures the callback asks for."""
+        self.client.simulate_latency()
+        writes, self.writes = self.writes, []
+        for doc_ref, data, mode in writes:
+            failure = None
+            while mode == "update" and doc_ref.path not in self.client.documents:
+                if failure is None:
+                    failure = FakeWriteFailure(
+                        doc_ref,
+                        code_pb2.NOT_FOUND,
+                        f"No document to update: {doc_ref.path}",
+                    )
+                else:
+                    failure.attempts += 1
+                if self.error_callback is None or not self.error_callback(
+                    failure, self
+                ):
+                    break
+            else:
+                self._apply(doc_ref, data, mode)
+
+    def flush(self):
+        """Send every queued write."""
+        if self.writes:
+            self.commit()
+
+    def close(self):
+        """Send every queued write."""
+        self.flush()
+
+    def _send_full_batch(self):
+        """Send the queued writes once there is a full batch."""
+        if len(self.writes) >= self.BATCH_SIZE:
+            self.commit()
+
+
+class FakeFirestoreClient(object):
+    """A class to represent a Firestore client held in memory."""
+
+    def __init__(self, latency=0.0):
+        """
+        Initialize the FakeFirestoreClient object.
+
+        Args:
+            latency (float, optional): Seconds to sleep on every request, to
+                simulate the round trip to Firestore.  Defaults to 0.
+        """
+        self.latency = latency
+        self.documents = {}
+        self.reset_counters()
+
+    def simulate_latency(self):
+        """Sleep for the simulated request latency."""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        """Reset the read and write counters."""
+        self.num_reads = 0
+        self.num_writes = 0
+        self.bytes_written = 0
+
+    def collection(self, path):
+        """Return a reference to a collection."""
+        return FakeCollectionReference(self, path)
+
+    def document(self, path):
+        """Return a reference to a document."""
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        """Return a new write batch."""
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self):
+        """Return a new bulk writer."""
+        return FakeBulkWriter(self)
+
+    def write(self, path, data, merge):
+        """Store a document, counting the write and its approximate size."""
+        record = copy.deepcopy(self.documents.get(path, {})) if merge else {}
+        for field, value in data.items():
+            if value is firestore_v1.DELETE_FIELD:
+                record.pop(field, None)
+            else:
+                record[field] = copy.deepcopy(value)
+        self.documents[path] = record
+        self.num_writes += 1
+        self.bytes_written += len(json.dumps(record, default=str))
@@ -0,0 +1,195 @@
+import argparse
+import json
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../src")
+from tqdm import tqdm
+
+import photosapp
+
+
+def hamming_distance(a, b):
+    """Return the number of bits that differ between two integer hashes."""
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHashTable(object):
+    """
+    A class implementing a multi-index hash table over 64-bit hashes.  Each
+    hash is split into threshold + 1 chunks and indexed by every chunk.  Two
+    hashes within threshold bits of each other must agree exactly on at least
+    one chunk, so a query only compares against the hashes sharing a chunk.
+    """
+
+    def __init__(self, threshold, num_bits=64):
+        """Initialize an empty MultiIndexHashTable."""
+        self.threshold = threshold
+        num_chunks = min(threshold + 1, num_bits)
+
+        # (shift, mask) of each chunk, sizes differ by at most one bit.
+        self.chunks = []
+        shift = 0
+        for idx in range(num_chunks):
+            width = num_bits // num_chunks + int(idx < num_bits % num_chunks)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [{} for _ in self.chunks]
+        self.values = []
+
+    def add(self, value, item):
+        """Add an item with the given hash to the table."""
+        self.values.append((value, item))
+        entry = len(self.values) - 1
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table.setdefault((value >> shift) & mask, []).append(entry)
+
+    def query(self, value):
+        """Return every item whose hash is within threshold bits of value."""
+        candidates = set()
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            candidates.update(table.get((value >> shift) & mask, []))
+
+        results = []
+        for entry in candidates:
+            other, item = self.values[entry]
+            if hamming_distance(value, other) <= self.threshold:
+                results.append(item)
+        return results
+
+
+def find_clusters(records, threshold):
+    """
+    Group records into clusters of near duplicates.  Two records are linked if
+    their hashes are within threshold bits, and clusters are the connected
+    components of those links.
+
+    Parameters:
+    - records: list, dicts with at least a "dhash" hex string
+    - threshold: int, the maximum Hamming distance between near duplicates
+
+    Returns:
+    - list, the clusters of two or more records, largest first
+    """
+
+    table = MultiIndexHashTable(threshold)
+    for idx, rec in enumerate(records):
+        table.add(int(rec["dhash"], 16), idx)
+
+    # Union-find over the record indices.
+    parent = list(range(len(records)))
+
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    for idx, rec in enumerate(tqdm(records)):
+        for match in table.query(int(rec["dhash"], 16)):
+            root_a, root_b = find(idx), find(match)
+            if root_a != root_b:
+                parent[root_b] = root_a
+
+    clusters = {}
+    for idx, rec in enumerate(records):
+        clusters.setdefault(find(idx), []).append(rec)
+
+    clusters = [c for c in clusters.values() if len(c) > 1]
+    clusters.sort(key=len, reverse=True)
+    return clusters
+
+
+def find_near_duplicates(
+    config_file, email, threshold, output_file=None, test_mode=False
+):
+    """
+    List the clusters of near duplicate images for a customer, using the
+    perceptual hash stored on each image record at ingest.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - email: str, the email address of the customer
+    - threshold: int, the maximum Hamming distance between near duplicates
+    - output_file: str, optional, a path to write the clusters to as JSON
+    - test_mode: bool, optional, whether to run in test mode (default is False)
+    """
+
+    db_helper = photosapp.DatabaseHelper(config_file, test_mode)
+    customer_rec = db_helper.get_customer(email)
+    col_ref = db_helper.get_db().collection(
+        f'customers/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
+    )
+
+    print("\n\nQuerying the database...\n\n")
+    records = []
+    num_unhashed = 0
+    fields = ["bucket_name", "blob_name", "acquisition_time", "rr_img", "dhash"]
+    for doc in tqdm(col_ref.select(fields).stream()):
+        rec = doc.to_dict()
+        if not rec.get("dhash", None):
+            num_unhashed += 1
+            continue
+        rec["uuid"] = doc.id
+        records.append(rec)
+
+    print("\n\nFinding near duplicates...\n\n")
+    clusters = find_clusters(records, threshold)
+    for cluster in clusters:
+        print(f"\n{len(cluster)} images:")
+        for rec in sorted(cluster, key=lambda r: r.get("acquisition_time") or ""):
+            print(f'  {rec["dhash"]}  {rec["bucket_name"]}/{rec["blob_name"]}')
+
+    num_duplicates = sum(len(cluster) - 1 for cluster in clusters)
+    print(
+        f"\n\nDone.  Found {len(clusters)} clusters of near duplicates in "
+        f"{len(records)} images, {num_duplicates} images could be dropped."
+    )
+    if num_unhashed:
+        print(f"{num_unhashed} images have no hash yet, reingest them with --force.")
+
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(clusters, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--email",
+        required=True,
+        type=str,
+        default=None,
+        help="customer email to find the near duplicates for",
+    )
+    parser.add_argument(
+        "--threshold",
+        required=False,
+        type=int,
+        default=6,
+        help="maximum number of differing hash bits between near duplicates",
+    )
+    parser.add_argument(
+        "--outfile",
+        required=False,
+        type=Path,
+        default=None,
+        help="path to write the clusters to as JSON",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database",
+    )
+
+    args = parser.parse_args()
+    find_near_duplicates(
+        args.configfile, args.email, args.threshold, args.outfile, args.testmode
+    )
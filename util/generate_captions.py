@@ -1,24 +1,176 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
 import sys
 
 sys.path.insert(0, "../src")
-import time
+sys.path.insert(0, "../cloud_functions/caption")
 import yaml
 
+from tqdm import tqdm
+
+# Only the image helpers of the caption function, importing its main would
+# install the function's SIGTERM handler in this process.
+from captionimage import load_caption_image
+import clients
+from dispatcher import AdaptiveDispatcher
 import photosapp
 
+# Fields of the image records the local model needs to load the image.
+IMAGE_FIELDS = ["caption", "bucket_name", "blob_name", "rr_img", "derivatives"]
+
+
+def use_config_credentials(config_file):
+    """
+    Load the images with the service account from the config file, rather than
+    the default credentials the caption function runs with.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    """
+
+    storage_helper = photosapp.GCStoragehelper(config_file)
+    clients.register_client("storage", storage_helper.storage_client)
+
+
+def load_image(rec):
+    """Load the image of a record as it would be sent to the API, or None on failure."""
+    try:
+        return load_caption_image(rec, "low")
+    except Exception as e:
+        print(e)
+        print(rec["bucket_name"], rec["blob_name"])
+        return None
+
+
+def caption_locally(db, docs, model, threshold, batch_size):
+    """
+    Caption documents with the local model, writing back the captions it is
+    confident in, tagged with caption_tier "local".
+
+    Parameters:
+    - db: firestore.Client, the database client
+    - docs: list, the (document path, record) of each document to caption
+    - model: LocalCaptionModel, the local caption model
+    - threshold: float, the lowest confidence a local caption is kept at
+    - batch_size: int, the number of images captioned in each model call
+
+    Returns:
+    list: the paths of the documents to escalate to the captioning API
+    """
+
+    escalated = []
+    num_captioned = 0
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for idx in tqdm(range(0, len(docs), batch_size)):
+            batch = docs[idx : idx + batch_size]
+            images = list(executor.map(lambda doc: load_image(doc[1]), batch))
 
-def generate_captions(config_file, email, maxmessages, test_mode=False):
+            loaded = [(doc, img) for doc, img in zip(batch, images) if img is not None]
+            escalated += [doc[0] for doc, img in zip(batch, images) if img is None]
+            if not loaded:
+                continue
+
+            # Write each batch's captions as they come, so an interrupted run
+            # keeps what it has already captioned.
+            db_batch = db.batch()
+            num_writes = 0
+            results = model.predict([img for _, img in loaded], return_scores=True)
+            for (doc, _), (caption, confidence) in zip(loaded, results):
+                if caption and confidence >= threshold:
+                    db_batch.update(
+                        db.document(doc[0]),
+                        {
+                            "caption": caption,
+                            "caption_tier": "local",
+                            "caption_confidence": confidence,
+                        },
+                    )
+                    num_writes += 1
+                else:
+                    escalated.append(doc[0])
+            if num_writes:
+                db_batch.commit()
+                num_captioned += num_writes
+
+    print(
+        f"\n\nCaptioned {num_captioned} of {len(docs)} images locally, "
+        f"escalating {len(escalated)} to the API."
+    )
+
+    return escalated
+
+
+def get_uncaptioned_docs(db_helper, customer_rec, maxmessages, fields):
+    """
+    Get the image records of a customer that have no caption yet.
+
+    Parameters:
+    - db_helper: DatabaseHelper, the database helper
+    - customer_rec: dict, the customer record
+    - maxmessages: int, the maximum number of records to return
+    - fields: list, the fields of the records to read
+
+    Returns:
+    list: the (document path, record) of each uncaptioned image
+    """
+
+    # Iterate through the documents in the database and collect the ones to
+    # caption.
+    col_ref = db_helper.get_db().collection(
+        f'customers/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
+    ).order_by('acquisition_time').select(fields)
+    image_list = col_ref.stream()
+
+    # Loop over the images first, collecting the documents to caption.  It turns
+    # out that if you leave the firestore connection open too long, it dies.
+    docs = []
+    for img in image_list:
+        # Captioning is expensive, only run it when there is no existing caption.
+        img_caption = img.to_dict().get('caption', None)
+        if img_caption is None:
+            docs.append(
+                (
+                    f'{photosapp.CUSTOMERTABLE}/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}/{img.id}',
+                    img.to_dict(),
+                )
+            )
+
+            if maxmessages and len(docs) >= maxmessages:
+                break
+
+    return docs
+
+
+def generate_captions(
+    config_file,
+    email,
+    maxmessages,
+    test_mode=False,
+    batch_size=1,
+    cascade=False,
+    threshold=0.5,
+    backend="int8",
+):
     """
     Generate captions for images based on the provided configuration file.
 
+    In cascade mode the images are captioned by the local model first, and only
+    the ones it is not confident about are sent to the captioning API.
+
     Parameters:
     - config_file: str, the path to the configuration file
     - email: str, the email address of the customer
-    - maxmessages: int, the maximum number of messages to process
+    - maxmessages: int, the maximum number of images to caption
     - test_mode: bool, optional, whether to run in test mode (default is False)
+    - batch_size: int, optional, the number of documents captioned by each
+      message (default is 1)
+    - cascade: bool, optional, caption with the local model first (default is
+      False)
+    - threshold: float, optional, the lowest confidence of a local caption that
+      is kept (default is 0.5)
+    - backend: str, optional, how the local model is run (default is "int8")
     """
 
     with open(config_file, "r") as file:
@@ -30,53 +182,46 @@ def generate_captions(config_file, email, maxmessages, test_mode=False):
     pubsub_helper = photosapp.PubSubHelper(config_file)
     topic_name = config["topics"]["caption_topic"]["name"]
 
-    msg_batch_size = config["functions"]["caption_function"]["max_instances"]
+    dispatcher = AdaptiveDispatcher.from_config(config, "caption_function")
 
     db_name = config["firestore"]["database_name"]
     if test_mode:
         db_name = config["firestore"]["testdb_name"]
 
-    # Iterate through the documents in the database and generate messages
-    # for each one.
-    col_ref = db_helper.get_db().collection(
-        f'customers/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
-    ).order_by('acquisition_time')
-    image_list = col_ref.stream()
+    docs = get_uncaptioned_docs(
+        db_helper, customer_rec, maxmessages, IMAGE_FIELDS if cascade else ['caption']
+    )
+
+    document_paths = [document_path for document_path, _ in docs]
+    if cascade:
+        # Only needed in cascade mode, it pulls in torch.
+        from captionmodel import LocalCaptionModel
+
+        model = LocalCaptionModel(backend=backend)
+        use_config_credentials(config_file)
+        document_paths = caption_locally(
+            db_helper.get_db(), docs, model, threshold, batch_size=16
+        )
 
-    # Loop over the images first, creating messages to send.  It turns out that 
-    # if you leave the firestore connection open too long, it dies.
+    # Each message captions a batch of documents, single documents are sent
+    # in the single document format.
     msg_list = []
-    total_num_msgs = 0
-    for img in image_list:
-        # Captioning is expensive, only run it when there is no existing caption.
-        img_caption = img.to_dict().get('caption', None)
-        if img_caption is None:
-            msg = {
-                "database_name": db_name,
-                "document_path": f'{photosapp.CUSTOMERTABLE}/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}/{img.id}',
-            }
-            msg_list.append(msg)
-            total_num_msgs += 1
-
-            if maxmessages and total_num_msgs >= maxmessages:
-                break
+    for idx in range(0, len(document_paths), batch_size):
+        batch = document_paths[idx : idx + batch_size]
+        msg = {"database_name": db_name}
+        if len(batch) == 1:
+            msg["document_path"] = batch[0]
+        else:
+            msg["document_paths"] = batch
+        msg_list.append(msg)
 
-    # Now send the messages in the msg_list, making sure not to overwhelm
-    # the cloud functions.
-    total_num_msgs_sent = 0
+    # Now send the messages in the msg_list, as fast as the dispatcher finds
+    # the cloud functions and the captioning API can keep up.
     for msg in msg_list:
+        dispatcher.acquire()
         message_id = pubsub_helper.publish_message(topic_name, msg)
-        total_num_msgs_sent += 1
         print(f"\n\nPublished message {message_id}.")
         print(json.dumps(msg))
-        time.sleep(2)
-
-        if total_num_msgs_sent % msg_batch_size == 0:
-            print("\n\nSleeping for 15 seconds...")
-            print(f"Total messages sent: {total_num_msgs_sent}, {msg_batch_size}")
-            time.sleep(15)
-
-        
 
 
 if __name__ == "__main__":
@@ -86,7 +231,7 @@ if __name__ == "__main__":
         required=False,
         type=int,
         default=None,
-        help="maximum number of messages to send",
+        help="maximum number of images to caption",
     )
     parser.add_argument(
         "--configfile",
@@ -108,5 +253,42 @@ if __name__ == "__main__":
         help="use the test database",
     )
 
+    parser.add_argument(
+        "--batchsize",
+        required=False,
+        type=int,
+        default=1,
+        help="number of documents captioned by each message",
+    )
+    parser.add_argument(
+        "--cascade",
+        required=False,
+        action="store_true",
+        help="caption with the local model first, sending only uncertain images to the API",
+    )
+    parser.add_argument(
+        "--threshold",
+        required=False,
+        type=float,
+        default=0.5,
+        help="lowest confidence (0 to 1) of a local caption that is kept",
+    )
+    parser.add_argument(
+        "--backend",
+        required=False,
+        type=str,
+        default="int8",
+        help="how the local model is run: int8, onnx or fp32",
+    )
+
     args = parser.parse_args()
-    generate_captions(args.configfile, args.email, args.maxmessages, args.testmode)
+    generate_captions(
+        args.configfile,
+        args.email,
+        args.maxmessages,
+        args.testmode,
+        args.batchsize,
+        args.cascade,
+        args.threshold,
+        args.backend,
+    )
@@ -32,7 +32,7 @@ def process_record(record):
         storage_client = storage.Client()
         bucket = storage_client.get_bucket(record["bucket_name"])
         blob = bucket.get_blob(record["blob_name"])
-        webp_name = generate_webp_image(bucket, blob, storage_client)
+        webp_name = generate_webp_image(bucket, blob)
 
         # Retrieve the record from the database.
         db_helper = photosapp.DatabaseHelper(
@@ -241,9 +241,13 @@ class InfraManager(object):
             function.source_repository = functions_v1.SourceRepository()
             function.source_repository.url = attr["source_url"]
 
+            # env_vars are read from the local environment, env holds fixed
+            # settings for the deployment.
             envvars = {}
             for var in attr["env_vars"]:
                 envvars[var] = os.getenv(var)
+            for var, value in attr.get("env", {}).items():
+                envvars[var] = str(value)
             function.environment_variables = envvars
 
             request = functions_v1.CreateFunctionRequest(
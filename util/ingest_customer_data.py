@@ -5,23 +5,61 @@ from pathlib import Path
 import sys
 
 sys.path.insert(0, "../src")
-import time
 import yaml
 
 from tqdm import tqdm
 
+from dispatcher import AdaptiveDispatcher
 import photosapp
 
 
-def ingest_data(config_file, email, maxmessages, test_mode=False):
+def publish_batch(pubsub_helper, topic_name, msg, blob_names, dispatcher):
+    """
+    Publish an ingest message for a list of blobs, once the dispatcher allows.
+
+    A single blob is sent in the single blob message format ("blob_name"),
+    more than one is sent as a batch ("blob_names").
+
+    Parameters:
+    - pubsub_helper: PubSubHelper, the helper used to publish the message
+    - topic_name: str, the name of the ingest topic
+    - msg: dict, the fields shared by every blob in the message
+    - blob_names: list, the names of the blobs to ingest
+    - dispatcher: AdaptiveDispatcher, paces the messages
+
+    Returns:
+    str: the id of the published message
+    """
+
+    msg = dict(msg)
+    if len(blob_names) == 1:
+        msg["blob_name"] = blob_names[0]
+    else:
+        msg["blob_names"] = list(blob_names)
+
+    dispatcher.acquire()
+    message_id = pubsub_helper.publish_message(topic_name, msg)
+    print(f"\n\nPublished message {message_id}.")
+    print(json.dumps(msg))
+
+    return message_id
+
+
+def ingest_data(
+    config_file, email, maxmessages, test_mode=False, batch_size=1, force=False
+):
     """
     Ingest data from a configuration file for a specific customer.
 
     Parameters:
     - config_file: str, the path to the configuration file
     - email: str, the email address of the customer
-    - maxmessages: int, the maximum number of messages to process
+    - maxmessages: int, the maximum number of images to send
     - test_mode: bool, optional, whether to run in test mode (default is False)
+    - batch_size: int, optional, the number of blobs to send in each message
+      (default is 1, the single blob message format)
+    - force: bool, optional, whether to reprocess images that are unchanged
+      since the last ingest (default is False)
 
     Returns:
     This function does not return anything explicitly.
@@ -39,46 +77,49 @@ def ingest_data(config_file, email, maxmessages, test_mode=False):
     pubsub_helper = photosapp.PubSubHelper(config_file)
     topic_name = config["topics"]["ingest_topic"]["name"]
 
-    msg_batch_size = config["functions"]["ingest_function"]["max_instances"]
+    dispatcher = AdaptiveDispatcher.from_config(config, "ingest_function")
 
     db_name = config["firestore"]["database_name"]
     if test_mode:
         db_name = config["firestore"]["testdb_name"]
 
-    # Iterate through the blobs and create messages for each.
-    total_num_msgs_sent = 0
+    msg = {
+        "database_name": db_name,
+        "customer_table_name": photosapp.CUSTOMERTABLE,
+        "top_level_collection_name": photosapp.IMAGESTABLE,
+        "bucket_name": customer_rec["bucket_name"],
+        "user_id": customer_rec["uuid"],
+    }
+    if force:
+        msg["force"] = True
+
+    # Iterate through the blobs and create messages for each batch.
+    total_num_blobs = 0
+    blob_names = []
     for blob in tqdm(blobs):
 
         if "image" in blob.content_type:
 
-            # Skip adding the reduced image if it already exists.
+            # Skip the reduced images generated by the ingest function.
             base, ext = os.path.splitext(os.path.basename(blob.name))
-            if ext == "webp":
+            if ext in (".webp", ".avif"):
                 continue
 
-            msg = {
-                "database_name": db_name,
-                "customer_table_name": photosapp.CUSTOMERTABLE,
-                "top_level_collection_name": photosapp.IMAGESTABLE,
-                "bucket_name": customer_rec["bucket_name"],
-                "blob_name": blob.name,
-                "user_id": customer_rec["uuid"],
-            }
-
-            message_id = pubsub_helper.publish_message(topic_name, msg)
-            print(f"\n\nPublished message {message_id}.")
-            print(json.dumps(msg))
-            total_num_msgs_sent += 1
-            time.sleep(1)
-
-            if total_num_msgs_sent % msg_batch_size == 0:
-                print("\n\nSleeping for 2 seconds...")
-                print(f"Total messages sent: {total_num_msgs_sent}, {msg_batch_size}")
-                time.sleep(2)
-
-        if maxmessages and total_num_msgs_sent >= maxmessages:
+            blob_names.append(blob.name)
+            total_num_blobs += 1
+
+        done = maxmessages and total_num_blobs >= maxmessages
+        if len(blob_names) >= batch_size or (done and blob_names):
+            publish_batch(pubsub_helper, topic_name, msg, blob_names, dispatcher)
+            blob_names = []
+
+        if done:
             break
 
+    # Publish the final partial batch.
+    if blob_names:
+        publish_batch(pubsub_helper, topic_name, msg, blob_names, dispatcher)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -108,6 +149,26 @@ if __name__ == "__main__":
         action="store_true",
         help="use the test database",
     )
+    parser.add_argument(
+        "--force",
+        required=False,
+        action="store_true",
+        help="reprocess images even if they are unchanged since the last ingest",
+    )
+    parser.add_argument(
+        "--batchsize",
+        required=False,
+        type=int,
+        default=1,
+        help="number of blobs to send in each ingest message",
+    )
 
     args = parser.parse_args()
-    ingest_data(args.configfile, args.email, args.maxmessages, args.testmode)
+    ingest_data(
+        args.configfile,
+        args.email,
+        args.maxmessages,
+        args.testmode,
+        args.batchsize,
+        args.force,
+    )
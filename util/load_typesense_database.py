@@ -51,11 +51,12 @@ def load_typesense_db(config_file, email, maxrecords, test_mode=False):
     customer_rec = db_helper.get_customer(email)
 
     # Iterate through the documents in the database and generate messages
-    # for each one.
+    # for each one.  Only the summary fields are read, not the whole record.
     col_ref = (
         db_helper.get_db()
         .collection(f'customers/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}')
         .order_by("acquisition_time")
+        .select(photosapp.IMAGE_SUMMARY_FIELDS)
     )
     image_list = col_ref.stream()
 
@@ -65,9 +66,9 @@ def load_typesense_db(config_file, email, maxrecords, test_mode=False):
     record_list = []
     total_num_records = 0
     for img in tqdm(image_list):  # image_list:
-        img_caption = img.to_dict().get("caption", None)
+        img_rec = img.to_dict()
+        img_caption = img_rec.get("caption", None)
         if img_caption is not None:
-            img_rec = img.to_dict()
             typesense_rec = {
                 "acquisition_time": img_rec["acquisition_time"],
                 "bucket_name": img_rec["bucket_name"],
@@ -0,0 +1,203 @@
+import argparse
+import json
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, "../src")
+sys.path.insert(0, "../cloud_functions/ingest")
+from tqdm import tqdm
+
+from google.cloud import firestore_v1
+
+import photosapp
+from main import get_exif_data_from_header, normalize_exif
+
+
+def get_record_size(rec):
+    """Return the approximate stored size of a record in bytes, as JSON."""
+    return len(json.dumps(rec, default=str).encode("utf-8"))
+
+
+def scan_collection(col_ref):
+    """
+    Stream every document in a collection, as the util scans do.
+
+    Returns:
+    tuple: the documents, the total size in bytes and the elapsed seconds
+    """
+
+    start = time.perf_counter()
+    docs = []
+    total_bytes = 0
+    for doc in tqdm(col_ref.stream()):
+        total_bytes += get_record_size(doc.to_dict())
+        docs.append(doc)
+    return docs, total_bytes, time.perf_counter() - start
+
+
+def print_scan(label, num_docs, total_bytes, elapsed):
+    """Print the size and throughput of a collection scan."""
+    print(
+        f"{label:6s} {num_docs} records, {total_bytes / 1e6:.2f} MB "
+        f"({total_bytes / max(num_docs, 1):.0f} bytes/record), "
+        f"scanned in {elapsed:.1f} s ({num_docs / max(elapsed, 1e-9):.0f} records/s)"
+    )
+
+
+def migrate_exif_schema(
+    config_file,
+    email,
+    test_mode=False,
+    dry_run=False,
+    reextract=False,
+    store_raw_exif=False,
+):
+    """
+    Move the Exif data off a customer's image records into their metadata
+    sidecars, normalizing it on the way, and report the change in record size
+    and scan throughput.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - email: str, the email address of the customer
+    - test_mode: bool, optional, whether to run in test mode (default is False)
+    - dry_run: bool, optional, only report the projected sizes (default is False)
+    - reextract: bool, optional, re-read the Exif header of each original instead
+      of normalizing the stored tags, which for JPEGs lack the Exif and GPS
+      sub-IFDs (default is False)
+    - store_raw_exif: bool, optional, keep the raw Exif tags in the sidecar as
+      well as the normalized ones (default is False)
+    """
+
+    db_helper = photosapp.DatabaseHelper(config_file, test_mode)
+    customer_rec = db_helper.get_customer(email)
+    storage_helper = photosapp.GCStoragehelper(config_file)
+    db = db_helper.get_db()
+    col_ref = db.collection(
+        f'{photosapp.CUSTOMERTABLE}/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
+    )
+
+    # It turns out that if you leave the firestore connection open too long,
+    # it dies, so read everything first.
+    print("\n\nScanning the database...\n\n")
+    docs, bytes_before, elapsed_before = scan_collection(col_ref)
+
+    print("\n\nNormalizing the exif data...\n\n")
+    buckets = {}
+    updates = []
+    bytes_after = bytes_before
+    for doc in tqdm(docs):
+        rec = doc.to_dict()
+        if "exif" not in rec and "exif_data" not in rec:
+            continue
+
+        exif_data = rec.get("exif_data", None)
+        if reextract:
+            try:
+                if rec["bucket_name"] not in buckets:
+                    buckets[rec["bucket_name"]] = storage_helper.get_bucket(
+                        rec["bucket_name"]
+                    )
+                blob = buckets[rec["bucket_name"]].get_blob(rec["blob_name"])
+                exif_data = get_exif_data_from_header(blob)
+            except Exception as e:
+                print(e)
+                print(rec["bucket_name"], rec["blob_name"])
+                continue
+
+        exif = rec.get("exif", None)
+        if reextract or exif is None:
+            exif = normalize_exif(exif_data)
+        sidecar = {"exif": exif}
+        if store_raw_exif:
+            sidecar["exif_data"] = exif_data
+
+        new_rec = {k: v for k, v in rec.items() if k not in ("exif", "exif_data")}
+        bytes_after += get_record_size(new_rec) - get_record_size(rec)
+        updates.append((doc.reference, sidecar))
+
+    print(f"\n\nFound {len(docs)} records, {len(updates)} to migrate.\n\n")
+    print_scan("Before", len(docs), bytes_before, elapsed_before)
+    if dry_run:
+        print_scan("After", len(docs), bytes_after, float("nan"))
+        return
+
+    print("\n\nMigrating the records...\n\n")
+    batch = db.batch()
+    num_writes = 0
+    for doc_ref, sidecar in tqdm(updates):
+        # Keep the record and its sidecar in the same batch.
+        batch.set(
+            doc_ref.collection(photosapp.METADATATABLE).document(
+                photosapp.EXIF_METADATA_DOC
+            ),
+            sidecar,
+        )
+        batch.update(
+            doc_ref,
+            {"exif": firestore_v1.DELETE_FIELD, "exif_data": firestore_v1.DELETE_FIELD},
+        )
+        num_writes += 2
+        if num_writes + 2 > photosapp.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+            num_writes = 0
+    if num_writes:
+        batch.commit()
+
+    print("\n\nScanning the migrated database...\n\n")
+    docs, bytes_after, elapsed_after = scan_collection(col_ref)
+    print_scan("Before", len(docs), bytes_before, elapsed_before)
+    print_scan("After", len(docs), bytes_after, elapsed_after)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--email",
+        required=True,
+        type=str,
+        default=None,
+        help="customer email to migrate the records for",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database",
+    )
+    parser.add_argument(
+        "--dryrun",
+        required=False,
+        action="store_true",
+        help="only report the projected record sizes",
+    )
+    parser.add_argument(
+        "--reextract",
+        required=False,
+        action="store_true",
+        help="re-read the exif header of each original from cloud storage",
+    )
+    parser.add_argument(
+        "--storerawexif",
+        required=False,
+        action="store_true",
+        help="keep the raw exif tags in the metadata sidecars",
+    )
+
+    args = parser.parse_args()
+    migrate_exif_schema(
+        args.configfile,
+        args.email,
+        args.testmode,
+        args.dryrun,
+        args.reextract,
+        args.storerawexif,
+    )
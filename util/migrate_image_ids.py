@@ -0,0 +1,171 @@
+import argparse
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../src")
+from tqdm import tqdm
+
+import photosapp
+
+
+def merge_records(docs):
+    """
+    Merge duplicate records for the same blob into one.  The record with the
+    most fields is considered the "best" and wins any conflicts, but fields that
+    only exist on the other records (e.g. a caption) are kept.
+
+    Parameters:
+    - docs: list, the DocumentSnapshots for the same blob
+
+    Returns:
+    dict: the merged record
+    """
+
+    merged = {}
+    for doc in sorted(docs, key=lambda d: len(d.to_dict().keys())):
+        merged.update(doc.to_dict())
+    return merged
+
+
+def get_sidecars(docs, new_id):
+    """
+    Read the metadata sidecars (e.g. the exif document written by
+    migrate_exif_schema.py) of duplicate records for the same blob, merged the
+    same way as merge_records.
+
+    Parameters:
+    - docs: list, the DocumentSnapshots for the same blob
+    - new_id: str, the id the records are migrated to
+
+    Returns:
+    tuple: the merged sidecars keyed by document id, and the references of the
+    sidecars of the records that are not already at new_id
+    """
+
+    sidecars = {}
+    old_refs = []
+    for doc in sorted(docs, key=lambda d: len(d.to_dict().keys())):
+        for sidecar in doc.reference.collection(photosapp.METADATATABLE).stream():
+            sidecars[sidecar.id] = sidecar.to_dict()
+            if doc.id != new_id:
+                old_refs.append(sidecar.reference)
+    return sidecars, old_refs
+
+
+def migrate_image_ids(config_file, email, test_mode=False, dry_run=False):
+    """
+    Rewrite a customer's image records so each one is keyed by
+    photosapp.get_image_doc_id, merging any duplicate records for the same
+    blob on the way.  Their metadata sidecars move with them.  Records that
+    don't name a bucket and blob are reported and left as they are.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - email: str, the email address of the customer
+    - test_mode: bool, optional, whether to run in test mode (default is False)
+    - dry_run: bool, optional, only report what would change (default is False)
+    """
+
+    db_helper = photosapp.DatabaseHelper(config_file, test_mode)
+    customer_rec = db_helper.get_customer(email)
+    db = db_helper.get_db()
+    col_ref = db.collection(
+        f'{photosapp.CUSTOMERTABLE}/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
+    )
+
+    # Group the records by their new id.  It turns out that if you leave the
+    # firestore connection open too long, it dies, so read everything first.
+    print("\n\nQuerying the database...\n\n")
+    groups = {}
+    skipped = []
+    for doc in tqdm(col_ref.stream()):
+        rec = doc.to_dict()
+        if not rec.get("bucket_name") or not rec.get("blob_name"):
+            skipped.append(doc.id)
+            continue
+        new_id = photosapp.get_image_doc_id(rec["bucket_name"], rec["blob_name"])
+        groups.setdefault(new_id, []).append(doc)
+
+    if skipped:
+        print(f"\n\nSkipping {len(skipped)} records with no bucket_name or blob_name:")
+        for doc_id in skipped:
+            print(f"  {doc_id}")
+
+    to_migrate = {
+        new_id: docs
+        for new_id, docs in groups.items()
+        if len(docs) > 1 or docs[0].id != new_id
+    }
+    num_deletes = sum(len(docs) for docs in to_migrate.values())
+    print(
+        f"\n\nFound {len(groups)} unique blobs, {len(to_migrate)} to migrate "
+        f"({num_deletes} records to rewrite).\n\n"
+    )
+    if dry_run:
+        return
+
+    print("\n\nMigrating the records...\n\n")
+    batch = db.batch()
+    num_writes = 0
+    for new_id, docs in tqdm(to_migrate.items()):
+        new_ref = col_ref.document(new_id)
+        sidecars, old_sidecar_refs = get_sidecars(docs, new_id)
+        deletes = [doc.reference for doc in docs if doc.id != new_id]
+        deletes += old_sidecar_refs
+
+        # Keep the sets and the deletes for one blob in the same batch, so a
+        # record never loses its sidecars.
+        blob_writes = 1 + len(sidecars) + len(deletes)
+        if num_writes + blob_writes > photosapp.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+            num_writes = 0
+
+        record = merge_records(docs)
+        record["uuid"] = new_id
+        batch.set(new_ref, record)
+        for sidecar_id, sidecar in sidecars.items():
+            batch.set(
+                new_ref.collection(photosapp.METADATATABLE).document(sidecar_id),
+                sidecar,
+            )
+        for ref in deletes:
+            batch.delete(ref)
+        num_writes += blob_writes
+
+    if num_writes:
+        batch.commit()
+
+    print(f"\n\nDone.  Migrated {len(to_migrate)} records.\n\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--email",
+        required=True,
+        type=str,
+        default=None,
+        help="customer email to migrate the image records for",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database",
+    )
+    parser.add_argument(
+        "--dryrun",
+        required=False,
+        action="store_true",
+        help="report the records that would be migrated without changing them",
+    )
+
+    args = parser.parse_args()
+    migrate_image_ids(args.configfile, args.email, args.testmode, args.dryrun)
@@ -0,0 +1,150 @@
+import argparse
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../src")
+sys.path.insert(0, "../cloud_functions/ingest")
+from tqdm import tqdm
+
+import photosapp
+from exifheader import ExifHeaderReader
+from main import get_exif_data_from_header, get_photo_acquired_time, normalize_exif
+
+
+def reextract_timestamps(
+    config_file, email, test_mode=False, update_exif=False, store_raw_exif=False
+):
+    """
+    Re-extract the acquisition time of every image record for a customer,
+    reading only the Exif header of each original with ranged reads.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - email: str, the email address of the customer
+    - test_mode: bool, optional, whether to run in test mode (default is False)
+    - update_exif: bool, optional, whether to rewrite the Exif data in the
+      metadata sidecars too (default is False)
+    - store_raw_exif: bool, optional, whether the rewritten sidecars keep the
+      raw Exif tags as well as the normalized ones (default is False)
+    """
+
+    db_helper = photosapp.DatabaseHelper(config_file, test_mode)
+    customer_rec = db_helper.get_customer(email)
+    storage_helper = photosapp.GCStoragehelper(config_file)
+    db = db_helper.get_db()
+
+    # Loop over the images first, creating records to process.  It turns out that
+    # if you leave the firestore connection open too long, it dies.
+    print("\n\nQuerying the database...\n\n")
+    col_ref = db.collection(
+        f'{photosapp.CUSTOMERTABLE}/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}'
+    )
+    records = [
+        (doc.reference, doc.to_dict())
+        for doc in tqdm(
+            col_ref.select(["bucket_name", "blob_name", "acquisition_time"]).stream()
+        )
+    ]
+
+    print("\n\nRe-extracting timestamps...\n\n")
+    buckets = {}
+    bytes_fetched = 0
+    bytes_total = 0
+    num_updated = 0
+    batch = db.batch()
+    num_writes = 0
+    for doc_ref, rec in tqdm(records):
+        try:
+            if rec["bucket_name"] not in buckets:
+                buckets[rec["bucket_name"]] = storage_helper.get_bucket(
+                    rec["bucket_name"]
+                )
+            blob = buckets[rec["bucket_name"]].get_blob(rec["blob_name"])
+
+            reader = ExifHeaderReader(blob)
+            exif_data = get_exif_data_from_header(blob, reader)
+            bytes_fetched += reader.bytes_fetched
+            bytes_total += blob.size
+            time_stamp = get_photo_acquired_time(rec["blob_name"], exif_data)
+        except Exception as e:
+            print(e)
+            print(rec["bucket_name"], rec["blob_name"])
+            continue
+
+        updated = False
+        if time_stamp.isoformat() != rec.get("acquisition_time", None):
+            batch.update(doc_ref, {"acquisition_time": time_stamp.isoformat()})
+            num_writes += 1
+            updated = True
+        if update_exif:
+            sidecar_ref = doc_ref.collection(photosapp.METADATATABLE).document(
+                photosapp.EXIF_METADATA_DOC
+            )
+            sidecar = {"exif": normalize_exif(exif_data)}
+            if store_raw_exif:
+                sidecar["exif_data"] = exif_data
+            batch.set(sidecar_ref, sidecar)
+            num_writes += 1
+            updated = True
+        if not updated:
+            continue
+
+        num_updated += 1
+        if num_writes + 2 > photosapp.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+            num_writes = 0
+
+    if num_writes:
+        batch.commit()
+
+    print(f"\n\nDone.  Updated {num_updated} of {len(records)} records.")
+    if bytes_total:
+        print(
+            f"Fetched {bytes_fetched} of {bytes_total} bytes "
+            f"({100 * bytes_fetched / bytes_total:.2f}% of the originals)."
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--email",
+        required=True,
+        type=str,
+        default=None,
+        help="customer email to re-extract the timestamps for",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database",
+    )
+    parser.add_argument(
+        "--updateexif",
+        required=False,
+        action="store_true",
+        help="also rewrite the exif data in the metadata sidecars",
+    )
+    parser.add_argument(
+        "--storerawexif",
+        required=False,
+        action="store_true",
+        help="keep the raw exif tags in the rewritten sidecars",
+    )
+
+    args = parser.parse_args()
+    reextract_timestamps(
+        args.configfile,
+        args.email,
+        args.testmode,
+        args.updateexif,
+        args.storerawexif,
+    )
@@ -4,15 +4,19 @@ from pathlib import Path
 import sys
 
 sys.path.insert(0, "../src")
-import time
 import yaml
 
 from tqdm import tqdm
 
+from dispatcher import AdaptiveDispatcher
 import photosapp
 
+from ingest_customer_data import publish_batch
 
-def ingest_failed_data(config_file, email, logfile, test_mode=False):
+
+def ingest_failed_data(
+    config_file, email, logfile, test_mode=False, batch_size=1, force=False
+):
     """
     Ingests failed data from a logfile and publishes messages to a topic.
 
@@ -21,6 +25,10 @@ def ingest_failed_data(config_file, email, logfile, test_mode=False):
         email (str): Email of the customer.
         logfile (str): Path to the logfile containing failed messages.
         test_mode (bool, optional): If True, uses test database. Defaults to False.
+        batch_size (int, optional): Number of blobs to send in each message.
+            Defaults to 1.
+        force (bool, optional): If True, reprocess images that are unchanged
+            since the last ingest. Defaults to False.
 
     Returns:
         None
@@ -38,36 +46,46 @@ def ingest_failed_data(config_file, email, logfile, test_mode=False):
     pubsub_helper = photosapp.PubSubHelper(config_file)
     topic_name = config["topics"]["ingest_topic"]["name"]
 
-    msg_batch_size = config["functions"]["ingest_function"]["max_instances"]
+    dispatcher = AdaptiveDispatcher.from_config(config, "ingest_function")
 
     db_name = config["firestore"]["database_name"]
     if test_mode:
         db_name = config["firestore"]["testdb_name"]
 
-    # Iterate through the failed messages and create ingest messages for each one,
-    # publishing them to the topic.
-    total_num_msgs_sent = 0
+    # Group the failed blobs by bucket, since a batched message names a
+    # single bucket.
+    failed_blobs = {}
     for entry in failed_messages:
+        # Skip entries that don't name a blob, e.g. batch summaries.
+        if "blob_name" not in entry["jsonPayload"]:
+            continue
+        bucket_name = entry["jsonPayload"]["bucket_name"]
+        failed_blobs.setdefault(bucket_name, []).append(
+            entry["jsonPayload"]["blob_name"]
+        )
+
+    # Iterate through the failed blobs and create ingest messages for each batch,
+    # publishing them to the topic.
+    for bucket_name, blob_names in failed_blobs.items():
 
         msg = {
             "database_name": db_name,
             "customer_table_name": photosapp.CUSTOMERTABLE,
             "top_level_collection_name": photosapp.IMAGESTABLE,
-            "bucket_name": entry["jsonPayload"]["bucket_name"],
-            "blob_name": entry["jsonPayload"]["blob_name"],
+            "bucket_name": bucket_name,
             "user_id": customer_rec["uuid"],
         }
+        if force:
+            msg["force"] = True
 
-        message_id = pubsub_helper.publish_message(topic_name, msg)
-        print(f"\n\nPublished message {message_id}.")
-        print(json.dumps(msg))
-        total_num_msgs_sent += 1
-        time.sleep(1)
-
-        if total_num_msgs_sent % msg_batch_size == 0:
-            print("\n\nSleeping for 2 seconds...")
-            print(f"Total messages sent: {total_num_msgs_sent}, {msg_batch_size}")
-            time.sleep(2)
+        for idx in range(0, len(blob_names), batch_size):
+            publish_batch(
+                pubsub_helper,
+                topic_name,
+                msg,
+                blob_names[idx : idx + batch_size],
+                dispatcher,
+            )
 
 
 if __name__ == "__main__":
@@ -97,6 +115,26 @@ if __name__ == "__main__":
         action="store_true",
         help="use the test database",
     )
+    parser.add_argument(
+        "--force",
+        required=False,
+        action="store_true",
+        help="reprocess images even if they are unchanged since the last ingest",
+    )
+    parser.add_argument(
+        "--batchsize",
+        required=False,
+        type=int,
+        default=1,
+        help="number of blobs to send in each ingest message",
+    )
 
     args = parser.parse_args()
-    ingest_failed_data(args.configfile, args.email, args.logfile, args.testmode)
+    ingest_failed_data(
+        args.configfile,
+        args.email,
+        args.logfile,
+        args.testmode,
+        args.batchsize,
+        args.force,
+    )
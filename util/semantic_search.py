@@ -0,0 +1,164 @@
+import argparse
+import os
+from pathlib import Path
+import sys
+
+sys.path.insert(0, "../src")
+import time
+
+from tqdm import tqdm
+
+import photosapp
+from semanticsearch import DEFAULT_EMBEDDING_MODEL, CaptionEmbedder, SemanticIndex
+
+
+def get_captioned_records(db_helper, customer_rec):
+    """
+    Get the summary fields of every captioned image of a customer.
+
+    Parameters:
+    - db_helper: DatabaseHelper, the database helper
+    - customer_rec: dict, the customer record
+
+    Returns:
+    dict: the summary record of each captioned image, by image id
+    """
+
+    # Only the summary fields are read, not the whole record.
+    col_ref = (
+        db_helper.get_db()
+        .collection(f'customers/{customer_rec["uuid"]}/{photosapp.IMAGESTABLE}')
+        .select(photosapp.IMAGE_SUMMARY_FIELDS)
+    )
+
+    # Read everything first, it turns out that if you leave the firestore
+    # connection open too long, it dies.
+    records = {}
+    for img in tqdm(col_ref.stream()):
+        img_rec = img.to_dict()
+        if img_rec.get("caption", None):
+            records[img.id] = img_rec
+    return records
+
+
+def semantic_search(
+    config_file,
+    email,
+    index_dir,
+    update=False,
+    query=None,
+    topk=10,
+    test_mode=False,
+    model_str=DEFAULT_EMBEDDING_MODEL,
+):
+    """
+    Update a customer's semantic search index from the captions in the
+    database, and/or search it.
+
+    Parameters:
+    - config_file: str, the path to the configuration file
+    - email: str, the email address of the customer
+    - index_dir: Path, the directory holding the index of every customer
+    - update: bool, optional, embed the new captions into the index (default
+      is False)
+    - query: str, optional, the text to search for (default is None)
+    - topk: int, optional, the number of results (default is 10)
+    - test_mode: bool, optional, whether to run in test mode (default is False)
+    - model_str: str, optional, the sentence-transformers model
+    """
+
+    db_helper = photosapp.DatabaseHelper(config_file, test_mode)
+    customer_rec = db_helper.get_customer(email)
+
+    embedder = CaptionEmbedder(model_str)
+    index = SemanticIndex(os.path.join(index_dir, customer_rec["uuid"]), embedder.dim)
+
+    if update:
+        print("\n\nRetrieving captions from Firestore...\n\n")
+        records = get_captioned_records(db_helper, customer_rec)
+
+        start = time.perf_counter()
+        num_changed, num_removed = index.update(records, embedder)
+        index.save()
+        print(
+            f"\n\nEmbedded {num_changed} new or changed captions and removed "
+            f"{num_removed} in {time.perf_counter() - start:.1f} s."
+        )
+
+    if query:
+        start = time.perf_counter()
+        results = index.search(query, embedder, topk)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        print(f'\n\nTop {len(results)} results for "{query}" ({elapsed_ms:.1f} ms):\n')
+        for rec, similarity in results:
+            print(f'{similarity:.3f}  {rec["blob_name"]}  {rec["caption"]}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configfile",
+        required=True,
+        type=Path,
+        help="path to the yaml config file",
+    )
+    parser.add_argument(
+        "--email",
+        required=True,
+        type=str,
+        default=None,
+        help="customer email to index or search the images of",
+    )
+    parser.add_argument(
+        "--indexdir",
+        required=False,
+        type=Path,
+        default=Path("_index_"),
+        help="directory holding the semantic search index of each customer",
+    )
+    parser.add_argument(
+        "--update",
+        required=False,
+        action="store_true",
+        help="embed the new and changed captions into the index",
+    )
+    parser.add_argument(
+        "--query",
+        required=False,
+        type=str,
+        default=None,
+        help="text to search the captions for",
+    )
+    parser.add_argument(
+        "--topk",
+        required=False,
+        type=int,
+        default=10,
+        help="number of results to return",
+    )
+    parser.add_argument(
+        "--testmode",
+        required=False,
+        action="store_true",
+        help="use the test database",
+    )
+    parser.add_argument(
+        "--model",
+        required=False,
+        type=str,
+        default=DEFAULT_EMBEDDING_MODEL,
+        help="sentence-transformers model used to embed the captions",
+    )
+
+    args = parser.parse_args()
+    semantic_search(
+        args.configfile,
+        args.email,
+        args.indexdir,
+        args.update,
+        args.query,
+        args.topk,
+        args.testmode,
+        args.model,
+    )